@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import datetime
+
+from search import normalize_name, MAX_CHAR, TYPEAHEAD_LIMIT
+from xmlio import NOW
+
+# Pacientes sem nenhuma alteração há mais dias que isso vão para o arquivo
+ARCHIVE_DAYS = 3 * 365
+
+# Nome do banco anexado com ATTACH
+ALIAS = "arquivo"
+
+# O arquivo guarda o nome do plano em vez do id, para não depender da
+# tabela planos do banco principal; alterado é o momento da última
+# alteração antes de arquivar
+CREATE_ARCHIVE = (
+    "CREATE TABLE IF NOT EXISTS arquivo.pacientes (id INTEGER PRIMARY KEY, nome TEXT NOT NULL, sexo TEXT, "
+    "cartao TEXT, dia_nasc TEXT, mes_nasc TEXT, ano_nasc TEXT, endereco TEXT, cidade TEXT, estado TEXT, cep TEXT, "
+    "telefone TEXT NOT NULL, celular TEXT, plano TEXT NOT NULL, nome_busca TEXT, conteudo_hash TEXT, "
+    "nascimento TEXT, versao INTEGER NOT NULL DEFAULT 0, alterado TEXT, arquivado TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS arquivo.pacientes_nome_busca ON pacientes (nome_busca, id)",
+    "CREATE INDEX IF NOT EXISTS arquivo.pacientes_nome ON pacientes (nome)",
+)
+
+COLUMNS = ("id, nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, "
+           "celular, {0}, nome_busca, conteudo_hash, nascimento, versao")
+
+ARCHIVE_PATIENTS = ("INSERT OR REPLACE INTO arquivo.pacientes (" + COLUMNS.format("plano") + ", alterado, arquivado) "
+                    "SELECT pacientes.id, pacientes.nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, "
+                    "cidade, estado, cep, telefone, celular, planos.nome, nome_busca, conteudo_hash, nascimento, "
+                    "versao, alteracoes.momento, " + NOW + " "
+                    "FROM alteracoes, pacientes, planos "
+                    "WHERE alteracoes.momento < ? AND NOT alteracoes.removido "
+                    "AND pacientes.id = alteracoes.paciente_id AND planos.id = pacientes.plano_id")
+
+# Só remove do banco principal o que já está gravado no arquivo e continua
+# sem alteração (outra estação pode ter gravado entre as duas transações)
+DELETE_ARCHIVED = ("DELETE FROM main.pacientes WHERE id IN (SELECT paciente_id FROM alteracoes WHERE momento < ?) "
+                   "AND EXISTS (SELECT 1 FROM arquivo.pacientes AS a WHERE a.id = main.pacientes.id)")
+
+# Cópias no arquivo de pacientes que continuam no banco principal: alterados
+# entre as duas transações de archive_patients, ou trazidos de volta com o
+# mesmo id por uma importação incremental (registro). Os ids são AUTOINCREMENT
+# e nunca reaproveitados, então o mesmo id é o mesmo paciente, e vale o do
+# banco principal.
+DELETE_ACTIVE = "DELETE FROM arquivo.pacientes WHERE id IN (SELECT id FROM main.pacientes)"
+
+# Depois de uma importação: quem está no arquivo importado (mesmo id, ou
+# mesmo nome e telefone) voltou a ser ativo e sai do arquivo
+DELETE_REIMPORTED = ("DELETE FROM arquivo.pacientes WHERE id IN (SELECT id FROM main.pacientes) "
+                     "OR EXISTS (SELECT 1 FROM main.pacientes AS p "
+                     "WHERE p.nome = arquivo.pacientes.nome AND p.telefone = arquivo.pacientes.telefone)")
+
+# A importação completa refaz o registro de alterações só com o banco
+# principal (xmlio.RESET_CHANGES); os que continuam arquivados entram de novo
+LOG_ARCHIVED = ("INSERT OR IGNORE INTO main.alteracoes (paciente_id, removido, momento) "
+                "SELECT id, 0, " + NOW + " FROM arquivo.pacientes ORDER BY id")
+
+RESTORE_PATIENT = ("INSERT INTO main.pacientes (" + COLUMNS.format("plano_id") + ") "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def archive_name(filename):
+    # patients.sdb -> patients-arquivo.sdb
+    return os.path.splitext(filename)[0] + "-arquivo.sdb"
+
+
+def cutoff(days, now=None):
+    # Momento (no formato de alteracoes.momento) antes do qual um paciente está inativo
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - datetime.timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def attach(db, filename, create=False):
+    # Anexa o arquivo à conexão, uma vez só; sem create, devolve False se o
+    # arquivo ainda não existe (nada foi arquivado)
+    cursor = db.cursor()
+    cursor.execute("PRAGMA database_list")
+    if any(row[1] == ALIAS for row in cursor.fetchall()):
+        return True
+    if not create and not os.path.exists(filename):
+        return False
+    cursor.execute("ATTACH DATABASE ? AS " + ALIAS, (filename,))
+    cursor.execute("PRAGMA arquivo.journal_mode=WAL")
+    for sql in CREATE_ARCHIVE:
+        cursor.execute(sql)
+    return True
+
+
+def archive_patients(db, before):
+    # Move para o arquivo os pacientes com a última alteração antes de
+    # before. São duas transações, porque no modo WAL uma transação em dois
+    # bancos não é atômica entre eles: primeiro grava no arquivo, depois
+    # remove do principal. Uma falha no meio deixa o paciente nos dois, o
+    # que a próxima execução resolve (DELETE_ACTIVE), e também um paciente
+    # alterado entre as duas: a segunda tira do arquivo a cópia dele, que
+    # as exportações escreveriam junto com a atual. Devolve quantos saíram do
+    # banco principal.
+    # Arquivar não é remover: o gatilho do registro de alterações sai
+    # durante a remoção, e o paciente continua com a sua última alteração
+    # (xmlio.export_changes lê os campos do arquivo).
+    cursor = db.cursor()
+    try:
+        cursor.execute(ARCHIVE_PATIENTS, (before,))
+        db.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT sql FROM main.sqlite_master WHERE type='trigger' AND name='pacientes_removido'")
+        trigger = cursor.fetchone()
+        if trigger is not None:
+            cursor.execute("DROP TRIGGER main.pacientes_removido")
+        cursor.execute(DELETE_ARCHIVED, (before,))
+        count = cursor.rowcount
+        cursor.execute(DELETE_ACTIVE)
+        if trigger is not None:
+            cursor.execute(trigger[0])
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return count
+
+
+def search_archived(db, text, limit=TYPEAHEAD_LIMIT):
+    # Como search.search_names, no arquivo
+    key = normalize_name(text)
+    if not key:
+        return []
+    cursor = db.cursor()
+    cursor.execute("SELECT nome, id FROM arquivo.pacientes "
+                   "WHERE nome_busca >= ? AND nome_busca < ? "
+                   "ORDER BY nome_busca, id LIMIT ?",
+                   (key, key + MAX_CHAR, limit))
+    return cursor.fetchall()
+
+
+def find_archived_by_name(db, nome):
+    cursor = db.cursor()
+    cursor.execute("SELECT nome, id FROM arquivo.pacientes WHERE nome=? ORDER BY id", (nome,))
+    return cursor.fetchall()
+
+
+def restore_patient(db, planos, identity):
+    # Traz o paciente de volta ao banco principal com o mesmo id e versão.
+    # Devolve False se o id não está no arquivo; se ele também está no banco
+    # principal (arquivado pela metade), levanta ValueError e não altera
+    # nada: a próxima execução de archive_patients ou importação descarta a
+    # cópia do arquivo.
+    cursor = db.cursor()
+    cursor.execute("SELECT " + COLUMNS.format("plano") + " FROM arquivo.pacientes WHERE id=?", (identity,))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    try:
+        try:
+            cursor.execute(RESTORE_PATIENT, row[:13] + (planos.get_and_set(row[13], commit=False),) + row[14:])
+        except sqlite3.IntegrityError:
+            raise ValueError('O paciente {0} já está no banco de dados principal'.format(identity))
+        db.commit()
+        cursor.execute("DELETE FROM arquivo.pacientes WHERE id=?", (identity,))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        planos.reload()
+        raise
+    return True
+
+
+def count_archived(db):
+    cursor = db.cursor()
+    cursor.execute("SELECT COUNT(*) FROM arquivo.pacientes")
+    return cursor.fetchone()[0]
+
+
+def after_import(db, full):
+    # O arquivo continua valendo depois de uma importação (os arquivados
+    # também estão nas exportações completas): tira dele quem voltou no
+    # arquivo importado e, depois de uma importação completa, registra de
+    # novo os que ficaram. Devolve quantos continuam arquivados.
+    cursor = db.cursor()
+    try:
+        cursor.execute(DELETE_REIMPORTED)
+        if full:
+            cursor.execute(LOG_ARCHIVED)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return count_archived(db)
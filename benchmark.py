@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import filecmp
+import random
+import sqlite3
+import argparse
+import platform
+import subprocess
+import statistics
+import multiprocessing
+import xml.sax.saxutils
+
+import xmlio
+from repository import ConflictError, Patient, PatientRepository
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+# Quantas vezes cada operação pontual é repetida por tamanho
+DEFAULT_SAMPLES = 200
+
+# Percentual de piora, em relação a um relatório anterior, tratado como regressão
+DEFAULT_THRESHOLD = 20.0
+
+# Teste de concorrência: pacientes no banco e quantos deles todos os
+# processos disputam, para que haja conflitos de verdade
+STRESS_ROWS = 10000
+STRESS_HOT = 50
+
+# Carga no servidor: proporção de cada operação feita pelos clientes
+HTTP_MIX = (("search", 0.6), ("get", 0.3), ("save", 0.1))
+
+FIRST_NAMES = ("José", "Maria", "João", "Ana", "Antônio", "Francisca", "Carlos", "Luíza", "Paulo", "Adriana",
+               "Pedro", "Márcia", "Lucas", "Fernanda", "Luiz", "Patrícia", "Marcos", "Aline", "Gabriel", "Sandra",
+               "Rafael", "Camila", "Daniel", "Juliana", "Marcelo", "Letícia", "Bruno", "Vânia", "Eduardo", "Cláudia")
+
+SURNAMES = ("Silva", "Santos", "Oliveira", "Souza", "Rodrigues", "Ferreira", "Alves", "Pereira", "Lima", "Gomes",
+            "Costa", "Ribeiro", "Martins", "Carvalho", "Almeida", "Lopes", "Soares", "Fernandes", "Vieira",
+            "Barbosa", "Rocha", "Dias", "Nascimento", "Andrade", "Moreira", "Nunes", "Marques", "Machado",
+            "Mendes", "Freitas", "D'Ávila", "Conceição", "Araújo", "Gonçalves", "Brandão")
+
+CITIES = (("São Paulo", "SP"), ("Campinas", "SP"), ("Rio de Janeiro", "RJ"), ("Niterói", "RJ"),
+          ("Belo Horizonte", "MG"), ("Uberlândia", "MG"), ("Curitiba", "PR"), ("Londrina", "PR"),
+          ("Porto Alegre", "RS"), ("Salvador", "BA"), ("Recife", "PE"), ("Fortaleza", "CE"),
+          ("Goiânia", "GO"), ("Brasília", "DF"), ("Florianópolis", "SC"), ("Belém", "PA"))
+
+STREETS = ("Rua das Flores", "Avenida Brasil", "Rua São João", "Travessa Santa Rita", "Rua 7 de Setembro",
+           "Avenida Paulista", "Rua XV de Novembro", "Alameda Santos", "Rua Barão & Filhos")
+
+PLANOS = ("UNIMED", "BRADESCO SAÚDE", "AMIL", "SULAMÉRICA", "PARTICULAR", "SUS", "GOLDEN CROSS",
+          "PORTO SEGURO", "CASSI", "GEAP", "NOTRE DAME", "HAPVIDA")
+
+MONTHS = ('Janeiro', 'Fevereiro', 'Março', 'Abril', 'Maio', 'Junho',
+          'Julho', 'Agosto', 'Setembro', 'Outubro', 'Novembro', 'Dezembro')
+
+
+def generate_patients(count, seed=1):
+    # Sempre os mesmos pacientes para a mesma semente
+    rng = random.Random(seed)
+    for number in range(count):
+        city, state = rng.choice(CITIES)
+        nome = "{0} {1} {2}".format(rng.choice(FIRST_NAMES), rng.choice(SURNAMES), rng.choice(SURNAMES))
+        yield Patient(nome,
+                      sexo=rng.choice(('Masculino', 'Feminino')),
+                      cartao="{0:012d}".format(rng.randrange(10 ** 12)),
+                      dia_nasc="{0:02d}".format(rng.randint(1, 28)),
+                      mes_nasc=rng.choice(MONTHS),
+                      ano_nasc=str(rng.randint(1925, 2023)),
+                      endereco="{0}, {1}".format(rng.choice(STREETS), rng.randint(1, 3000)),
+                      cidade=city,
+                      estado=state,
+                      cep="{0:05d}-{1:03d}".format(rng.randrange(100000), rng.randrange(1000)),
+                      telefone="({0}) {1:04d}-{2:04d}".format(rng.randint(11, 99), rng.randrange(10000), number % 10000),
+                      celular="({0}) 9{1:04d}-{2:04d}".format(rng.randint(11, 99), rng.randrange(10000),
+                                                              rng.randrange(10000)),
+                      plano=rng.choice(PLANOS))
+
+
+def write_xml(filename, count, seed=1):
+    # Mesmo formato gravado por xmlio.export_xml com o formato XML
+    with open(filename, "wb") as fh:
+        fh.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n')
+        lines = []
+        for patient in generate_patients(count, seed):
+            lines.append(xmlio.pac_line((patient.nome, patient.sexo, patient.cartao, patient.dia_nasc,
+                                         patient.mes_nasc, patient.ano_nasc, patient.endereco, patient.cidade,
+                                         patient.plano, patient.estado, patient.cep, patient.telefone,
+                                         patient.celular)))
+            if len(lines) >= xmlio.EXPORT_CHUNK:
+                fh.write("".join(lines).encode("UTF-8"))
+                lines.clear()
+        fh.write("".join(lines).encode("UTF-8"))
+        fh.write(b"</pacientes>\n")
+
+
+def baseline_export_xml(db, filename):
+    # O exportador anterior ao atual xmlio.export_xml, mantido só como
+    # referência de desempenho: lê o cursor linha a linha, passa todo
+    # atributo por quoteattr e faz vários write por paciente. Os atributos
+    # nulos ficam de fora, como no atual (o anterior parava com erro).
+    cursor = db.cursor()
+    cursor.execute(xmlio.SELECT_EXPORT)
+    count = 0
+    with open(filename, mode="w", encoding="UTF-8") as fh:
+        fh.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fh.write("<pacientes>\n")
+        for record in cursor:
+            fh.write("<pac")
+            for name, value in zip(xmlio.ATTRIBUTES, record[1:]):
+                if value is not None:
+                    fh.write(" {0}={1}".format(name, xml.sax.saxutils.quoteattr(value)))
+            fh.write(">")
+            fh.write(xml.sax.saxutils.escape(record[0]))
+            fh.write("</pac>\n")
+            count += 1
+        fh.write("</pacientes>\n")
+    return count
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "mean_ms": statistics.mean(samples) * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def once(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def repeat(function, arguments):
+    samples = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+    return summary(samples)
+
+
+def bench_size(size, directory, seed=1, samples=DEFAULT_SAMPLES, log=print):
+    directory = os.path.join(directory, str(size))
+    os.makedirs(directory, exist_ok=True)
+    xml_file = os.path.join(directory, "patients.xml")
+    db_file = os.path.join(directory, "patients.sdb")
+    export_file = os.path.join(directory, "export.xml")
+    results = {}
+    rng = random.Random(seed)
+
+    if not os.path.exists(xml_file):
+        log("gerando {0} pacientes em {1}".format(size, xml_file))
+        write_xml(xml_file, size, seed)
+    for name in (db_file, db_file + "-journal", db_file + "-wal", db_file + "-shm"):
+        if os.path.exists(name):
+            os.remove(name)
+
+    repo = PatientRepository(db_file)
+    try:
+        elapsed, count = once(repo.import_file, xml_file)
+        results["import_xml"] = {"seconds": elapsed, "rows_per_second": count / elapsed}
+        log("  import_xml       {0:9.2f} s".format(elapsed))
+
+        elapsed, count = once(repo.export_file, export_file)
+        results["export_xml"] = {"seconds": elapsed, "rows_per_second": count / elapsed}
+        log("  export_xml       {0:9.2f} s".format(elapsed))
+
+        # O mesmo arquivo pelo exportador anterior, para comparar os dois na
+        # mesma máquina e com os mesmos dados
+        baseline_file = os.path.join(directory, "export-baseline.xml")
+        elapsed, count = once(baseline_export_xml, repo.db, baseline_file)
+        results["export_xml_baseline"] = {"seconds": elapsed, "rows_per_second": count / elapsed,
+                                          "same_output": filecmp.cmp(export_file, baseline_file, shallow=False)}
+        log("  export_baseline  {0:9.2f} s ({1:.1f}x o atual{2})".format(
+            elapsed, elapsed / results["export_xml"]["seconds"],
+            "" if results["export_xml_baseline"]["same_output"] else ", ARQUIVO DIFERENTE"))
+        os.remove(baseline_file)
+
+        # Os outros formatos: exporta e reimporta o mesmo conteúdo num banco à
+        # parte, para não mudar os ids usados nas medidas abaixo
+        copy = PatientRepository(os.path.join(directory, "formats.sdb"))
+        try:
+            for extension in ("csv", "jsonl"):
+                data_file = os.path.join(directory, "export." + extension)
+                for operation, function in (("export", repo.export_file), ("import", copy.import_file)):
+                    name = "{0}_{1}".format(operation, extension)
+                    elapsed, count = once(function, data_file)
+                    results[name] = {"seconds": elapsed, "rows_per_second": count / elapsed}
+                    log("  {0:16} {1:9.2f} s".format(name, elapsed))
+        finally:
+            copy.close()
+
+        elapsed, ignore = once(repo.load_indexes)
+        results["load_indexes"] = {"seconds": elapsed}
+        log("  load_indexes     {0:9.2f} s".format(elapsed))
+
+        prefixes = []
+        for i in range(samples):
+            nome = rng.choice(FIRST_NAMES)
+            if i % 2:
+                nome += " " + rng.choice(SURNAMES)[:rng.randint(1, 4)]
+            prefixes.append((nome.lower(),))
+        results["abrir_search"] = repeat(repo.search, prefixes)
+
+        identities = [(rng.randint(1, count),) for i in range(samples)]
+        results["abrir_id_get"] = repeat(repo.get, identities)
+        # Recepção alternando entre poucos pacientes: servidos pelo cache
+        results["abrir_id_cached"] = repeat(repo.get, [identities[i % 10] for i in range(samples)])
+
+        new = list(generate_patients(samples, seed + 1))
+        results["salvar_insert"] = repeat(repo.save, [(patient,) for patient in new])
+
+        updates = []
+        for patient in repo.get_many(identity for (identity,) in identities).values():
+            patient.endereco = "Rua Atualizada, {0}".format(rng.randint(1, 999))
+            updates.append((patient,))
+        results["salvar_update"] = repeat(repo.save, updates)
+
+        # Atualização das comboboxes depois de uma gravação que muda o nome
+        def refresh(patient):
+            patient.nome += " Jr"
+            repo.save(patient)
+            repo.list_pac()
+            repo.list_id()
+            repo.list_planos()
+        results["list_refresh"] = repeat(refresh, updates)
+
+        for name in ("abrir_search", "abrir_id_get", "abrir_id_cached", "salvar_insert", "salvar_update",
+                     "list_refresh"):
+            log("  {0:16} {1:9.3f} ms (p95 {2:.3f} ms)".format(name, results[name]["median_ms"],
+                                                              results[name]["p95_ms"]))
+    finally:
+        repo.close()
+    return results
+
+
+def stress_writer(db_file, seconds, seed):
+    # Lê um paciente disputado, espera um pouco como um usuário editando e
+    # grava; devolve quantas gravações passaram, quantas deram conflito e
+    # quantas falharam com o banco ocupado
+    rng = random.Random(seed)
+    counts = {"saves": 0, "conflicts": 0, "busy": 0}
+    repo = PatientRepository(db_file)
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            patient = repo.get(rng.randint(1, STRESS_HOT))
+            time.sleep(rng.random() * 0.002)
+            patient.endereco = "Rua Concorrente, {0}".format(rng.randint(1, 9999))
+            try:
+                repo.save(patient)
+                counts["saves"] += 1
+            except ConflictError:
+                counts["conflicts"] += 1
+            except sqlite3.OperationalError:
+                counts["busy"] += 1
+    finally:
+        repo.close()
+    return counts
+
+
+def stress_reader(db_file, seconds, seed):
+    # Consultas enquanto os outros processos gravam; devolve as durações
+    rng = random.Random(seed)
+    samples = []
+    repo = PatientRepository(db_file)
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            repo.search(rng.choice(FIRST_NAMES))
+            repo.browse("cidade")
+            samples.append(time.perf_counter() - start)
+    finally:
+        repo.close()
+    return samples
+
+
+def stress(directory, processes, seconds, seed=1, log=print):
+    # Vários processos gravando os mesmos pacientes e um lendo. Cada gravação
+    # aceita soma exatamente 1 à versão do paciente, então a soma das versões
+    # precisa crescer o mesmo tanto que o total de gravações aceitas; se uma
+    # sobrescrevesse a outra sem detectar o conflito a conta não fecharia.
+    os.makedirs(directory, exist_ok=True)
+    db_file = os.path.join(directory, "stress.sdb")
+    for name in (db_file, db_file + "-journal", db_file + "-wal", db_file + "-shm"):
+        if os.path.exists(name):
+            os.remove(name)
+    repo = PatientRepository(db_file)
+    try:
+        repo.upsert_many(generate_patients(STRESS_ROWS, seed))
+        before = repo.db.execute("SELECT SUM(versao) FROM pacientes").fetchone()[0]
+    finally:
+        repo.close()
+
+    log("{0} processos gravando por {1} s".format(processes, seconds))
+    with multiprocessing.Pool(processes + 1) as pool:
+        reader = pool.apply_async(stress_reader, (db_file, seconds, seed))
+        writers = [pool.apply_async(stress_writer, (db_file, seconds, seed + number))
+                   for number in range(1, processes + 1)]
+        results = [writer.get() for writer in writers]
+        reads = reader.get()
+
+    repo = PatientRepository(db_file)
+    try:
+        after = repo.db.execute("SELECT SUM(versao) FROM pacientes").fetchone()[0]
+    finally:
+        repo.close()
+    totals = {name: sum(result[name] for result in results) for name in ("saves", "conflicts", "busy")}
+    totals["lost_updates"] = totals["saves"] - (after - before)
+    totals["reads"] = summary(reads)
+    log("  gravações {saves}, conflitos {conflicts}, banco ocupado {busy}, "
+        "gravações perdidas {lost_updates}".format(**totals))
+    log("  leitura durante gravações {0:.3f} ms (p95 {1:.3f} ms, máx {2:.3f} ms)".format(
+        totals["reads"]["median_ms"], totals["reads"]["p95_ms"], totals["reads"]["max_ms"]))
+    return totals
+
+
+def http_client(url, seconds, seed):
+    # Uma estação fazendo buscas, aberturas e gravações sem pausa; devolve
+    # as durações por operação e quantas gravações deram conflito
+    import client
+    rng = random.Random(seed)
+    samples = {name: [] for name, share in HTTP_MIX}
+    conflicts = 0
+    repo = client.open_repository(url)
+    try:
+        identities = repo.ids_index().keys
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            name = rng.choices([name for name, share in HTTP_MIX], [share for name, share in HTTP_MIX])[0]
+            start = time.perf_counter()
+            if name == "search":
+                repo.search(rng.choice(FIRST_NAMES) + " " + rng.choice(SURNAMES)[:2])
+            elif name == "get":
+                repo.get(rng.choice(identities))
+            else:
+                patient = repo.get(rng.choice(identities[:STRESS_HOT]))
+                patient.endereco = "Rua Remota, {0}".format(rng.randint(1, 9999))
+                try:
+                    repo.save(patient)
+                except ConflictError:
+                    conflicts += 1
+            samples[name].append(time.perf_counter() - start)
+    finally:
+        repo.close()
+    return samples, conflicts
+
+
+def start_server(db_file, readers):
+    # cadastro.py serve numa porta livre; devolve o processo e a URL impressa
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             "cadastro.py"),
+                                "--db", db_file, "serve", "--port", "0", "--readers", str(readers)],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError('O servidor não iniciou')
+    return process, line.split()[3]
+
+
+def http_load(directory, clients, seconds, url=None, readers=4, seed=1, log=print):
+    # clients processos usando o servidor em url ou, sem url, num servidor
+    # iniciado aqui com um banco de STRESS_ROWS pacientes
+    process = None
+    if url is None:
+        os.makedirs(directory, exist_ok=True)
+        db_file = os.path.join(directory, "http.sdb")
+        for name in (db_file, db_file + "-journal", db_file + "-wal", db_file + "-shm"):
+            if os.path.exists(name):
+                os.remove(name)
+        repo = PatientRepository(db_file)
+        try:
+            repo.upsert_many(generate_patients(STRESS_ROWS, seed))
+        finally:
+            repo.close()
+        process, url = start_server(db_file, readers)
+    try:
+        log("{0} clientes em {1} por {2} s".format(clients, url, seconds))
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.starmap(http_client, [(url, seconds, seed + number) for number in range(clients)])
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    totals = {"clients": clients, "seconds": seconds, "conflicts": sum(conflicts for ignore, conflicts in results)}
+    count = 0
+    for name, share in HTTP_MIX:
+        samples = [sample for result, ignore in results for sample in result[name]]
+        count += len(samples)
+        if samples:
+            totals[name] = summary(samples)
+            log("  {0:8} {1:7} {2:9.3f} ms (p95 {3:.3f} ms)".format(name, len(samples), totals[name]["median_ms"],
+                                                                  totals[name]["p95_ms"]))
+    totals["ops_per_second"] = count / seconds
+    log("  {0:.0f} operações/s, {1} conflitos".format(totals["ops_per_second"], totals["conflicts"]))
+    return totals
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    # Lista de (tamanho, operação, antes, depois) que pioraram além do limite
+    regressions = []
+    for size, operations in report["sizes"].items():
+        for name, result in operations.items():
+            old = baseline.get("sizes", {}).get(size, {}).get(name)
+            if old is None:
+                continue
+            metric = "seconds" if "seconds" in result else "median_ms"
+            if result[metric] > old[metric] * (1 + threshold / 100.0):
+                regressions.append((size, name, old[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do cadastro de pacientes")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="quantidades de pacientes separadas por vírgula")
+    parser.add_argument("--dir", default="bench", help="diretório dos bancos e XML gerados")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument("--report", default=None, help="arquivo JSON do relatório (padrão: DIR/report.json)")
+    parser.add_argument("--baseline", default=None, help="relatório anterior para detectar regressões")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="percentual de piora considerado regressão")
+    parser.add_argument("--stress", type=int, default=0, metavar="PROCESSOS",
+                        help="em vez do benchmark, testa gravações concorrentes com PROCESSOS processos")
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos do teste de concorrência")
+    parser.add_argument("--http", type=int, default=0, metavar="CLIENTES",
+                        help="em vez do benchmark, mede latência e vazão do servidor com CLIENTES processos")
+    parser.add_argument("--url", default=None,
+                        help="servidor já em execução para --http (padrão: inicia um com um banco de teste)")
+    parser.add_argument("--readers", type=int, default=4, help="conexões de leitura do servidor iniciado por --http")
+    args = parser.parse_args(argv)
+
+    if args.stress:
+        totals = stress(args.dir, args.stress, args.duration, args.seed)
+        return 1 if totals["busy"] or totals["lost_updates"] else 0
+    if args.http:
+        http_load(args.dir, args.http, args.duration, args.url, args.readers, args.seed)
+        return 0
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "sizes": {},
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        print("{0} pacientes".format(size))
+        report["sizes"][str(size)] = bench_size(size, args.dir, args.seed, args.samples)
+
+    filename = args.report or os.path.join(args.dir, "report.json")
+    with open(filename, "w", encoding="UTF-8") as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+    print("relatório gravado em {0}".format(filename))
+
+    if args.baseline:
+        with open(args.baseline, encoding="UTF-8") as fh:
+            baseline = json.load(fh)
+        regressions = compare(report, baseline, args.threshold)
+        for size, name, old, new in regressions:
+            print("REGRESSÃO {0} {1}: {2:.3f} -> {3:.3f}".format(size, name, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
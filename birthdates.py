@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import calendar
+import datetime
+
+from search import normalize_name
+
+MONTHS = ('Janeiro', 'Fevereiro', 'Março', 'Abril', 'Maio', 'Junho',
+          'Julho', 'Agosto', 'Setembro', 'Outubro', 'Novembro', 'Dezembro')
+
+# Número do mês pelo nome normalizado (sem acento, minúsculo) ou pelo número
+MONTH_NUMBERS = {normalize_name(name): number for number, name in enumerate(MONTHS, 1)}
+MONTH_NUMBERS.update((str(number), number) for number in range(1, 13))
+MONTH_NUMBERS.update(("{0:02d}".format(number), number) for number in range(1, 10))
+
+
+def month_number(mes):
+    if mes is None:
+        return None
+    number = MONTH_NUMBERS.get(mes)
+    if number is None:
+        number = MONTH_NUMBERS.get(normalize_name(mes))
+    return number
+
+
+def iso_date(dia, mes, ano):
+    # Data de nascimento 'AAAA-MM-DD' a partir dos três campos do cadastro,
+    # ou None se não formarem uma data válida
+    month = month_number(mes)
+    if month is None or not dia or not ano:
+        return None
+    dia = dia.strip()
+    ano = ano.strip()
+    if not dia.isdigit() or not ano.isdigit() or len(ano) != 4:
+        return None
+    try:
+        return datetime.date(int(ano), month, int(dia)).isoformat()
+    except ValueError:
+        return None
+
+
+def age(nascimento, today=None):
+    # Anos completos em today de quem nasceu em nascimento ('AAAA-MM-DD')
+    today = today or datetime.date.today()
+    born = datetime.date.fromisoformat(nascimento)
+    return today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+
+
+def years_ago(today, years):
+    # 29 de fevereiro vira 28 nos anos que não são bissextos
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        return today.replace(year=today.year - years, day=28)
+
+
+def age_bounds(min_age, max_age, today=None):
+    # (depois de, até) para "nascimento > ? AND nascimento <= ?": quem tem
+    # entre min_age e max_age anos completos em today
+    today = today or datetime.date.today()
+    return years_ago(today, max_age + 1).isoformat(), years_ago(today, min_age).isoformat()
+
+
+def day_key(day):
+    # 'MM-DD' de um dia como fim de faixa: nos anos que não são bissextos o
+    # 28 de fevereiro também é o aniversário de quem nasceu em 29
+    if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+        return "02-29"
+    return day.strftime("%m-%d")
+
+
+def birthday_ranges(days, today=None):
+    # Faixas ('MM-DD', 'MM-DD') dos aniversários de today até days dias
+    # depois, na ordem em que acontecem; duas quando passam da virada do ano
+    today = today or datetime.date.today()
+    if days < 1:
+        return []
+    if days >= 365:
+        # O ano todo, a partir de hoje
+        last = today - datetime.timedelta(days=1)
+    else:
+        last = today + datetime.timedelta(days=days - 1)
+    if today.strftime("%m-%d") == "01-01" and days >= 365:
+        return [("01-01", "12-31")]
+    if last.year == today.year and last >= today:
+        return [(today.strftime("%m-%d"), day_key(last))]
+    return [(today.strftime("%m-%d"), "12-31"), ("01-01", day_key(last))]
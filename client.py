@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import sqlite3
+import http.client
+import urllib.parse
+
+import xmlio
+import schema
+import search
+import archive
+import duplicates
+from indexes import SortedIndex
+from repository import ConflictError, PatientRepository
+from server import COPY_CHUNK, patient_to_json, patient_from_json
+
+
+# Segundos de espera pela resposta de importação e exportação: o servidor só
+# responde no fim do trabalho, que leva minutos com milhões de pacientes
+TRANSFER_TIMEOUT = 3600.0
+
+
+def is_remote(target):
+    return target.startswith(("http://", "https://"))
+
+
+def open_repository(target, timeout=None, stats=None):
+    # PatientRepository para um arquivo, RemoteRepository para a URL de um
+    # servidor (server.py). timeout é a espera quando outra estação está
+    # gravando; com um servidor, a resposta pode levar essa espera (feita lá)
+    # mais a própria operação, e o limite da requisição é o dobro dela.
+    if is_remote(target):
+        return RemoteRepository(target, None if timeout is None else timeout * 2, stats)
+    return PatientRepository(target, schema.BUSY_TIMEOUT if timeout is None else timeout, stats)
+
+
+class RemotePlanos:
+    # O que a interface usa de PlanoCache: o índice dos nomes
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._index = SortedIndex()
+        self.loaded = False
+
+    @property
+    def index(self):
+        if not self.loaded:
+            self.reload()
+        return self._index
+
+    def reload(self):
+        names = self.repo.request("GET", "/planos")
+        if names != list(self._index):
+            self._index.reset(names)
+        self.loaded = True
+
+    def names(self):
+        return self.index.values()
+
+
+class RemoteRepository:
+    # Os métodos de PatientRepository usados pela interface e pelas tarefas,
+    # atendidos por um servidor. A conexão HTTP é mantida entre as
+    # requisições; cada thread precisa do seu próprio RemoteRepository,
+    # como acontece com as conexões SQLite.
+
+    cache = None
+
+    def __init__(self, url, timeout=None, stats=None):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError('Endereço do servidor inválido: {0}'.format(url))
+        self.filename = url
+        self.archive_file = url.rstrip("/") + "/arquivo"
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = schema.BUSY_TIMEOUT * 2 if timeout is None else timeout
+        self.stats = stats
+        self.connection = None
+        self.planos = RemotePlanos(self)
+        self.nomes = SortedIndex(value=lambda key: key[0])
+        self.registros = SortedIndex()
+        self.indexes_version = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    # HTTP
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self.connection
+
+    def _send(self, method, path, body, headers, timeout):
+        # Uma nova tentativa quando o servidor fechou a conexão mantida
+        # (reiniciado, por exemplo); só para o que pode ser repetido sem efeito
+        # duplicado, ou seja, tudo menos POST
+        for attempt in (0, 1):
+            connection = self._connect()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                return connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt or method == "POST":
+                    raise
+
+    def _response(self, method, route, path, body=None, headers=None, output=None, timeout=None):
+        start = time.perf_counter()
+        try:
+            response = self._send(method, path, body, headers or {}, self.timeout if timeout is None else timeout)
+            if response.status == 200 and output is not None:
+                while True:
+                    data = response.read(COPY_CHUNK)
+                    if not data:
+                        break
+                    output.write(data)
+                result = None
+            else:
+                result = json.loads(response.read() or b"null")
+            if response.getheader("Connection", "").lower() == "close":
+                self.close()
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            if self.stats is not None:
+                self.stats.record("rede", route, time.perf_counter() - start)
+        if response.status == 200:
+            return result
+        message = result.get("erro", response.reason) if isinstance(result, dict) else response.reason
+        if response.status == 404:
+            raise LookupError(message)
+        if response.status == 409:
+            raise ConflictError(message)
+        if response.status == 503:
+            raise sqlite3.OperationalError(message)
+        if response.status == 400:
+            raise ValueError(message)
+        raise EnvironmentError('Servidor: {0} {1}'.format(response.status, message))
+
+    def request(self, method, path, query=None, data=None, route=None):
+        if query:
+            path += "?" + urllib.parse.urlencode({name: value for name, value in query.items() if value is not None})
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data).encode("UTF-8")
+            headers["Content-Type"] = "application/json"
+        return self._response(method, route or "{0} {1}".format(method, path.split("?")[0]), path, body, headers)
+
+    # Índices das comboboxes: o servidor só devolve as listas quando mudaram
+    # desde a versão que já temos
+
+    def load_indexes(self):
+        data = self.request("GET", "/indices", {"versao": self.indexes_version})
+        if "nomes" in data:
+            self.nomes.reset(tuple(record) for record in data["nomes"])
+            self.registros.reset(data["registros"])
+        self.indexes_version = data["versao"]
+
+    def names_index(self):
+        self.load_indexes()
+        return self.nomes
+
+    def ids_index(self):
+        self.load_indexes()
+        return self.registros
+
+    def list_pac(self):
+        return self.names_index().values()
+
+    def list_id(self):
+        return self.ids_index().values()
+
+    def list_planos(self):
+        return self.planos.names()
+
+    # Consultas
+
+    def get(self, identity, restore=False):
+        try:
+            data = self.request("GET", "/pacientes/{0}".format(identity), {"restaurar": 1 if restore else None},
+                                route="GET /pacientes/{id}")
+        except LookupError:
+            return None
+        return patient_from_json(data)
+
+    def browse(self, sort="nome", after=None, limit=100, descending=False):
+        rows = self.request("GET", "/navegar", {"ordem": sort, "depois": None if after is None else json.dumps(after),
+                                                "limite": limit, "desc": 1 if descending else None})
+        return [tuple(row) for row in rows]
+
+    def find_id(self, nome, telefone):
+        return self.request("GET", "/pacientes", {"nome": nome, "telefone": telefone or ""})["id"]
+
+    def find_by_name(self, nome):
+        return [tuple(row) for row in self.request("GET", "/pacientes", {"nome": nome})]
+
+    def search_archive(self, text, limit=search.TYPEAHEAD_LIMIT):
+        return [tuple(row) for row in self.request("GET", "/arquivo", {"busca": text, "limite": limit})]
+
+    def find_archived_by_name(self, nome):
+        return [tuple(row) for row in self.request("GET", "/arquivo", {"nome": nome})]
+
+    def search(self, text, limit=search.TYPEAHEAD_LIMIT, offset=0):
+        return [tuple(row) for row in self.request("GET", "/pacientes", {"busca": text, "limite": limit,
+                                                                         "deslocamento": offset})]
+
+    def duplicate_pairs(self, threshold=duplicates.THRESHOLD, progress=None):
+        return [tuple(row) for row in self.request("GET", "/duplicados", {"nota": threshold})]
+
+    # Alterações
+
+    def save(self, patient):
+        data = patient_to_json(patient)
+        if patient.id is None:
+            result = self.request("POST", "/pacientes", data=data)
+        else:
+            result = self.request("PUT", "/pacientes/{0}".format(patient.id), data=data,
+                                  route="PUT /pacientes/{id}")
+        patient.id, patient.versao = result["id"], result["versao"]
+        return patient.id
+
+    def delete(self, identity):
+        return self.request("DELETE", "/pacientes/{0}".format(identity), route="DELETE /pacientes/{id}")["removido"]
+
+    def mark_distinct(self, first, second):
+        self.request("POST", "/duplicados/distintos", data={"a": first, "b": second})
+
+    def merge_patients(self, keep, drop):
+        if keep.id is None or drop.id is None or keep.id == drop.id:
+            raise ValueError('Escolha dois pacientes diferentes já gravados')
+        data = self.request("POST", "/duplicados/mesclar", data={"manter": keep.id, "remover": drop.id,
+                                                                  "versao_manter": keep.versao,
+                                                                  "versao_remover": drop.versao})
+        return patient_from_json(data)
+
+    def archive_inactive(self, days=archive.ARCHIVE_DAYS):
+        return self.request("POST", "/arquivo", data={"dias": days})["arquivados"]
+
+    def restore(self, identity):
+        return self.get(identity, restore=True)
+
+    # Importação e exportação
+
+    def reload(self):
+        self.planos.loaded = False
+        self.indexes_version = None
+
+    def _upload(self, filename, merge, progress, workers, rejects):
+        # O arquivo vai no corpo da requisição, em partes; o progresso é o
+        # do envio, e a espera pelo servidor aparece como 100%. Os recusados
+        # vêm na resposta e são gravados aqui, em rejects. Uma importação
+        # interrompida começa de novo: o servidor recebe outro arquivo.
+        if not isinstance(filename, str):
+            if len(filename) != 1:
+                raise ValueError('O servidor importa um arquivo por vez')
+            filename = filename[0]
+        if rejects is None:
+            rejects = xmlio.Rejects(xmlio.rejects_name(filename))
+        size = os.path.getsize(filename)
+
+        def body():
+            sent = 0
+            with open(filename, "rb") as fh:
+                while True:
+                    data = fh.read(COPY_CHUNK)
+                    if not data:
+                        break
+                    sent += len(data)
+                    if progress is not None:
+                        progress(0, sent / size if size else 1.0)
+                    yield data
+
+        query = {"nome": os.path.basename(filename), "processos": workers}
+        if merge:
+            query["mesclar"] = 1
+        result = self._response("POST", "POST /importar", "/importar?" + urllib.parse.urlencode(query), body(),
+                                {"Content-Length": str(size)}, timeout=TRANSFER_TIMEOUT)
+        self.reload()
+        rejects.write(result.pop("recusados"))
+        return result
+
+    def pending_import(self, filename):
+        return None
+
+    def import_file(self, filename, progress=None, workers=1, rejects=None):
+        return self._upload(filename, False, progress, workers, rejects)["pacientes"]
+
+    def merge_file(self, filename, progress=None, workers=1, rejects=None):
+        return self._upload(filename, True, progress, workers, rejects)
+
+    def export_file(self, filename, progress=None, file_rows=None):
+        # O servidor grava a exportação e a envia; o total de pacientes não
+        # vem junto, então devolve None
+        if file_rows:
+            raise ValueError('A exportação dividida não é feita pelo servidor')
+        try:
+            with open(filename, "wb") as fh:
+                self._response("GET", "GET /exportar", "/exportar?" + urllib.parse.urlencode(
+                    {"nome": os.path.basename(filename)}), output=fh, timeout=TRANSFER_TIMEOUT)
+        except BaseException:
+            os.remove(filename)
+            raise
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import re
+
+from birthdates import MONTHS
+
+# Codificação compacta de alguns campos, gravada no banco e desfeita nas
+# consultas (decoded), de modo que a interface, a exportação e o servidor
+# veem sempre o texto: sexo e mês viram '1', '2'..., telefones e CEP só os
+# dígitos. Valores fora do padrão (outro texto, outra quantidade de
+# dígitos) ficam como estão. Telefone e CEP voltam sempre com a mesma
+# máscara, qualquer que tenha sido a pontuação digitada.
+
+SEXOS = ("Masculino", "Feminino")
+
+# Posições dos campos compactados em xmlio.FIELDS
+SEXO, MES_NASC, CEP, TELEFONE, CELULAR = 1, 4, 9, 10, 11
+
+# Texto de telefone e CEP que pode ser reduzido aos dígitos: só dígitos e pontuação
+PHONE_TEXT = re.compile(r"[\d\s().+/-]+")
+CEP_TEXT = re.compile(r"[\d\s.-]+")
+NOT_DIGITS = re.compile(r"\D")
+
+# Quantidade de dígitos de um telefone que tem máscara: sem e com DDD, com e sem o 9
+PHONE_SIZES = (8, 9, 10, 11)
+
+SEXO_CODES = {name: str(code) for code, name in enumerate(SEXOS, 1)}
+MONTH_CODES = {name: str(code) for code, name in enumerate(MONTHS, 1)}
+
+
+def encode_code(value, codes):
+    # Um código (já gravado, ou o número do mês) fica como está
+    return codes.get(value, value)
+
+
+def encode_digits(value, text, sizes, zero=True):
+    # zero: se os dígitos podem começar com 0. Um CEP pode; um telefone que
+    # começa com 0 (0800, o 0 da operadora antes do DDD) não tem a máscara
+    # e fica como foi digitado.
+    if not value or text.fullmatch(value) is None:
+        return value
+    digits = NOT_DIGITS.sub("", value)
+    if len(digits) not in sizes or (not zero and digits.startswith("0")):
+        return value
+    return digits
+
+
+def encode(record):
+    # record na ordem de xmlio.FIELDS
+    record = list(record)
+    record[SEXO] = encode_code(record[SEXO], SEXO_CODES)
+    record[MES_NASC] = encode_code(record[MES_NASC], MONTH_CODES)
+    record[CEP] = encode_digits(record[CEP], CEP_TEXT, (8,))
+    record[TELEFONE] = encode_digits(record[TELEFONE], PHONE_TEXT, PHONE_SIZES, zero=False)
+    record[CELULAR] = encode_digits(record[CELULAR], PHONE_TEXT, PHONE_SIZES, zero=False)
+    return tuple(record)
+
+
+def encode_phone(value):
+    # Para comparar com a coluna telefone (find_id)
+    return encode_digits(value, PHONE_TEXT, PHONE_SIZES, zero=False)
+
+
+def _names(column, names):
+    return "CASE {0} {1} ELSE {0} END".format(column, " ".join(
+        "WHEN '{0}' THEN '{1}'".format(code, name) for code, name in enumerate(names, 1)))
+
+
+def _mask(column, sizes, zero=True):
+    # sizes: quantidade de dígitos -> [(tamanho do trecho, texto antes dele)];
+    # sem zero, os dígitos que começam com 0 (gravados antes de encode_digits
+    # deixar esses telefones como foram digitados) voltam sem máscara
+    cases = []
+    for size, parts in sizes:
+        start = 1
+        pieces = []
+        for length, prefix in parts:
+            if prefix:
+                pieces.append("'{0}'".format(prefix))
+            pieces.append("substr({0}, {1}, {2})".format(column, start, length))
+            start += length
+        cases.append("WHEN {0} THEN {1}".format(size, " || ".join(pieces)))
+    return "CASE WHEN {0} GLOB '*[^0-9]*'{2} THEN {0} ELSE CASE length({0}) {1} ELSE {0} END END".format(
+        column, " ".join(cases), "" if zero else " OR {0} GLOB '0*'".format(column))
+
+
+PHONE_MASKS = ((8, ((4, ""), (4, "-"))),
+               (9, ((5, ""), (4, "-"))),
+               (10, ((2, "("), (4, ") "), (4, "-"))),
+               (11, ((2, "("), (5, ") "), (4, "-"))))
+CEP_MASKS = ((8, ((5, ""), (3, "-"))),)
+
+
+def decoded(field, table="pacientes"):
+    # Expressão SQL com o valor de field como foi digitado (a máscara, no
+    # caso de telefone e CEP)
+    column = "{0}.{1}".format(table, field)
+    if field == "sexo":
+        return _names(column, SEXOS)
+    if field == "mes_nasc":
+        return _names(column, MONTHS)
+    if field == "cep":
+        return _mask(column, CEP_MASKS)
+    if field in ("telefone", "celular"):
+        return _mask(column, PHONE_MASKS, zero=False)
+    return column
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import re
+
+# Pares com nota abaixo disso não aparecem na lista de revisão
+THRESHOLD = 0.7
+
+# Vizinhança ordenada: cada paciente só é comparado com os próximos WINDOW
+# da mesma chave de bloco, para que blocos grandes (nomes muito comuns) não
+# gerem pares demais
+WINDOW = 8
+
+# Pesos da nota; a semelhança do nome sozinha não passa do limite. Datas de
+# nascimento ou cartões diferentes são indício de pessoas diferentes.
+NAME_WEIGHT = 0.6
+PHONE_WEIGHT = 0.2
+BIRTH_WEIGHT, BIRTH_MISMATCH = 0.2, 0.3
+CARD_WEIGHT, CARD_MISMATCH = 0.2, 0.1
+CEP_WEIGHT = 0.05
+
+STOPWORDS = frozenset(("da", "de", "do", "das", "dos", "e"))
+
+WORDS = re.compile(r"\w+")
+NOT_DIGITS = re.compile(r"\D")
+
+# Código fonético simplificado para o português: aplicado em ordem a um
+# token já normalizado (sem acento, minúsculo)
+PHONETIC_RULES = tuple((re.compile(pattern), replacement) for pattern, replacement in (
+    (r"ph", "f"), (r"th", "t"), (r"y", "i"), (r"w", "v"), (r"h(?=[aeiou])", ""),
+    (r"lh", "li"), (r"nh", "ni"), (r"ch|sh|x", "x"), (r"qu|q", "k"), (r"gu(?=[ei])", "g"),
+    (r"c(?=[ei])", "s"), (r"c", "k"), (r"g(?=[ei])", "j"), (r"z|ss|ç", "s"), (r"h", ""),
+    (r"n$", "m"), (r"(?<=.)[aeiou]+", ""), (r"(.)\1+", r"\1"),
+))
+
+
+# Códigos já calculados; os mesmos nomes se repetem muito
+CODES = {}
+
+
+def phonetic(token):
+    code = CODES.get(token)
+    if code is None:
+        code = token
+        for pattern, replacement in PHONETIC_RULES:
+            code = pattern.sub(replacement, code)
+        if len(CODES) < 100000:
+            CODES[token] = code
+    return code
+
+
+def name_tokens(nome_busca):
+    # "jose da silva" -> ["jose", "silva"]; nome_busca já vem normalizado
+    return [token for token in WORDS.findall(nome_busca.replace("'", "")) if token not in STOPWORDS]
+
+
+def digits(value, size=8):
+    # Só os últimos dígitos, para ignorar DDD, máscaras e o 9 extra do celular
+    if not value:
+        return None
+    value = NOT_DIGITS.sub("", value)
+    return value[-size:] if len(value) >= size else None
+
+
+class Features:
+    # O que é usado para comparar um paciente, calculado uma vez
+
+    __slots__ = ("id", "tokens", "codes", "code_set", "telefones", "nascimento", "cartao", "cep")
+
+    def __init__(self, identity, nome_busca, telefone, celular, cep, nascimento, cartao):
+        self.id = identity
+        self.tokens = name_tokens(nome_busca or "")
+        self.codes = [phonetic(token) for token in self.tokens]
+        self.code_set = frozenset(self.codes)
+        self.telefones = {phone for phone in (digits(telefone), digits(celular)) if phone}
+        self.nascimento = nascimento
+        self.cartao = NOT_DIGITS.sub("", cartao) if cartao else None
+        self.cep = digits(cep, 8)
+
+    def blocking_keys(self):
+        # (tipo, chave, ordem) de cada bloco onde o paciente entra
+        if not self.codes:
+            return
+        name = " ".join(self.codes)
+        yield "nome", self.codes[0] + " " + self.codes[-1], name
+        for phone in self.telefones:
+            yield "telefone", phone, name
+        if self.nascimento:
+            yield "nascimento", self.nascimento + " " + self.codes[0], name
+        if self.cep:
+            yield "cep", self.cep + " " + self.codes[0], name
+
+
+def name_similarity(a, b):
+    # Dice entre os conjuntos de códigos fonéticos, para que grafias
+    # diferentes (Luiz/Luis, Souza/Sousa) contem como iguais
+    if not a.code_set or not b.code_set:
+        return 0.0
+    return 2.0 * len(a.code_set & b.code_set) / (len(a.code_set) + len(b.code_set))
+
+
+def score(a, b):
+    # Nota entre 0 e 1; chamada para cada par candidato, por isso sem laços
+    # e com a semelhança do nome calculada aqui mesmo
+    size = len(a.code_set) + len(b.code_set)
+    total = NAME_WEIGHT * 2.0 * len(a.code_set & b.code_set) / size if size else 0.0
+    if a.telefones & b.telefones:
+        total += PHONE_WEIGHT
+    if a.nascimento and b.nascimento:
+        total += BIRTH_WEIGHT if a.nascimento == b.nascimento else -BIRTH_MISMATCH
+    if a.cartao and b.cartao:
+        total += CARD_WEIGHT if a.cartao == b.cartao else -CARD_MISMATCH
+    if a.cep and a.cep == b.cep:
+        total += CEP_WEIGHT
+    return total
+
+
+def reasons(a, b):
+    # Texto para a lista de revisão explicando a nota de score
+    result = ["nome {0:.0%}".format(name_similarity(a, b))]
+    if a.telefones & b.telefones:
+        result.append("telefone")
+    for field in ("nascimento", "cartao", "cep"):
+        first, second = getattr(a, field), getattr(b, field)
+        if first and second:
+            result.append(field if first == second else field + " diferente")
+    return ", ".join(result)
+
+
+def candidate_pairs(patients, window=WINDOW):
+    # Ordena as chaves de cada tipo de bloco (O(n log n)) e compara cada
+    # paciente com os próximos window da mesma chave. Devolve um conjunto de
+    # pares (índice menor, índice maior) em patients.
+    pairs = set()
+    kinds = {}
+    for index, features in enumerate(patients):
+        for kind, key, order in features.blocking_keys():
+            kinds.setdefault(kind, []).append((key, order, index))
+    for kind, entries in kinds.items():
+        entries.sort()
+        for position, (key, order, index) in enumerate(entries):
+            for other_key, other_order, other in entries[position + 1:position + 1 + window]:
+                if other_key != key:
+                    break
+                pairs.add((index, other) if index < other else (other, index))
+        kinds[kind] = None
+    return pairs
+
+
+def find_duplicates(db, threshold=THRESHOLD, window=WINDOW, ignored=(), progress=None):
+    # Lista de (nota, id, id, motivos) dos prováveis duplicados, da maior nota
+    # para a menor. ignored: pares (menor id, maior id) já marcados como
+    # pessoas diferentes.
+    cursor = db.cursor()
+    cursor.execute("SELECT id, nome_busca, telefone, celular, cep, nascimento, cartao FROM pacientes")
+    patients = [Features(*row) for row in cursor.fetchall()]
+    if progress is not None:
+        progress(len(patients), 0.25)
+    pairs = candidate_pairs(patients, window)
+    if progress is not None:
+        progress(len(patients), 0.5)
+    ignored = set(ignored)
+    results = []
+    for number, (first, second) in enumerate(pairs, 1):
+        a, b = patients[first], patients[second]
+        if a.id > b.id:
+            a, b = b, a
+        if (a.id, b.id) in ignored:
+            continue
+        total = score(a, b)
+        if total >= threshold:
+            results.append((round(min(1.0, total), 3), a.id, b.id, reasons(a, b)))
+        if progress is not None and number % 100000 == 0:
+            progress(len(patients), 0.5 + 0.5 * number / len(pairs))
+    results.sort(key=lambda result: (-result[0], result[1], result[2]))
+    return results
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import csv
+import json
+import json.encoder
+
+from xmlio import FIELDS, ATTRIBUTES, Reject, XmlFormat
+
+# Colunas gravadas, na ordem de xmlio.SELECT_EXPORT; na leitura a ordem vem
+# do cabeçalho, e uma coluna registro opcional é usada pela importação incremental
+COLUMNS = ("nome",) + ATTRIBUTES
+
+# Campos obrigatórios no banco, além do nome e do plano: no CSV, vazio é
+# texto vazio (como telefone="" no XML), e só a coluna ausente é None
+REQUIRED = ("telefone",)
+
+# Uma linha JSON montada direto, sem passar por um dicionário; cada valor já
+# vem codificado por encode_basestring (ou null)
+JSON_TEMPLATE = "{{" + ", ".join('"{0}": {{{1}}}'.format(column, i) for i, column in enumerate(COLUMNS)) + "}}\n"
+
+
+def _text(value):
+    # No JSON um número (cartão, CEP) pode vir sem aspas
+    if value is None or value.__class__ is str:
+        return value
+    return str(value)
+
+
+class CsvFormat:
+    # Uma linha de cabeçalho com os nomes das colunas e um paciente por linha.
+    # O CSV não distingue campo vazio de ausente: os dois são lidos como None,
+    # menos nos obrigatórios (REQUIRED e o plano), em que vazio continua vazio
+    # para que uma exportação seja importada de volta igual. Uma linha com
+    # outra quantidade de colunas é recusada (Reject), e a importação continua.
+    name = "csv"
+    extension = ".csv"
+    header = (",".join(COLUMNS) + "\n").encode("UTF-8")
+    footer = b""
+
+    @staticmethod
+    def lines(records):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(records)
+        return buffer.getvalue()
+
+    @staticmethod
+    def read(source):
+        # utf-8-sig aceita também o BOM que planilhas gravam no início
+        reader = csv.reader(io.TextIOWrapper(source, encoding="utf-8-sig", newline=""))
+        try:
+            header = next(reader, None)
+            if header is None:
+                return
+            header = [column.strip() for column in header]
+            for column in ("nome", "plano"):
+                if column not in header:
+                    raise ValueError('Arquivo CSV sem a coluna {0}'.format(column))
+            # Colunas ausentes do cabeçalho leem a posição extra, sempre vazia
+            width = len(header)
+            positions = [header.index(field) if field in header else width for field in FIELDS]
+            optional = [field not in REQUIRED or field not in header for field in FIELDS[1:]]
+            fields = list(zip(positions[1:], optional))
+            plano = header.index("plano")
+            registro = header.index("registro") if "registro" in header else width
+            for row in reader:
+                if len(row) != width:
+                    if not row:
+                        continue
+                    yield Reject('linha {0} com {1} colunas em vez de {2}'.format(reader.line_num, len(row), width),
+                                 row)
+                    continue
+                row.append("")
+                record = (row[positions[0]].strip(),) + tuple([(row[i] or None) if optional else row[i]
+                                                               for i, optional in fields])
+                yield record, row[plano], row[registro] or None
+        except csv.Error as err:
+            raise ValueError('Arquivo CSV inválido na linha {0}: {1}'.format(reader.line_num, err))
+
+
+class JsonLinesFormat:
+    # Um objeto JSON por linha, com as chaves de COLUMNS; null ou chave ausente
+    # é um campo sem valor, como um atributo ausente no XML. Uma linha que não
+    # é um objeto JSON é recusada (Reject), e a importação continua.
+    name = "jsonl"
+    extension = ".jsonl"
+    header = b""
+    footer = b""
+
+    @staticmethod
+    def lines(records):
+        encode = json.encoder.encode_basestring
+        return "".join(JSON_TEMPLATE.format(*["null" if value is None else encode(value) for value in record])
+                       for record in records)
+
+    @staticmethod
+    def read(source):
+        loads = json.loads
+        for number, line in enumerate(io.TextIOWrapper(source, encoding="UTF-8"), 1):
+            try:
+                values = loads(line)
+            except ValueError as err:
+                if not line.strip():
+                    continue
+                yield Reject('linha {0} inválida: {1}'.format(number, err), (line.strip(),))
+                continue
+            if not isinstance(values, dict):
+                yield Reject('linha {0} não é um objeto'.format(number), (line.strip(),))
+                continue
+            nome = values.get("nome")
+            record = (nome.strip() if isinstance(nome, str) else None,) + \
+                tuple([_text(values.get(field)) for field in FIELDS[1:]])
+            plano = (_text(values["plano"]) or "") if "plano" in values else None
+            yield record, plano, values.get("registro")
+
+
+FORMATS = {fmt.extension: fmt for fmt in (XmlFormat, CsvFormat, JsonLinesFormat)}
+
+
+def for_filename(filename):
+    # O formato vem da extensão, ignorando um .gz no final
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Formato de arquivo desconhecido: {0} (use {1})'.format(
+            filename, ", ".join(sorted(FORMATS))))
+    return FORMATS[extension]
@@ -0,0 +1,1059 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import datetime
+import tkinter
+import sqlite3
+import xml.etree.ElementTree
+import xml.parsers.expat
+
+from tkinter import ttk, messagebox, simpledialog
+from tkinter.filedialog import asksaveasfilename, askopenfilename
+
+import xmlio
+import search
+import client
+import worker
+import archive
+import instrument
+import birthdates
+from repository import ConflictError, Patient
+
+# Milissegundos sem digitação antes de atualizar a lista de nomes
+TYPEAHEAD_DELAY = 250
+
+# Quantos registros listar quando a busca em abrir é ambígua
+AMBIGUOUS_LIMIT = 20
+
+# Intervalo em milissegundos entre as leituras do progresso de uma tarefa
+POLL_INTERVAL = 200
+
+# Lê os índices das comboboxes de nome e registro numa thread logo depois
+# que a janela aparece; sem isso, são lidos na primeira vez que abrem
+PREFETCH_INDEXES = True
+
+# Janela de navegação: linhas por página, máximo de linhas mantidas no
+# Treeview e fração da rolagem perto das bordas que dispara nova página
+BROWSE_PAGE = 100
+BROWSE_WINDOW = 300
+BROWSE_MARGIN = 0.1
+
+# Formatos oferecidos na importação e exportação (ver formats.FORMATS)
+FILE_TYPES = [('Arquivos XML', '.xml'), ('XML compactado', '.xml.gz'), ('Planilha CSV', '.csv'),
+              ('CSV compactado', '.csv.gz'), ('JSON Lines', '.jsonl'), ('JSON Lines compactado', '.jsonl.gz'),
+              ('Todos Arquivos', '.*')]
+
+class AbrirWindow(tkinter.Toplevel):
+    
+    def __init__(self, parent, name=None):
+        super().__init__(parent)
+        self.title("Localizar Paciente")
+        self.parent = parent
+        self.accepted = False
+        self.nameVar = tkinter.StringVar()
+        if name is not None:
+            self.nameVar.set(name)
+        
+        frame = tkinter.Frame(self)
+        nameLabel = tkinter.Label(frame, text="Nome:", underline=0)
+        nameEntry = tkinter.Entry(frame, textvariable=self.nameVar)
+        nameEntry.focus_set()
+        okButton = tkinter.Button(frame, text="Localizar", command=self.ok)
+        cancelButton = tkinter.Button(frame, text="Cancelar", command=self.close)
+        nameLabel.grid(row=0, column=0, sticky=tkinter.W, pady=3,padx=3)
+        nameEntry.grid(row=0, column=1, columnspan=3, sticky=tkinter.EW, pady=3, padx=3)
+        okButton.grid(row=2, column=2, sticky=tkinter.EW, pady=3, padx=3)
+        cancelButton.grid(row=2, column=3, sticky=tkinter.EW, pady=3, padx=3)
+        frame.grid(row=0, column=0, sticky=tkinter.NSEW)
+        frame.columnconfigure(1, weight=1)
+        window = self.winfo_toplevel()
+        window.columnconfigure(0, weight=1)
+        
+        self.bind("<Return>", self.ok)
+        self.bind("<Escape>", self.close)
+
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.grab_set()
+        self.wait_window(self)
+
+    def ok(self, event=None):
+        self.name = self.nameVar.get()
+        self.accepted = True
+        self.close()
+
+    def close(self, event=None):
+        self.parent.focus_set()
+        self.destroy()       
+
+class ProgressWindow(tkinter.Toplevel):
+    
+    def __init__(self, parent, title, job, on_done):
+        super().__init__(parent)
+        self.title(title)
+        self.resizable(tkinter.FALSE, tkinter.FALSE)
+        self.job = job
+        self.on_done = on_done
+        self.statusVar = tkinter.StringVar()
+        
+        frame = tkinter.Frame(self)
+        self.bar = ttk.Progressbar(frame, length=320, mode='determinate', maximum=1.0)
+        statusLabel = tkinter.Label(frame, textvariable=self.statusVar, anchor=tkinter.W)
+        self.cancelButton = tkinter.Button(frame, text="Cancelar", command=self.cancel)
+        self.bar.grid(row=0, column=0, columnspan=2, sticky=tkinter.EW, pady=3, padx=3)
+        statusLabel.grid(row=1, column=0, sticky=tkinter.EW, pady=3, padx=3)
+        self.cancelButton.grid(row=1, column=1, sticky=tkinter.E, pady=3, padx=3)
+        frame.grid(row=0, column=0, sticky=tkinter.NSEW)
+        
+        self.bind("<Escape>", self.cancel)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        self.job.start()
+        self.poll()
+    
+    def poll(self):
+        job = self.job
+        if job.fraction is None:
+            if str(self.bar['mode']) != 'indeterminate':
+                self.bar.configure(mode='indeterminate')
+                self.bar.start()
+        else:
+            self.bar['value'] = job.fraction
+        if not job.cancel_event.is_set():
+            self.statusVar.set('{0} pacientes, {1:.0f}/s, restam {2}'.format(
+                job.rows, job.rate(), worker.format_duration(job.eta())))
+        if job.is_alive():
+            self.after(POLL_INTERVAL, self.poll)
+        else:
+            self.destroy()
+            self.on_done(job)
+    
+    def cancel(self, event=None):
+        self.job.cancel()
+        self.statusVar.set('Cancelando...')
+        self.cancelButton['state'] = tkinter.DISABLED
+
+class BrowseWindow(tkinter.Toplevel):
+    # Lista de pacientes que só mantém em memória algumas páginas por vez,
+    # buscando a próxima (ou a anterior) conforme a rolagem chega às bordas
+    
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Pacientes")
+        self.parent = parent
+        self.repo = parent.repo
+        self.sort = 'nome'
+        self.descending = False
+        self.keys = {}
+        self.more_above = False
+        self.more_below = False
+        self.loading = False
+        
+        frame = tkinter.Frame(self)
+        self.tree = ttk.Treeview(frame, columns=('registro', 'nome', 'cidade', 'plano'), show='headings',
+                                 height=20, selectmode='browse')
+        self.headings = {}
+        for column, text, width in (('registro', 'Registro', 70), ('nome', 'Nome', 300),
+                                    ('cidade', 'Cidade', 160), ('plano', 'Plano', 120)):
+            self.headings[column] = text
+            self.tree.heading(column, text=text, command=lambda column=column: self.sort_by(column))
+            self.tree.column(column, width=width, stretch=column == 'nome')
+        self.scrollbar = ttk.Scrollbar(frame, orient=tkinter.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.scrolled)
+        self.tree.grid(row=0, column=0, sticky=tkinter.NSEW)
+        self.scrollbar.grid(row=0, column=1, sticky=tkinter.NS)
+        frame.grid(row=0, column=0, sticky=tkinter.NSEW)
+        frame.rowconfigure(0, weight=1)
+        frame.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        
+        self.tree.bind("<Double-1>", self.open)
+        self.tree.bind("<Return>", self.open)
+        self.bind("<Escape>", self.close)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.reload()
+        self.tree.focus_set()
+    
+    def sort_by(self, column):
+        if column == self.sort:
+            self.descending = not self.descending
+        else:
+            self.sort = column
+            self.descending = False
+        self.reload()
+    
+    def reload(self):
+        for column, text in self.headings.items():
+            if column == self.sort:
+                text += ' ▼' if self.descending else ' ▲'
+            self.tree.heading(column, text=text)
+        self.tree.delete(*self.tree.get_children())
+        self.keys.clear()
+        rows = self.repo.browse(self.sort, None, BROWSE_PAGE, self.descending)
+        self.more_above = False
+        self.more_below = len(rows) == BROWSE_PAGE
+        self.insert_rows(rows, 'end')
+        self.tree.yview_moveto(0)
+    
+    def insert_rows(self, rows, index):
+        for identity, nome, cidade, plano, key in rows:
+            iid = str(identity)
+            self.tree.insert('', index, iid=iid, values=(identity, nome, cidade or '', plano))
+            self.keys[iid] = (key, identity)
+            if index != 'end':
+                index += 1
+    
+    def drop_rows(self, iids):
+        self.tree.delete(*iids)
+        for iid in iids:
+            del self.keys[iid]
+    
+    def scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.loading:
+            return
+        if self.more_below and float(last) >= 1.0 - BROWSE_MARGIN:
+            self.loading = True
+            self.after_idle(self.load_below)
+        elif self.more_above and float(first) <= BROWSE_MARGIN:
+            self.loading = True
+            self.after_idle(self.load_above)
+    
+    def load_below(self):
+        children = self.tree.get_children()
+        rows = self.repo.browse(self.sort, self.keys[children[-1]], BROWSE_PAGE, self.descending)
+        self.more_below = len(rows) == BROWSE_PAGE
+        self.insert_rows(rows, 'end')
+        excess = len(children) + len(rows) - BROWSE_WINDOW
+        if excess > 0:
+            self.drop_rows(children[:excess])
+            self.more_above = True
+            # As linhas removidas acima deslocariam a vista; compensa
+            self.tree.yview_scroll(-excess, 'units')
+        self.loading = False
+    
+    def load_above(self):
+        children = self.tree.get_children()
+        rows = self.repo.browse(self.sort, self.keys[children[0]], BROWSE_PAGE, not self.descending)
+        rows.reverse()
+        self.more_above = len(rows) == BROWSE_PAGE
+        self.insert_rows(rows, 0)
+        self.tree.yview_scroll(len(rows), 'units')
+        excess = len(children) + len(rows) - BROWSE_WINDOW
+        if excess > 0:
+            self.drop_rows(children[-excess:])
+            self.more_below = True
+        self.loading = False
+    
+    def open(self, event=None):
+        iid = self.tree.focus()
+        if not iid:
+            return
+        self.parent.registro.set(iid)
+        self.parent.abrir_id()
+    
+    def close(self, event=None):
+        self.parent.focus_set()
+        self.destroy()
+
+class DesempenhoWindow(tkinter.Toplevel):
+    # Tempos medidos desde que o programa abriu: consultas SQL e ações da interface
+    
+    COLUMNS = (('nome', 'Operação', 420), ('n', 'Vezes', 60), ('media', 'Média ms', 75), ('p50', 'p50 ms', 70),
+               ('p95', 'p95 ms', 70), ('max', 'Máx. ms', 75), ('total', 'Total s', 70))
+    
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Desempenho")
+        self.stats = parent.stats
+        self.cache = parent.repo.cache
+        self.cacheVar = tkinter.StringVar()
+        self.trees = {}
+        
+        frame = tkinter.Frame(self)
+        # Usando um servidor não há consultas SQL aqui, e sim requisições
+        queries = ('sql', 'Consultas SQL', 14) if self.cache is not None else ('rede', 'Requisições ao servidor', 14)
+        for row, (category, text, height) in enumerate((('interface', 'Ações da interface', 8), queries)):
+            tkinter.Label(frame, text=text, anchor=tkinter.W).grid(row=row * 2, column=0, sticky=tkinter.EW)
+            tree = ttk.Treeview(frame, columns=[column for column, text, width in self.COLUMNS],
+                                show='headings', height=height)
+            for column, heading, width in self.COLUMNS:
+                tree.heading(column, text=heading)
+                tree.column(column, width=width, stretch=column == 'nome',
+                            anchor=tkinter.W if column == 'nome' else tkinter.E)
+            tree.grid(row=row * 2 + 1, column=0, sticky=tkinter.NSEW, pady=3)
+            frame.rowconfigure(row * 2 + 1, weight=1)
+            self.trees[category] = tree
+        log = self.stats.slow_log or '-'
+        tkinter.Label(frame, text='Operações lentas gravadas em {0}'.format(log),
+                      anchor=tkinter.W).grid(row=4, column=0, sticky=tkinter.EW)
+        tkinter.Label(frame, textvariable=self.cacheVar, anchor=tkinter.W).grid(row=5, column=0, sticky=tkinter.EW)
+        buttons = tkinter.Frame(frame)
+        tkinter.Button(buttons, text="Atualizar", command=self.refresh).grid(row=0, column=0, padx=3)
+        tkinter.Button(buttons, text="Zerar", command=self.reset).grid(row=0, column=1, padx=3)
+        tkinter.Button(buttons, text="Fechar", command=self.destroy).grid(row=0, column=2, padx=3)
+        buttons.grid(row=6, column=0, sticky=tkinter.E, pady=3)
+        frame.grid(row=0, column=0, sticky=tkinter.NSEW, padx=3, pady=3)
+        frame.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        
+        self.bind("<Escape>", lambda event: self.destroy())
+        self.bind("<F5>", self.refresh)
+        self.refresh()
+    
+    def refresh(self, event=None):
+        for category, tree in self.trees.items():
+            tree.delete(*tree.get_children())
+            for name, count, mean, p50, p95, maximum, total in self.stats.rows(category):
+                tree.insert('', 'end', values=(name, count, '{0:.2f}'.format(mean * 1000),
+                                               '{0:.2f}'.format(p50 * 1000), '{0:.2f}'.format(p95 * 1000),
+                                               '{0:.2f}'.format(maximum * 1000), '{0:.2f}'.format(total)))
+        cache = self.cache
+        if cache is None:
+            return
+        lookups = cache.hits + cache.misses
+        self.cacheVar.set('Pacientes em memória: {0} de {1}, {2} aberturas, {3:.0%} sem consultar o banco'.format(
+            len(cache.patients), cache.size, lookups, cache.hits / lookups if lookups else 0))
+    
+    def reset(self):
+        self.stats.reset()
+        if self.cache is not None:
+            self.cache.hits = self.cache.misses = 0
+        self.refresh()
+
+class DuplicadosWindow(tkinter.Toplevel):
+    # Lista de revisão dos prováveis duplicados, da maior nota para a menor
+    
+    COLUMNS = (('nota', 'Nota', 50), ('a', 'Registro', 70), ('nome_a', 'Nome', 220), ('b', 'Registro', 70),
+               ('nome_b', 'Nome', 220), ('motivos', 'Motivos', 300))
+    
+    def __init__(self, parent, rows):
+        super().__init__(parent)
+        self.title("Duplicados")
+        self.parent = parent
+        self.repo = parent.repo
+        self.pairs = {}
+        
+        frame = tkinter.Frame(self)
+        self.tree = ttk.Treeview(frame, columns=[column for column, text, width in self.COLUMNS],
+                                 show='headings', height=20, selectmode='browse')
+        for column, heading, width in self.COLUMNS:
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, stretch=column in ('nome_a', 'nome_b', 'motivos'))
+        scrollbar = ttk.Scrollbar(frame, orient=tkinter.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.grid(row=0, column=0, sticky=tkinter.NSEW)
+        scrollbar.grid(row=0, column=1, sticky=tkinter.NS)
+        buttons = tkinter.Frame(frame)
+        for column, (text, command) in enumerate((("Abrir A", lambda: self.open(0)),
+                                                  ("Abrir B", lambda: self.open(1)),
+                                                  ("Mesclar B em A", self.merge),
+                                                  ("Não é duplicado", self.distinct),
+                                                  ("Fechar", self.close))):
+            tkinter.Button(buttons, text=text, command=command).grid(row=0, column=column, padx=3)
+        buttons.grid(row=1, column=0, columnspan=2, sticky=tkinter.E, pady=3)
+        frame.grid(row=0, column=0, sticky=tkinter.NSEW, padx=3, pady=3)
+        frame.rowconfigure(0, weight=1)
+        frame.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        
+        for nota, first, nome_a, second, nome_b, motivos in rows:
+            iid = self.tree.insert('', 'end', values=('{0:.2f}'.format(nota), first, nome_a, second, nome_b,
+                                                      motivos))
+            self.pairs[iid] = (first, second)
+        self.tree.bind("<Double-1>", lambda event: self.open(0))
+        self.bind("<Escape>", self.close)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.tree.focus_set()
+    
+    def selected(self):
+        iid = self.tree.focus()
+        return (iid, self.pairs[iid]) if iid else (None, None)
+    
+    def open(self, which):
+        iid, pair = self.selected()
+        if iid is None:
+            return
+        self.parent.registro.set(pair[which])
+        self.parent.abrir_id()
+    
+    def merge(self):
+        iid, (first, second) = self.selected()
+        if iid is None:
+            return
+        reply = messagebox.askyesno('Mesclar', 'Os campos vazios do registro {0} serão preenchidos com os do '
+                                    'registro {1}, que será removido. Deseja continuar?'.format(first, second),
+                                    parent=self)
+        if not reply:
+            return
+        keep, drop = self.repo.get(first), self.repo.get(second)
+        if keep is None or drop is None:
+            messagebox.showinfo(message='Um dos pacientes já foi removido', title='Atenção', parent=self)
+            self.tree.delete(iid)
+            return
+        try:
+            self.repo.merge_patients(keep, drop)
+        except (ValueError, sqlite3.OperationalError) as err:
+            messagebox.showwarning(title='Atenção', message='ERRO: {0}'.format(err), parent=self)
+            return
+        # Outros pares com o registro removido deixam de valer
+        for other, pair in list(self.pairs.items()):
+            if second in pair:
+                self.tree.delete(other)
+                del self.pairs[other]
+    
+    def distinct(self):
+        iid, pair = self.selected()
+        if iid is None:
+            return
+        try:
+            self.repo.mark_distinct(*pair)
+        except sqlite3.OperationalError as err:
+            messagebox.showwarning(title='Atenção', message='ERRO: {0}'.format(err), parent=self)
+            return
+        self.tree.delete(iid)
+        del self.pairs[iid]
+    
+    def close(self, event=None):
+        self.parent.focus_set()
+        self.destroy()
+
+class MainWindow(tkinter.Tk):
+    
+    def __init__(self, filename, timeout=None):
+        # A janela abre sem ler a tabela de pacientes: as comboboxes são
+        # preenchidas quando abertas (postcommand) ou por prefetch_indexes.
+        # A duração de cada fase vai para as medidas como "início: ...".
+        self.phase_start = self.started = time.perf_counter()
+        self.filename = filename
+        # Espera quando outra estação está gravando (--timeout), também nas
+        # conexões das tarefas; None é o padrão de client.open_repository
+        self.timeout = timeout
+        # Medidas baratas o bastante para ficarem sempre ligadas (ver
+        # DesempenhoWindow). Com um servidor (filename é a URL) o banco fica
+        # lá, e o log das consultas lentas também.
+        remote = client.is_remote(filename)
+        self.stats = instrument.Stats(slow_log=None if remote else os.path.splitext(filename)[0] + '-lento.log')
+        self.repo = client.open_repository(self.filename, self.timeout, self.stats)
+        self.startup_phase('conexão')
+        self.combo_versions = {}
+        self.job = None
+        # (registro, versão) do paciente aberto, para detectar gravações
+        # feitas por outra estação depois que ele foi lido
+        self.loaded = None
+        
+        tkinter.Tk.__init__(self)
+        self.wm_title("Cadastro de pacientes")
+        self.protocol("WM_DELETE_WINDOW", self.sair)
+        self.resizable(tkinter.FALSE, tkinter.FALSE)
+        
+        self.images_keepmem = []
+        self.icon = tkinter.PhotoImage(file=os.path.join(os.path.dirname(__file__), "images", "bookmark.gif"))
+        self.images_keepmem.append(self.icon)
+        self.tk.call('wm', 'iconphoto', self._w, self.icon)
+        
+        #Menus
+        menubar = tkinter.Menu(self)
+        self["menu"] = menubar
+        self.option_add('*tearOff', tkinter.FALSE)
+        
+        #Menu Arquivo
+        menuArquivo = tkinter.Menu(menubar)
+        for label, command, shortcut_text, shortcut in (
+                ("Novo", self.novo, "Ctrl+N", "<Control-n>"),
+                ("Abrir", self.abrir, "Ctrl+A", "<Control-a>"),
+                ("Navegar", self.navegar, "Ctrl+L", "<Control-l>"),
+                ("Duplicados", self.duplicados, None, None),
+                ("Salvar", self.salvar, "Ctrl+S", "<Control-s>"),
+                ("Excluir", self.remover, "Ctrl+E", "<Control-e>"),
+                (None, None, None, None),
+                ("Fechar", self.sair, "Ctrl+Q", "<Control-q>")):
+            if label is None:
+                menuArquivo.add_separator()
+            else:
+                menuArquivo.add_command(label=label, underline=0,
+                        command=command, accelerator=shortcut_text)
+                if shortcut is not None:
+                    self.bind(shortcut, command)        
+        menubar.add_cascade(label="Arquivo", menu=menuArquivo, underline=0)
+        
+        # Menu Editar
+        menuEditar = tkinter.Menu(menubar)
+        for label, command, shortcut_text, shortcut in (
+                ("Copiar", self.copiar, "Ctrl+C", "<Control-c>"),
+                ("Colar", self.colar, "Ctrl+V", "<Control-v>"),
+                ("Recortar", self.recortar, "Ctrl+X", "<Control-x>")):
+            menuEditar.add_command(label=label, underline=0 if label != "Colar" else 1,
+                        command=command, accelerator=shortcut_text)
+            #self.bind(shortcut, command)
+        menuEditar.add_separator()
+        menuEditar.add_command(label="Importar XML", underline=0, command=self.importar_db)
+        menuEditar.add_command(label="Sincronizar XML", underline=0, command=self.sincronizar_db)
+        menuEditar.add_command(label="Exportar XML", underline=0, command=self.exportar_db)
+        menuEditar.add_command(label="Arquivar inativos", underline=1, command=self.arquivar_db)
+        
+        menubar.add_cascade(label="Editar", menu=menuEditar, underline=0)
+        
+        #Menu Ajuda
+        menuAjuda = tkinter.Menu(menubar)
+        menuAjuda.add_command(label="Sobre", underline=0,
+                              command=self.sobre, accelerator="Ctrl+H")
+        self.bind("<Control-h>", self.sobre)
+        menuAjuda.add_command(label="Desempenho", underline=0, command=self.desempenho)
+        menubar.add_cascade(label="Ajuda", menu=menuAjuda, underline=2)
+        
+        #Menu Mouse
+        self.MENUmouse = tkinter.Menu(self, tearoff=0)
+        self.MENUmouse.add_command(label="Copiar")
+        self.MENUmouse.add_command(label="Colar")
+        self.MENUmouse.add_command(label="Recortar")
+        self.bind("<Button-3><ButtonRelease-3>", self.show_mouse_menu)
+        
+        # Toolbar
+        self.mainframe = tkinter.Frame(self)
+        self.toolbar = tkinter.Frame(self.mainframe)
+        for image, command in (
+                ("images/filenew.gif", self.novo),
+                ("images/fileopen.gif", self.abrir),
+                ("images/trash.gif", self.remover),
+                ("images/filesave.gif", self.salvar),
+                ("images/exit.gif", self.sair)):
+            image = os.path.join(os.path.dirname(__file__), image)
+            try:
+                image = tkinter.PhotoImage(file=image)
+                self.images_keepmem.append(image)
+                button = tkinter.Button(self.toolbar, image=image,
+                                        command=command)
+                button.grid(row=0, column=len(self.images_keepmem) -2)
+            except tkinter.TclError as err:
+                print(err)
+        
+        self.toolbar.grid(row=0, column=0, columnspan=5, sticky=tkinter.NW)
+        self.mainframe.grid(row=0,column=0, sticky=tkinter.EW)
+        
+        #Nome
+        ttk.Label(self.mainframe, text="Nome: ").grid(row=1, column=1, sticky=tkinter.E) 
+        self.nome = tkinter.StringVar()
+        self.name_entry = ttk.Combobox(self.mainframe, width=50, textvariable=self.nome,
+                                       postcommand=self.name_values)
+        self.name_entry.grid(row=1, column=2, columnspan=9, sticky=tkinter.W)
+        self.typeahead_job = None
+        self.name_entry.bind('<KeyRelease>', self.typeahead)
+        self.name_entry.bind('<<ComboboxSelected>>', self.abrir_nome)
+        
+        #Sexo
+        ttk.Label(self.mainframe, text='Sexo: ').grid(row=2, column=1, sticky=tkinter.E)
+        self.sexo = tkinter.StringVar()
+        self.masculino = ttk.Radiobutton(self.mainframe, text='Masculino', variable=self.sexo, value='Masculino')
+        self.feminino = ttk.Radiobutton(self.mainframe, text='Feminino', variable=self.sexo, value='Feminino')
+        self.masculino.grid(row=2, column=2, sticky=tkinter.W)
+        self.feminino.grid(row=2, column=3, sticky=tkinter.W)
+        
+        #Plano de Saúde
+        ttk.Label(self.mainframe, text='Plano: ').grid(row=3, column=1, sticky=tkinter.E)
+        self.plano = tkinter.StringVar()
+        self.plano_entry = ttk.Combobox(self.mainframe, textvariable=self.plano,
+                                        postcommand=lambda: self.sync_values(self.plano_entry, self.repo.planos.index))
+        self.plano_entry.grid(row=3, column=2, columnspan=3, sticky=tkinter.W)
+        
+        # Número do Cartão
+        ttk.Label(self.mainframe, text='Cartão: ').grid(row=4, column=1, sticky=tkinter.E)
+        self.cartao = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=20, textvariable=self.cartao).grid(row=4,column=2, columnspan=3, sticky=tkinter.W)
+        
+        #Data de nascimento
+        self.ageframe = tkinter.Frame(self.mainframe)
+        self.ageframe.grid(row=5, column=1, columnspan=10, sticky=tkinter.EW)
+        ttk.Label(self.ageframe, text='Data de Nascimento: ').grid(row=1, column=1, sticky=tkinter.E)
+        self.dia_nasc = tkinter.StringVar()
+        self.dia_nasc.set('01')
+        self.mes_nasc = tkinter.StringVar()
+        self.mes_nasc.set('Janeiro')
+        self.ano_nasc = tkinter.StringVar()
+        self.ano_nasc.set('1950')
+        self.idade = tkinter.StringVar()
+        ttk.Entry(self.ageframe, width=4, textvariable=self.dia_nasc).grid(row=1,column=2, sticky=tkinter.E)
+        ttk.Label(self.ageframe, text='/').grid(row=1, column=3, sticky=tkinter.EW)
+        self.mes = ttk.Combobox(self.ageframe, textvariable=self.mes_nasc)
+        self.mes.grid(row=1, column=4, sticky=tkinter.EW)
+        ttk.Label(self.ageframe, text='/').grid(row=1, column=5, sticky=tkinter.EW)
+        ttk.Entry(self.ageframe, width=6, textvariable=self.ano_nasc).grid(row=1,column=6, sticky=tkinter.W)
+        self.mes['values'] = birthdates.MONTHS
+        
+        ttk.Label(self.ageframe, text='Idade: ').grid(row=1, column=7, sticky=tkinter.E)
+        ttk.Label(self.ageframe, textvariable=self.idade).grid(row=1, column=8, sticky=tkinter.W)
+        ttk.Label(self.ageframe, text='anos').grid(row=1, column=9, sticky=tkinter.E)
+        self.mes.bind('<<ComboboxSelected>>', self.callback)
+        self.dia_nasc.trace("w", self.callback)
+        self.ano_nasc.trace("w", self.callback)
+        self.callback()
+        
+        #Endereço
+        ttk.Label(self.mainframe, text='Endereço: ').grid(row=6, column=1, sticky=tkinter.E)
+        self.endereco = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=50, textvariable=self.endereco).grid(row=6, column=2, columnspan=9, sticky=tkinter.W)
+        
+        #Cidade
+        ttk.Label(self.mainframe, text='Cidade: ').grid(row=7, column=1, sticky=tkinter.E)
+        self.cidade = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=30, textvariable=self.cidade).grid(row=7, column=2, sticky=tkinter.W)
+        
+        # Estado
+        ttk.Label(self.mainframe, text='Estado: ').grid(row=7, column=3, sticky=tkinter.E)
+        self.estado = tkinter.StringVar()
+        self.estado_entry = ttk.Combobox(self.mainframe, width=4, textvariable=self.estado)
+        self.estado_entry.grid(row=7, column=4, sticky=tkinter.W)
+        self.estado_entry['values'] = ('AC', 'AL', 'AP', 'AM', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MT', 'MS', 'MG', 'PA',
+                                       'PB', 'PR', 'PE', 'PI', 'RJ', 'RN', 'RS', 'RO', 'RR', 'SC', 'SP', 'SE', 'TO')
+        
+        # CEP
+        ttk.Label(self.mainframe, text='CEP: ').grid(row=8, column=1, sticky=tkinter.E)
+        self.cep = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=30, textvariable=self.cep).grid(row=8, column=2, sticky=tkinter.W)
+        
+        # Telefone
+        ttk.Label(self.mainframe, text='Telefone: ').grid(row=9, column=1, sticky=tkinter.E)
+        self.telefone = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=20, textvariable=self.telefone).grid(row=9, column=2, columnspan=3, sticky=tkinter.W)
+        
+        # Celular
+        ttk.Label(self.mainframe, text='Celular: ').grid(row=10, column=1, sticky=tkinter.E)
+        self.celular = tkinter.StringVar()
+        ttk.Entry(self.mainframe, width=20, textvariable=self.celular).grid(row=10, column=2, columnspan=3, sticky=tkinter.W)
+        
+        # Registro
+        ttk.Label(self.mainframe, text='Registro: ').grid(row=10, column=5, sticky=tkinter.E)
+        self.registro = tkinter.StringVar()
+        self.reg_entry = ttk.Combobox(self.mainframe, width=5, textvariable=self.registro,
+                                      postcommand=lambda: self.sync_values(self.reg_entry, self.repo.ids_index()))
+        self.reg_entry.grid(row=10, column=6, sticky=tkinter.W)
+        self.reg_entry.bind('<<ComboboxSelected>>', self.abrir_id)
+        
+        for child in self.mainframe.winfo_children():
+            child.grid_configure(padx=3, pady=3)
+            
+        for child in self.toolbar.winfo_children():
+            child.grid_configure(padx=2, pady=3)
+        self.startup_phase('janela')
+        self.after_idle(self.first_idle)
+    
+    def __del__(self):
+        self.repo.close()
+    
+    def startup_phase(self, name):
+        now = time.perf_counter()
+        self.stats.record('interface', 'início: ' + name, now - self.phase_start)
+        self.phase_start = now
+    
+    def first_idle(self):
+        # A janela já foi desenhada e aceita digitação
+        self.startup_phase('primeira tela')
+        elapsed = time.perf_counter() - self.started
+        self.stats.record('interface', 'início: total', elapsed)
+        if elapsed >= self.stats.slow_handler:
+            self.stats.log('início lento: {0:.1f} ms'.format(elapsed * 1000))
+        if PREFETCH_INDEXES and not client.is_remote(self.filename):
+            self.prefetch_indexes()
+    
+    def prefetch_indexes(self):
+        # Lê os índices com outra conexão, numa thread; se nesse meio tempo
+        # algo foi gravado, são descartados e lidos quando pedidos
+        marker = self.repo.data_marker()
+        job = worker.Job(self.filename, lambda repo, progress: repo.index_records(), self.stats, self.timeout)
+        job.start()
+        self.after(POLL_INTERVAL, self.prefetch_done, job, marker)
+    
+    def prefetch_done(self, job, marker):
+        if job.is_alive():
+            self.after(POLL_INTERVAL, self.prefetch_done, job, marker)
+            return
+        if job.error is not None or not self.repo.use_indexes(job.result, marker):
+            return
+        self.stats.record('interface', 'início: índices', job.elapsed())
+        # Repassa as listas ao Tk enquanto o usuário ainda não as abriu
+        self.sync_values(self.reg_entry, self.repo.ids_index())
+        if not search.normalize_name(self.nome.get()):
+            self.sync_values(self.name_entry, self.repo.names_index())
+    
+    def sync_values(self, combobox, index):
+        # Só repassa a lista ao Tk quando o índice mudou desde a última vez
+        if self.combo_versions.get(str(combobox)) != index.version:
+            combobox['values'] = index.values()
+            self.combo_versions[str(combobox)] = index.version
+    
+    def typeahead(self, event=None):
+        # Espera o usuário parar de digitar antes de consultar o banco
+        if event is not None and event.keysym in ('Up', 'Down', 'Return', 'Escape', 'Tab'):
+            return
+        if self.typeahead_job is not None:
+            self.after_cancel(self.typeahead_job)
+        self.typeahead_job = self.after(TYPEAHEAD_DELAY, self.name_values)
+    
+    @instrument.timed('name_values')
+    def name_values(self):
+        self.typeahead_job = None
+        text = self.nome.get()
+        if not search.normalize_name(text):
+            self.sync_values(self.name_entry, self.repo.names_index())
+            return
+        self.name_entry['values'] = tuple(record[0] for record in self.repo.search(text))
+        self.combo_versions.pop(str(self.name_entry), None)
+    
+    def current_id(self):
+        # Registro digitado ou, na falta dele, o paciente com mesmo nome e telefone
+        reg = self.registro.get().strip()
+        if reg:
+            return int(reg)
+        return self.repo.find_id(self.nome.get(), self.telefone.get())
+    
+    def form_patient(self, identity):
+        versao = self.loaded[1] if self.loaded is not None and self.loaded[0] == identity else None
+        return Patient(self.nome.get(), sexo=self.sexo.get(), cartao=self.cartao.get(),
+                       dia_nasc=self.dia_nasc.get(), mes_nasc=self.mes_nasc.get(), ano_nasc=self.ano_nasc.get(),
+                       endereco=self.endereco.get(), cidade=self.cidade.get(), estado=self.estado.get(),
+                       cep=self.cep.get(), telefone=self.telefone.get(), celular=self.celular.get(),
+                       plano=self.plano.get(), id=identity, versao=versao)
+    
+    def show_patient(self, patient):
+        self.loaded = (patient.id, patient.versao)
+        self.registro.set(patient.id)
+        self.nome.set(patient.nome)
+        self.sexo.set(patient.sexo)
+        self.cartao.set(patient.cartao)
+        self.dia_nasc.set(patient.dia_nasc)
+        self.mes_nasc.set(patient.mes_nasc)
+        self.ano_nasc.set(patient.ano_nasc)
+        self.endereco.set(patient.endereco)
+        self.cidade.set(patient.cidade)
+        self.plano.set(patient.plano)
+        self.estado.set(patient.estado)
+        self.cep.set(patient.cep)
+        self.telefone.set(patient.telefone)
+        self.celular.set(patient.celular)
+    
+    def copiar(self, *ignore):
+        w = self.focus_get()
+        w.event_generate("<<Copy>>")
+    
+    def colar(self, *ignore):
+        w = self.focus_get()
+        w.event_generate("<<Paste>>")
+    
+    def recortar(self, *ignore):
+        w = self.focus_get()
+        w.event_generate("<<Cut>>")
+    
+    def desempenho(self, *ignore):
+        DesempenhoWindow(self)
+    
+    def sobre(self, *ignore):
+        messagebox.showinfo(message='Cadastro de Pacientes versão 0.10', title='Sobre')
+    
+    def blank(self, *ignore):
+        self.nome.set('')
+        self.sexo.set(None)
+        self.cartao.set('')
+        self.dia_nasc.set('01')
+        self.mes_nasc.set('Janeiro')
+        self.ano_nasc.set('1950')
+        self.endereco.set('')
+        self.cidade.set('')
+        self.plano.set('')
+        self.estado.set('')
+        self.cep.set('')
+        self.telefone.set('')
+        self.celular.set('')
+        self.registro.set('')
+        self.loaded = None
+        
+    # Os métodos que abrem uma janela modal (confirmação, escolha de arquivo)
+    # não são medidos inteiros, senão o tempo do usuário na janela entraria
+    # nas estatísticas: instrument.timed fica no trabalho feito depois dela.
+    # Importar, sincronizar, exportar e arquivar só iniciam uma tarefa, cujo
+    # tempo job_done registra.
+    
+    def novo(self, *ignore):
+        reply = messagebox.askyesno('Novo', 
+                     'Deseja salvar alterações para o paciente {0}?'.format(self.nome.get()), parent=self)
+        if reply and len(self.nome.get()) > 0:
+            self.salvar(self) 
+        self.limpar()
+    
+    @instrument.timed('novo')
+    def limpar(self):
+        self.blank()
+    
+    def abrir(self, *ignore):
+        form = AbrirWindow(self)
+        if form.accepted and form.name:
+            nome = form.name
+        else:
+            return
+        
+        records = self.buscar(nome)
+        if len(records) > 1:
+            record = search.exact_match(records, nome)
+            if record is not None:
+                self.registro.set(record[1])
+                self.abrir_id()
+                return
+            ids = [str(record[1]) for record in records[:AMBIGUOUS_LIMIT]]
+            if len(records) > AMBIGUOUS_LIMIT:
+                ids.append('...')
+            messagebox.showinfo(message='Há mais de um paciente com o nome {0} Registros: ({1}) Tente abrir pelo número do registro'\
+                                                                                        .format(nome, ', '.join(ids)), title='Atenção')
+        elif records:
+            self.registro.set(records[0][1])
+            self.abrir_id()
+        else:
+            messagebox.showinfo(message='Nenhum paciente encontrado com o nome {0}'.format(nome), title='Atenção')
+    
+    @instrument.timed('abrir')
+    def buscar(self, nome):
+        records = self.repo.search(nome, limit=AMBIGUOUS_LIMIT + 1)
+        if not records:
+            # Só então consulta os inativos; abrir_id os traz de volta
+            records = self.repo.search_archive(nome, limit=AMBIGUOUS_LIMIT + 1)
+        return records
+    
+    @instrument.timed('navegar')
+    def navegar(self, *ignore):
+        BrowseWindow(self)
+    
+    @instrument.timed('duplicados')
+    def duplicados(self, *ignore):
+        self.start_job('Procurando duplicados', lambda repo, progress: repo.duplicate_pairs(progress=progress),
+                       self.duplicados_done)
+    
+    def duplicados_done(self, job):
+        if job.cancelled:
+            return
+        elif isinstance(job.error, sqlite3.Error):
+            messagebox.showwarning(title='Erro', message='ERRO: {0}'.format(job.error))
+        elif job.error is not None:
+            raise job.error
+        elif not job.result:
+            messagebox.showinfo(title='Info', message='Nenhum provável duplicado encontrado')
+        else:
+            DuplicadosWindow(self, job.result)
+    
+    def abrir_nome(self, *ignore):
+        nome = self.nome.get()  
+        records = self.buscar_nome(nome)
+        if not records:
+            messagebox.showinfo(message='Nenhum paciente encontrado com o nome {0}'.format(nome), title='Atenção')
+        elif len(records) > 1:
+            ids = []
+            for i in range(len(records)):
+                ids.append(str(records[i][1]))
+            messagebox.showinfo(message='Há mais de um paciente com o nome {0} Registros: ({1}) Tente abrir pelo número do registro'\
+                                                                                        .format(nome, ', '.join(ids)), title='Atenção')
+        else:
+            self.registro.set(records[0][1])
+            self.abrir_id()
+    
+    @instrument.timed('abrir_nome')
+    def buscar_nome(self, nome):
+        return self.repo.find_by_name(nome) or self.repo.find_archived_by_name(nome)
+    
+    def abrir_id(self, *ignore):
+        if not self.carregar():
+            messagebox.showinfo(message='Registro {0} não encontrado'.format(self.registro.get()), title='Atenção')
+    
+    @instrument.timed('abrir_id')
+    def carregar(self):
+        # Mostra o paciente do registro; False se ele não existe
+        try:
+            identity = int(self.registro.get())
+        except ValueError:
+            return False
+        patient = self.repo.get(identity) or self.repo.restore(identity)
+        if patient is None:
+            return False
+        self.show_patient(patient)
+        return True
+    
+    def remover(self, *ignore):
+        reply = messagebox.askyesno('Remover', 
+                     'Deseja remover o paciente atual do Banco de Dados?', parent=self)
+        
+        if not reply:
+            return
+        try:
+            identity = self.current_id()
+        except ValueError as err:
+            messagebox.showwarning(title='Atenção', message='ERRO: {0}'.format(err))
+            return
+        self.apagar(identity)
+    
+    @instrument.timed('remover')
+    def apagar(self, identity):
+        if identity is not None:
+            self.repo.delete(identity)
+        self.blank()
+        
+    def salvar(self, *ignore):
+        if not self.nome.get():
+            messagebox.showwarning(title='Atenção', message='É obrigatório preencher o nome')
+            return
+        if not self.telefone.get():
+            messagebox.showwarning(title='Atenção', message='É obrigatório preencher o telefone')
+            return
+        try:
+            identity = self.current_id()
+        except ValueError as err:
+            messagebox.showwarning(title='Atenção', message='ERRO: {0}'.format(err))
+            return
+        patient = self.form_patient(identity)
+        try:
+            self.gravar(patient)
+        except ConflictError as err:
+            reply = messagebox.askyesno(title='Atenção', message='{0}. Deseja descartar as suas alterações e '
+                                        'abrir a versão gravada?'.format(err), parent=self)
+            if reply:
+                self.abrir_id()
+        except sqlite3.OperationalError as err:
+            messagebox.showwarning(title='Atenção', message='ERRO: {0}. Tente salvar novamente'.format(err))
+    
+    @instrument.timed('salvar')
+    def gravar(self, patient):
+        self.repo.save(patient)
+        self.loaded = (patient.id, patient.versao)
+        self.registro.set(patient.id)
+            
+    def sair(self, event=None):
+        if self.okayToContinue():
+            if self.job is not None and self.job.is_alive():
+                self.job.cancel()
+                self.job.join()
+            self.destroy()
+            
+    def okayToContinue(self):
+        reply = messagebox.askyesnocancel(
+                   "Saída",
+                   "Deseja salvar as alterações antes de sair?", parent=self)
+        if reply is None:
+            return False
+        elif reply and len(self.nome.get()) > 0:
+            self.salvar(self)
+            return True
+        else:
+            return True
+    
+    def show_mouse_menu(self, e):
+        w = e.widget
+        self.MENUmouse.entryconfigure("Copiar", command=lambda: w.event_generate("<<Copy>>"))
+        self.MENUmouse.entryconfigure("Colar", command=lambda: w.event_generate("<<Paste>>"))
+        self.MENUmouse.entryconfigure("Recortar", command=lambda: w.event_generate("<<Cut>>"))
+        self.MENUmouse.tk.call("tk_popup", self.MENUmouse, e.x_root, e.y_root)
+        
+    def callback(self, *ignore):
+        nascimento = birthdates.iso_date(self.dia_nasc.get(), self.mes_nasc.get(), self.ano_nasc.get())
+        if nascimento is None or nascimento > datetime.date.today().isoformat():
+            self.idade.set('Invalid')
+        else:
+            self.idade.set(birthdates.age(nascimento))
+            
+    def importar_db(self, *ignore):
+        reply = messagebox.askyesno(title='Info', message='Esta ação irá apagar o banco de dados atual e importar um novo XML. Deseja continuar?')
+        if not reply:
+            return
+        
+        options = {}
+        options['filetypes'] = FILE_TYPES
+        options['initialfile'] = 'patients.xml'
+        fileName = askopenfilename(**options)
+        if not fileName:
+            return
+        
+        rejects = xmlio.Rejects(xmlio.rejects_name(fileName))
+        self.start_job('Importando XML', lambda repo, progress: repo.import_file(fileName, progress, workers=os.cpu_count() or 1, rejects=rejects),
+                       lambda job: self.importar_done(job, rejects, resumable=not client.is_remote(self.filename)))
+    
+    def sincronizar_db(self, *ignore):
+        reply = messagebox.askyesno(title='Info', message='Esta ação irá atualizar o banco de dados com o conteúdo do XML, '
+                                    'removendo os pacientes que não estiverem no arquivo. Deseja continuar?')
+        if not reply:
+            return
+        
+        options = {}
+        options['filetypes'] = FILE_TYPES
+        options['initialfile'] = 'patients.xml'
+        fileName = askopenfilename(**options)
+        if not fileName:
+            return
+        
+        rejects = xmlio.Rejects(xmlio.rejects_name(fileName))
+        self.start_job('Sincronizando XML', lambda repo, progress: repo.merge_file(fileName, progress, workers=os.cpu_count() or 1, rejects=rejects),
+                       lambda job: self.importar_done(job, rejects))
+    
+    def importar_done(self, job, rejects, resumable=False):
+        self.repo.reload()
+        if job.cancelled and resumable:
+            messagebox.showinfo(title='Info', message='Importação cancelada. O banco de dados não foi alterado; importar o mesmo '
+                                'arquivo de novo continua de onde parou')
+        elif job.cancelled:
+            messagebox.showinfo(title='Info', message='Importação cancelada. O banco de dados não foi alterado')
+        elif isinstance(job.error, (EnvironmentError, ValueError, sqlite3.Error, xml.parsers.expat.ExpatError,
+                                    xml.etree.ElementTree.ParseError)):
+            messagebox.showwarning(title='Erro', message='ERRO: {0}. Não foi possível importar o banco de dados'.format(job.error))
+        elif job.error is not None:
+            raise job.error
+        elif isinstance(job.result, dict):
+            messagebox.showinfo(title='Info', message='Arquivo XML sincronizado com sucesso. {inseridos} inseridos, '
+                                '{atualizados} atualizados, {removidos} removidos e {inalterados} inalterados'.format(**job.result))
+        else:
+            messagebox.showinfo(title='Info', message='Arquivo XML importado com sucesso. Foram importados {0} pacientes'.format(job.result))
+        if job.error is None and rejects.count:
+            messagebox.showwarning(title='Pacientes recusados', message='{0} pacientes não foram importados. Os motivos estão em '
+                                   '{1}'.format(rejects.count, rejects.filename))
+            
+    def exportar_db(self, *ignore):
+        options = {}
+        options['filetypes'] = FILE_TYPES
+        options['initialfile'] = 'patients.xml'
+        fileName = asksaveasfilename(**options)
+        if not fileName:
+            return
+        
+        self.start_job('Exportando XML', lambda repo, progress: repo.export_file(fileName, progress), self.exportar_done)
+    
+    def exportar_done(self, job):
+        if job.cancelled:
+            messagebox.showinfo(title='Info', message='Exportação cancelada')
+        elif isinstance(job.error, (EnvironmentError, sqlite3.Error)):
+            messagebox.showwarning(title='Erro', message='ERRO: {0}. Não foi possível exportar o banco de dados'.format(job.error))
+        elif job.error is not None:
+            raise job.error
+        else:
+            messagebox.showinfo(title='Info', message='Arquivo XML exportado com sucesso')
+    
+    def arquivar_db(self, *ignore):
+        days = simpledialog.askinteger('Arquivar inativos', 'Arquivar os pacientes sem alteração há quantos dias?',
+                                       initialvalue=archive.ARCHIVE_DAYS, minvalue=1, parent=self)
+        if days is None:
+            return
+        self.start_job('Arquivando inativos', lambda repo, progress: repo.archive_inactive(days), self.arquivar_done)
+    
+    def arquivar_done(self, job):
+        self.repo.reload()
+        if isinstance(job.error, sqlite3.Error):
+            messagebox.showwarning(title='Erro', message='ERRO: {0}. Nenhum paciente foi arquivado'.format(job.error))
+        elif job.error is not None:
+            raise job.error
+        else:
+            messagebox.showinfo(title='Info', message='{0} pacientes movidos para {1}. Eles voltam ao banco de dados '
+                                'quando forem abertos'.format(job.result, os.path.basename(self.repo.archive_file)))
+    
+    def start_job(self, title, task, on_done):
+        if self.job is not None and self.job.is_alive():
+            messagebox.showwarning(title='Atenção', message='Aguarde o fim da importação ou exportação em andamento')
+            return
+        self.job = worker.Job(self.filename, task, self.stats, self.timeout)
+        ProgressWindow(self, title, self.job, lambda job: self.job_done(title, job, on_done))
+    
+    def job_done(self, title, job, on_done):
+        self.stats.record('interface', title, job.elapsed())
+        on_done(job)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import bisect
+
+
+class SortedIndex:
+    # Lista ordenada mantida em memória e atualizada com bisect, para que as
+    # comboboxes não precisem reler a tabela inteira a cada alteração
+
+    def __init__(self, keys=(), value=None):
+        self.keys = sorted(keys)
+        self.value = value
+        self.version = 0
+        self._values = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def _changed(self):
+        self.version += 1
+        self._values = None
+
+    def add(self, key):
+        # A posição vem do bisect; o insert só desloca a lista (memmove), e
+        # values(), se já foi montada, recebe o valor na mesma posição em vez
+        # de ser refeita
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        if self._values is not None:
+            self._values.insert(i, key if self.value is None else self.value(key))
+        self.version += 1
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+            if self._values is not None:
+                del self._values[i]
+            self.version += 1
+            return True
+        return False
+
+    def replace(self, old, new):
+        if old == new:
+            return
+        self.remove(old)
+        self.add(new)
+
+    def reset(self, keys):
+        self.keys = sorted(keys)
+        self._changed()
+
+    def values(self):
+        # Lista pronta para a combobox, montada uma vez e depois mantida por
+        # add e remove. É a própria lista do índice: quem a recebe não deve
+        # alterá-la nem guardá-la esperando que não mude (a combobox copia).
+        if self._values is None:
+            if self.value is None:
+                self._values = list(self.keys)
+            else:
+                self._values = list(map(self.value, self.keys))
+        return self._values
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import re
+import time
+import bisect
+import sqlite3
+import threading
+import functools
+
+# Limites superiores, em segundos, das faixas dos histogramas: de 0,1 ms a
+# cerca de 26 s, dobrando a cada faixa, mais uma faixa final sem limite
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(19)) + (float("inf"),)
+
+# Consultas e ações de interface mais lentas que isso vão para o log
+SLOW_QUERY = 0.1
+SLOW_HANDLER = 0.5
+
+# Máximo de consultas distintas acompanhadas; as demais somam em OTHER
+MAX_KEYS = 200
+OTHER = "(outras)"
+
+# Listas de parâmetros de tamanho variável, como em get_many, viram uma só chave
+PARAM_LIST = re.compile(r"\?(\s*,\s*\?)+")
+SPACES = re.compile(r"\s+")
+
+
+class Histogram:
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        # Aproximado pelo limite superior da faixa, nunca acima do máximo visto
+        wanted = fraction * self.count
+        seen = 0
+        for limit, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(limit, self.max)
+        return self.max
+
+
+class Stats:
+    # Histogramas por categoria ("sql", "interface") e nome, e o log das
+    # operações lentas. Usado pela thread da interface e pelas tarefas, daí a trava.
+
+    def __init__(self, slow_log=None, slow_query=SLOW_QUERY, slow_handler=SLOW_HANDLER):
+        self.slow_log = slow_log
+        self.slow_query = slow_query
+        self.slow_handler = slow_handler
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.plans = {}
+
+    def record(self, category, name, seconds):
+        with self.lock:
+            histograms = self.histograms.setdefault(category, {})
+            histogram = histograms.get(name)
+            if histogram is None:
+                if len(histograms) >= MAX_KEYS:
+                    name = OTHER
+                histogram = histograms.setdefault(name, Histogram())
+            histogram.add(seconds)
+
+    def rows(self, category):
+        # (nome, n, média, p50, p95, máximo, total) do maior total para o menor
+        with self.lock:
+            items = list(self.histograms.get(category, {}).items())
+            rows = [(name, h.count, h.mean(), h.percentile(0.5), h.percentile(0.95), h.max, h.total)
+                    for name, h in items]
+        rows.sort(key=lambda row: row[-1], reverse=True)
+        return rows
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def log(self, text):
+        if self.slow_log is None:
+            return
+        try:
+            with open(self.slow_log, "a", encoding="UTF-8") as fh:
+                fh.write("{0} {1}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), text))
+        except EnvironmentError:
+            pass
+
+    def slow_sql(self, cursor, key, sql, params, seconds, phase="execução"):
+        # O plano é obtido uma vez por consulta distinta; os parâmetros não
+        # são gravados no log porque trazem dados de pacientes
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = "-"
+            if sql.lstrip()[:6].upper() in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+                try:
+                    explain = sqlite3.Cursor.execute(cursor.connection.cursor(),
+                                                     "EXPLAIN QUERY PLAN " + sql, params)
+                    plan = " / ".join(row[-1] for row in explain.fetchall())
+                except sqlite3.Error:
+                    pass
+            self.plans[key] = plan
+        self.log("SQL ({0}) {1:.1f} ms: {2} | plano: {3}".format(phase, seconds * 1000, key, plan))
+
+
+# Chave já calculada de cada texto de consulta
+KEYS = {}
+
+
+def statement_key(sql):
+    key = KEYS.get(sql)
+    if key is None:
+        key = PARAM_LIST.sub("?, ...", SPACES.sub(" ", sql.strip()))
+        if len(KEYS) < MAX_KEYS * 10:
+            KEYS[sql] = key
+    return key
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Mede execute e executemany e as leituras seguintes (fetch*), somando
+    # tudo na chave da última consulta. Linhas lidas iterando o cursor
+    # diretamente não entram na conta.
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._finish(sql, params, time.perf_counter() - start)
+
+    def executemany(self, sql, params):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            self._finish(sql, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._more(time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self._more(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._more(time.perf_counter() - start)
+
+    def _finish(self, sql, params, seconds):
+        stats = self.connection.stats
+        if stats is None:
+            return
+        self.last = (statement_key(sql), sql, params if params is not None else ())
+        stats.record("sql", self.last[0], seconds)
+        if seconds >= stats.slow_query:
+            stats.slow_sql(self, self.last[0], sql, self.last[2], seconds)
+
+    def _more(self, seconds):
+        stats = self.connection.stats
+        last = getattr(self, "last", None)
+        if last is None or stats is None:
+            return
+        key, sql, params = last
+        stats.record("sql", key + " [leitura]", seconds)
+        if seconds >= stats.slow_query:
+            stats.slow_sql(self, key, sql, params, seconds, "leitura")
+
+
+class TimedConnection(sqlite3.Connection):
+    # Passada como factory a sqlite3.connect; até stats ser atribuído (depois
+    # das migrações) nada é medido
+
+    stats = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            if self.stats is not None:
+                self.stats.record("sql", "COMMIT", time.perf_counter() - start)
+
+    # Os atalhos do sqlite3.Connection criariam um Cursor comum
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+
+def timed(name):
+    # Decorador para métodos da interface: soma em stats.record("interface", name)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(self, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                stats = self.stats
+                stats.record("interface", name, seconds)
+                if seconds >= stats.slow_handler:
+                    stats.log("interface {0:.1f} ms: {1}".format(seconds * 1000, name))
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+import schema
+
+# Páginas devolvidas ao sistema por transação no vácuo incremental, para
+# que as outras estações possam gravar entre uma e outra
+VACUUM_STEP = 1000
+
+# PRAGMA auto_vacuum
+INCREMENTAL = 2
+
+# Tamanho de cada tabela com os seus índices; dbstat é opcional no SQLite
+SELECT_SIZES = ("SELECT ifnull(m.tbl_name, s.name) AS tabela, "
+                "sum(CASE WHEN m.type = 'index' THEN 0 ELSE s.pgsize END) AS dados, "
+                "sum(CASE WHEN m.type = 'index' THEN s.pgsize ELSE 0 END) AS indices, "
+                "sum(s.unused) "
+                "FROM dbstat AS s LEFT JOIN sqlite_master AS m ON m.name = s.name "
+                "GROUP BY tabela ORDER BY dados + indices DESC")
+
+
+def pragma(db, name):
+    return db.execute("PRAGMA " + name).fetchone()[0]
+
+
+def file_size(db):
+    # Bytes do arquivo principal (o WAL à parte) e das páginas livres nele
+    page_size = pragma(db, "page_size")
+    return pragma(db, "page_count") * page_size, pragma(db, "freelist_count") * page_size
+
+
+def table_sizes(db):
+    # (tabela, bytes da tabela, bytes dos índices, bytes sem uso dentro das
+    # páginas), da maior para a menor, ou None se o SQLite não tem dbstat
+    try:
+        return db.execute(SELECT_SIZES).fetchall()
+    except sqlite3.OperationalError as err:
+        if "dbstat" not in str(err):
+            raise
+        return None
+
+
+def release_free_pages(db, step=VACUUM_STEP):
+    # Devolve ao sistema as páginas livres (por exemplo as que sobraram de
+    # uma importação completa), de step em step; só no modo incremental.
+    # Devolve quantas páginas saíram.
+    if pragma(db, "auto_vacuum") != INCREMENTAL:
+        return 0
+    released = 0
+    while True:
+        free = pragma(db, "freelist_count")
+        if not free:
+            return released
+        # Cada passo da instrução libera uma página, daí o fetchall
+        schema.retry_busy(lambda: db.execute("PRAGMA incremental_vacuum({0})".format(step)).fetchall())
+        db.commit()
+        released += free - pragma(db, "freelist_count")
+
+
+def maintain(db, full=False):
+    # Atualiza as estatísticas do planejador (ANALYZE), devolve as páginas
+    # livres ao sistema e trunca o WAL. Num banco criado antes do modo
+    # incremental, full faz um VACUUM completo, que reescreve o arquivo
+    # inteiro (as outras estações esperam) e passa o banco para o modo
+    # incremental, de modo que as próximas vezes não precisam dele.
+    # Devolve um dicionário com o que foi feito.
+    db.commit()
+    before, free = file_size(db)
+    result = {"antes": before, "livre": free, "vacuum": None}
+    schema.retry_busy(db.execute, "ANALYZE")
+    db.commit()
+    if pragma(db, "auto_vacuum") == INCREMENTAL:
+        release_free_pages(db)
+        result["vacuum"] = "incremental"
+    elif full:
+        db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        schema.retry_busy(db.execute, "VACUUM")
+        result["vacuum"] = "completo"
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    result["depois"] = file_size(db)[0]
+    return result
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+from indexes import SortedIndex
+
+
+class PlanoCache:
+    # Mantém em memória o mapa nome do plano -> id, carregado uma única vez,
+    # para que importação, salvamento e listagem não consultem a tabela planos
+
+    def __init__(self, db):
+        self.db = db
+        self.ids = {}
+        self.index = SortedIndex()
+        self.reload()
+
+    def reload(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT nome, id FROM planos")
+        self.ids = dict(cursor.fetchall())
+        self.index.reset(self.ids)
+
+    def clear(self):
+        self.ids = {}
+        self.index.reset(())
+
+    def get_id(self, plano):
+        return self.ids.get(plano.upper())
+
+    def get_and_set(self, plano, commit=True):
+        plano = plano.upper()
+        plano_id = self.ids.get(plano)
+        if plano_id is not None:
+            return plano_id
+        cursor = self.db.cursor()
+        cursor.execute("INSERT INTO planos (nome) VALUES (?)", (plano,))
+        plano_id = self.ids[plano] = cursor.lastrowid
+        self.index.add(plano)
+        if commit:
+            self.db.commit()
+        return plano_id
+
+    def names(self):
+        return self.index.values()
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+
+import collections
+
+import schema
+import search
+import birthdates
+import xmlio
+import formats
+import instrument
+import duplicates
+import archive
+import compact
+import maintenance
+from planos import PlanoCache
+from indexes import SortedIndex
+
+# Linhas lidas do banco por vez em iter_all
+FETCH_SIZE = 1000
+
+# Máximo de ids por consulta em get_many (o SQLite limita os parâmetros)
+MANY_CHUNK = 500
+
+# Os campos na ordem de xmlio.FIELDS, sem a codificação compacta
+SELECT_PATIENT = ("SELECT pacientes.id, " + ", ".join(map(compact.decoded, xmlio.FIELDS)) + ", planos.nome, "
+                  "pacientes.versao "
+                  "FROM pacientes, planos "
+                  "WHERE pacientes.plano_id = planos.id ")
+
+# Pacientes mantidos em memória por get (os últimos abertos)
+CACHE_SIZE = 256
+
+# Linhas por página na janela de navegação
+PAGE_SIZE = 100
+
+# Expressão de ordenação de cada coluna da navegação; todas têm índice
+BROWSE_KEYS = {
+    "registro": "pacientes.id",
+    "nome": "pacientes.nome_busca",
+    "cidade": "ifnull(pacientes.cidade, '')",
+    "plano": "planos.nome",
+}
+
+SELECT_BROWSE = ("SELECT pacientes.id, pacientes.nome, pacientes.cidade, planos.nome, {0} "
+                 "FROM pacientes, planos "
+                 "WHERE pacientes.plano_id = planos.id ")
+
+UPSERT_PATIENT = ("INSERT INTO pacientes "
+                  "(id, nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, "
+                  "celular, plano_id, nome_busca, conteudo_hash, nascimento) "
+                  "VALUES (:id, :nome, :sexo, :cartao, :dia_nasc, :mes_nasc, :ano_nasc, :endereco, :cidade, :estado, "
+                  ":cep, :telefone, :celular, :plano_id, :nome_busca, :conteudo_hash, :nascimento) "
+                  "ON CONFLICT (id) DO UPDATE SET nome=excluded.nome, sexo=excluded.sexo, cartao=excluded.cartao, "
+                  "dia_nasc=excluded.dia_nasc, mes_nasc=excluded.mes_nasc, ano_nasc=excluded.ano_nasc, "
+                  "endereco=excluded.endereco, cidade=excluded.cidade, estado=excluded.estado, cep=excluded.cep, "
+                  "telefone=excluded.telefone, celular=excluded.celular, plano_id=excluded.plano_id, "
+                  "nome_busca=excluded.nome_busca, conteudo_hash=excluded.conteudo_hash, "
+                  "nascimento=excluded.nascimento, versao=pacientes.versao + 1")
+
+# Gravação de um paciente aberto no formulário: só altera se ninguém mais o
+# gravou desde que foi lido
+UPDATE_PATIENT = ("UPDATE pacientes SET nome=:nome, sexo=:sexo, cartao=:cartao, dia_nasc=:dia_nasc, "
+                  "mes_nasc=:mes_nasc, ano_nasc=:ano_nasc, endereco=:endereco, cidade=:cidade, estado=:estado, "
+                  "cep=:cep, telefone=:telefone, celular=:celular, plano_id=:plano_id, nome_busca=:nome_busca, "
+                  "conteudo_hash=:conteudo_hash, nascimento=:nascimento, versao=versao + 1 "
+                  "WHERE id=:id AND versao=:versao")
+
+
+class ConflictError(ValueError):
+    # O paciente foi alterado ou removido por outra conexão depois de lido
+    pass
+
+
+class Patient:
+
+    __slots__ = ("id",) + xmlio.FIELDS + ("plano", "versao")
+
+    def __init__(self, nome, sexo=None, cartao=None, dia_nasc=None, mes_nasc=None, ano_nasc=None,
+                 endereco=None, cidade=None, estado=None, cep=None, telefone=None, celular=None,
+                 plano=None, id=None, versao=None):
+        self.id = id
+        self.nome = nome
+        self.sexo = sexo
+        self.cartao = cartao
+        self.dia_nasc = dia_nasc
+        self.mes_nasc = mes_nasc
+        self.ano_nasc = ano_nasc
+        self.endereco = endereco
+        self.cidade = cidade
+        self.estado = estado
+        self.cep = cep
+        self.telefone = telefone
+        self.celular = celular
+        self.plano = plano
+        # Versão lida do banco; None grava sem verificar conflito
+        self.versao = versao
+
+    @classmethod
+    def from_row(cls, row):
+        # Linha no formato de SELECT_PATIENT
+        return cls(*row[1:14], id=row[0], versao=row[14])
+
+    def fields(self):
+        return tuple(getattr(self, field) for field in xmlio.FIELDS)
+
+    def copy(self):
+        return Patient(*self.fields(), plano=self.plano, id=self.id, versao=self.versao)
+
+    def __eq__(self, other):
+        if not isinstance(other, Patient):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return "Patient(id={0!r}, nome={1!r})".format(self.id, self.nome)
+
+
+class PatientCache:
+    # Os últimos pacientes lidos por id, do menos para o mais recentemente
+    # usado. Gravações desta conexão descartam o paciente alterado; as de
+    # outras conexões (outra estação, uma importação em andamento) mudam
+    # PRAGMA data_version, e aí tudo é descartado.
+
+    def __init__(self, db, size=CACHE_SIZE):
+        self.db = db
+        self.size = size
+        self.patients = collections.OrderedDict()
+        self.data_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, identity):
+        # Uma cópia, para que alterações no Patient devolvido não cheguem aqui
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self.patients.clear()
+            self.data_version = version
+        patient = self.patients.get(identity)
+        if patient is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.patients.move_to_end(identity)
+        return patient.copy()
+
+    def put(self, patient):
+        self.patients[patient.id] = patient.copy()
+        self.patients.move_to_end(patient.id)
+        if len(self.patients) > self.size:
+            self.patients.popitem(last=False)
+
+    def discard(self, identity):
+        self.patients.pop(identity, None)
+
+    def clear(self):
+        self.patients.clear()
+
+
+class PatientRepository:
+    # Acesso ao banco de pacientes sem nenhuma dependência da interface gráfica
+
+    def __init__(self, filename, timeout=schema.BUSY_TIMEOUT, stats=None):
+        # Com stats (instrument.Stats), toda consulta feita por esta conexão é medida
+        self.filename = filename
+        self.archive_file = archive.archive_name(filename)
+        if stats is None:
+            self.db = schema.connect(filename, timeout)
+        else:
+            self.db = schema.connect(filename, timeout, instrument.TimedConnection)
+            self.db.stats = stats
+        self.planos = PlanoCache(self.db)
+        self.cache = PatientCache(self.db)
+        self.nomes = None
+        self.registros = None
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    # Índices em memória das comboboxes, carregados só quando pedidos ou,
+    # pela interface, em segundo plano (use_indexes)
+
+    def index_records(self):
+        # (nome, id) de todos os pacientes, em ordem, para load_indexes
+        cursor = self.db.cursor()
+        cursor.execute("SELECT nome, id FROM pacientes")
+        records = cursor.fetchall()
+        records.sort()
+        return records
+
+    def data_marker(self):
+        # Muda quando esta conexão ou outra grava no banco
+        return self.db.total_changes, self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def load_indexes(self, records=None):
+        # records, se dado, vem de index_records, possivelmente lido por
+        # outra conexão numa thread (ver use_indexes)
+        if records is None:
+            records = self.index_records()
+        if self.nomes is None:
+            self.nomes = SortedIndex(value=lambda key: key[0])
+            self.registros = SortedIndex()
+        self.nomes.reset(records)
+        self.registros.reset(record[1] for record in records)
+
+    def use_indexes(self, records, marker):
+        # Adota os índices lidos em segundo plano, a não ser que já tenham
+        # sido carregados ou que o banco tenha mudado depois de data_marker
+        # ter devolvido marker; devolve se foram adotados
+        if self.nomes is not None or self.data_marker() != marker:
+            return False
+        self.load_indexes(records)
+        return True
+
+    def names_index(self):
+        if self.nomes is None:
+            self.load_indexes()
+        return self.nomes
+
+    def ids_index(self):
+        if self.registros is None:
+            self.load_indexes()
+        return self.registros
+
+    def list_pac(self):
+        return self.names_index().values()
+
+    def list_id(self):
+        return self.ids_index().values()
+
+    def list_planos(self):
+        return self.planos.names()
+
+    # Consultas
+
+    def count(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pacientes")
+        return cursor.fetchone()[0]
+
+    def get(self, identity):
+        patient = self.cache.get(identity)
+        if patient is not None:
+            return patient
+        cursor = self.db.cursor()
+        cursor.execute(SELECT_PATIENT + "AND pacientes.id=?", (identity,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        patient = Patient.from_row(row)
+        self.cache.put(patient)
+        return patient
+
+    def get_many(self, identities):
+        # Devolve um dicionário id -> Patient; ids inexistentes ficam de fora
+        identities = list(identities)
+        patients = {}
+        cursor = self.db.cursor()
+        for start in range(0, len(identities), MANY_CHUNK):
+            chunk = identities[start:start + MANY_CHUNK]
+            cursor.execute(SELECT_PATIENT + "AND pacientes.id IN ({0})".format(", ".join("?" * len(chunk))), chunk)
+            for row in cursor:
+                patients[row[0]] = Patient.from_row(row)
+        return patients
+
+    def iter_all(self, order="nome"):
+        if order not in ("nome", "id"):
+            raise ValueError('Ordem inválida: {0}'.format(order))
+        cursor = self.db.cursor()
+        cursor.execute(SELECT_PATIENT + "ORDER BY pacientes.{0}".format(order))
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield Patient.from_row(row)
+
+    def browse(self, sort="nome", after=None, limit=PAGE_SIZE, descending=False):
+        # Página de (id, nome, cidade, plano, chave) na ordem da coluna sort,
+        # continuando depois de after = (chave, id) da última linha já vista.
+        # A continuação é feita em duas consultas (mesma chave com id maior,
+        # depois chaves maiores) porque assim as duas usam o índice para
+        # posicionar, e o custo não depende de quantas páginas já passaram.
+        if sort not in BROWSE_KEYS:
+            raise ValueError('Ordem inválida: {0}'.format(sort))
+        key = BROWSE_KEYS[sort]
+        op, order = ("<", "DESC") if descending else (">", "ASC")
+        select = SELECT_BROWSE.format(key)
+        cursor = self.db.cursor()
+        if after is None:
+            cursor.execute(select + "ORDER BY {0} {1}, pacientes.id {1} LIMIT ?".format(key, order), (limit,))
+            return cursor.fetchall()
+        value, identity = after
+        if sort == "registro":
+            cursor.execute(select + "AND pacientes.id {0} ? ORDER BY pacientes.id {1} LIMIT ?".format(op, order),
+                           (identity, limit))
+            return cursor.fetchall()
+        cursor.execute(select + "AND {0} = ? AND pacientes.id {1} ? ORDER BY pacientes.id {2} LIMIT ?".format(
+                       key, op, order), (value, identity, limit))
+        rows = cursor.fetchall()
+        if len(rows) < limit:
+            cursor.execute(select + "AND {0} {1} ? ORDER BY {0} {2}, pacientes.id {2} LIMIT ?".format(key, op, order),
+                           (value, limit - len(rows)))
+            rows += cursor.fetchall()
+        return rows
+
+    def find_id(self, nome, telefone):
+        cursor = self.db.cursor()
+        cursor.execute('SELECT nome, telefone, id FROM pacientes '
+                       'WHERE nome=? AND telefone=?',
+                       (nome, compact.encode_phone(telefone)))
+        records = cursor.fetchall()
+        if len(records) == 0:
+            return None
+        elif len(records) > 1:
+            raise ValueError('Nome duplicado no banco de dados')
+        else:
+            return records[0][2]
+
+    def find_by_name(self, nome):
+        cursor = self.db.cursor()
+        cursor.execute('SELECT nome, id FROM pacientes '
+                       'WHERE nome=? ORDER BY nome',
+                       (nome, ))
+        return cursor.fetchall()
+
+    # Arquivo de inativos: anexado só quando uma busca não encontra nada no
+    # banco principal, ou para arquivar
+
+    def search_archive(self, text, limit=search.TYPEAHEAD_LIMIT):
+        if not archive.attach(self.db, self.archive_file):
+            return []
+        return archive.search_archived(self.db, text, limit)
+
+    def find_archived_by_name(self, nome):
+        if not archive.attach(self.db, self.archive_file):
+            return []
+        return archive.find_archived_by_name(self.db, nome)
+
+    def count_archived(self):
+        if not archive.attach(self.db, self.archive_file):
+            return 0
+        return archive.count_archived(self.db)
+
+    def search(self, text, limit=search.TYPEAHEAD_LIMIT, offset=0):
+        return search.search_names(self.db, text, limit, offset)
+
+    def by_age(self, min_age, max_age, limit=None, today=None):
+        # (id, nome, nascimento, telefone) de quem tem de min_age a max_age
+        # anos completos, do mais novo para o mais velho
+        after, until = birthdates.age_bounds(min_age, max_age, today)
+        cursor = self.db.cursor()
+        cursor.execute("SELECT id, nome, nascimento, " + compact.decoded("telefone") + " FROM pacientes "
+                       "WHERE nascimento > ? AND nascimento <= ? ORDER BY nascimento DESC LIMIT ?",
+                       (after, until, -1 if limit is None else limit))
+        return cursor.fetchall()
+
+    def birthdays(self, days=7, today=None):
+        # (id, nome, nascimento, telefone) de quem faz aniversário de hoje
+        # até days dias depois, na ordem dos aniversários
+        rows = []
+        cursor = self.db.cursor()
+        for first, last in birthdates.birthday_ranges(days, today):
+            cursor.execute("SELECT id, nome, nascimento, " + compact.decoded("telefone") + " FROM pacientes "
+                           "WHERE substr(nascimento, 6) BETWEEN ? AND ? ORDER BY substr(nascimento, 6), nome",
+                           (first, last))
+            rows += cursor.fetchall()
+        return rows
+
+    def find_duplicates(self, threshold=duplicates.THRESHOLD, progress=None):
+        # (nota, id, id, motivos) dos prováveis duplicados ainda não marcados
+        # como pessoas diferentes; ver duplicates.find_duplicates
+        cursor = self.db.cursor()
+        cursor.execute("SELECT paciente_a, paciente_b FROM distintos")
+        return duplicates.find_duplicates(self.db, threshold, ignored=cursor.fetchall(), progress=progress)
+
+    def duplicate_pairs(self, threshold=duplicates.THRESHOLD, progress=None):
+        # Como find_duplicates, com os nomes: (nota, id, nome, id, nome, motivos)
+        rows = self.find_duplicates(threshold, progress)
+        patients = self.get_many({identity for row in rows for identity in row[1:3]})
+        return [(nota, first, patients[first].nome, second, patients[second].nome, motivos)
+                for nota, first, second, motivos in rows if first in patients and second in patients]
+
+    # Alterações
+
+    def _params(self, patient):
+        record = compact.encode(patient.fields())
+        params = dict(zip(xmlio.FIELDS, record))
+        params["id"] = patient.id
+        params["plano_id"] = self.planos.get_and_set(patient.plano or "", commit=False)
+        params["nome_busca"] = search.normalize_name(patient.nome)
+        params["conteudo_hash"] = xmlio.content_hash(record, patient.plano or "")
+        params["nascimento"] = birthdates.iso_date(patient.dia_nasc, patient.mes_nasc, patient.ano_nasc)
+        return params
+
+    def _old_name(self, cursor, identity):
+        if identity is None or self.nomes is None:
+            return None
+        cursor.execute("SELECT nome, id FROM pacientes WHERE id=?", (identity,))
+        return cursor.fetchone()
+
+    def _indexed(self, old, nome, identity):
+        if self.nomes is None:
+            return
+        if old is None:
+            self.nomes.add((nome, identity))
+            self.registros.add(identity)
+        else:
+            self.nomes.replace(old, (nome, identity))
+
+    def save(self, patient):
+        # Insere ou atualiza o paciente (pelo id) e devolve o id gravado. Se
+        # patient.versao veio do banco e outra conexão gravou depois, levanta
+        # ConflictError sem alterar nada.
+        return schema.retry_busy(self._save, patient)
+
+    def _save(self, patient):
+        cursor = self.db.cursor()
+        try:
+            old = self._old_name(cursor, patient.id)
+            params = self._params(patient)
+            if patient.id is not None and patient.versao is not None:
+                params["versao"] = patient.versao
+                cursor.execute(UPDATE_PATIENT, params)
+                if cursor.rowcount == 0:
+                    raise ConflictError('O paciente {0} foi alterado ou removido em outra estação'.format(patient.id))
+                versao = patient.versao + 1
+            else:
+                cursor.execute(UPSERT_PATIENT + " RETURNING id, versao", params)
+                identity, versao = cursor.fetchone()
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            self.planos.reload()
+            raise
+        finally:
+            self.cache.discard(patient.id)
+        if patient.id is None:
+            patient.id = identity
+        patient.versao = versao
+        self._indexed(old, patient.nome, patient.id)
+        return patient.id
+
+    def upsert_many(self, patients, batch_size=xmlio.BATCH_SIZE):
+        # Grava vários pacientes numa única transação; os que não têm id são
+        # inseridos. Não verifica a versão de cada um.
+        patients = list(patients)
+        return schema.retry_busy(self._upsert_many, patients, batch_size)
+
+    def _upsert_many(self, patients, batch_size):
+        cursor = self.db.cursor()
+        batch = []
+        count = 0
+        try:
+            for patient in patients:
+                batch.append(self._params(patient))
+                if len(batch) >= batch_size:
+                    cursor.executemany(UPSERT_PATIENT, batch)
+                    count += len(batch)
+                    batch.clear()
+            if batch:
+                cursor.executemany(UPSERT_PATIENT, batch)
+                count += len(batch)
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            self.planos.reload()
+            raise
+        finally:
+            self.cache.clear()
+        if self.nomes is not None:
+            self.load_indexes()
+        return count
+
+    def delete(self, identity):
+        return schema.retry_busy(self._delete, identity)
+
+    def _delete(self, identity):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT nome, id FROM pacientes WHERE id=?", (identity,))
+        old = cursor.fetchone()
+        try:
+            cursor.execute("DELETE FROM pacientes WHERE id=?", (identity,))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        finally:
+            self.cache.discard(identity)
+        if old is not None and self.nomes is not None:
+            self.nomes.remove(old)
+            self.registros.remove(old[1])
+        return old is not None
+
+    def mark_distinct(self, first, second):
+        # O par não volta a aparecer em find_duplicates
+        return schema.retry_busy(self._mark_distinct, min(first, second), max(first, second))
+
+    def _mark_distinct(self, first, second):
+        try:
+            self.db.execute("INSERT OR IGNORE INTO distintos (paciente_a, paciente_b) VALUES (?, ?)",
+                            (first, second))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+
+    def merge_patients(self, keep, drop):
+        # Junta dois cadastros da mesma pessoa: os campos vazios de keep são
+        # preenchidos com os de drop e drop é removido, tudo numa transação.
+        # keep e drop são Patient lidos do banco; se algum foi alterado
+        # depois de lido, levanta ConflictError sem alterar nada.
+        if keep.id is None or drop.id is None or keep.id == drop.id:
+            raise ValueError('Escolha dois pacientes diferentes já gravados')
+        return schema.retry_busy(self._merge_patients, keep, drop)
+
+    def _merge_patients(self, keep, drop):
+        merged = Patient(keep.nome, id=keep.id, versao=keep.versao)
+        for field in xmlio.FIELDS[1:]:
+            setattr(merged, field, getattr(keep, field) or getattr(drop, field))
+        merged.plano = keep.plano or drop.plano
+        cursor = self.db.cursor()
+        try:
+            params = self._params(merged)
+            params["versao"] = keep.versao
+            cursor.execute(UPDATE_PATIENT, params)
+            if cursor.rowcount == 0:
+                raise ConflictError('O paciente {0} foi alterado ou removido em outra estação'.format(keep.id))
+            cursor.execute("DELETE FROM pacientes WHERE id=? AND versao=?", (drop.id, drop.versao))
+            if cursor.rowcount == 0:
+                raise ConflictError('O paciente {0} foi alterado ou removido em outra estação'.format(drop.id))
+            cursor.execute("DELETE FROM distintos WHERE paciente_a=? OR paciente_b=?", (drop.id, drop.id))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            self.planos.reload()
+            raise
+        finally:
+            self.cache.discard(keep.id)
+            self.cache.discard(drop.id)
+        merged.versao = keep.versao + 1
+        if self.nomes is not None:
+            self.nomes.remove((drop.nome, drop.id))
+            self.registros.remove(drop.id)
+        return merged
+
+    def archive_inactive(self, days=archive.ARCHIVE_DAYS):
+        # Move para o arquivo os pacientes sem alteração há mais de days dias
+        archive.attach(self.db, self.archive_file, create=True)
+        try:
+            count = schema.retry_busy(archive.archive_patients, self.db, archive.cutoff(days))
+        finally:
+            self.cache.clear()
+        if self.nomes is not None:
+            self.load_indexes()
+        return count
+
+    def restore(self, identity):
+        # Traz de volta do arquivo e devolve o paciente, ou None se não está lá
+        if not archive.attach(self.db, self.archive_file):
+            return None
+        if not schema.retry_busy(archive.restore_patient, self.db, self.planos, identity):
+            return None
+        patient = self.get(identity)
+        if patient is not None and self.registros is not None and patient.id not in self.registros:
+            self._indexed(None, patient.nome, patient.id)
+        return patient
+
+    # Importação e exportação
+
+    def reload(self):
+        # Relê o que está em memória depois de alterações feitas por outra conexão
+        self.planos.reload()
+        self.cache.clear()
+        if self.nomes is not None:
+            self.load_indexes()
+
+    def pending_import(self, filename):
+        # Pacientes já lidos por uma importação interrompida destes
+        # arquivos, que import_file vai continuar, ou None
+        return xmlio.pending_import(self.db, xmlio.Inputs(filename))
+
+    def import_file(self, filename, progress=None, workers=1, rejects=None, resumable=True):
+        # filename pode ser uma lista (por exemplo as partes de uma exportação
+        # dividida); o formato de todos vem da extensão do primeiro. workers
+        # processos leem os XML grandes em paralelo. rejects (xmlio.Rejects)
+        # recebe os pacientes recusados; ver xmlio.import_xml.
+        fmt = self._format(filename)
+        self.cache.clear()
+        count = xmlio.import_xml(self.db, filename, self.planos, progress=progress, fmt=fmt, workers=workers,
+                                 rejects=rejects, resumable=resumable)
+        if archive.attach(self.db, self.archive_file):
+            schema.retry_busy(archive.after_import, self.db, True)
+        # O que a importação apagou e não reocupou (e a área de leitura,
+        # importacao_pacientes) volta ao sistema
+        maintenance.release_free_pages(self.db)
+        if self.nomes is not None:
+            self.load_indexes()
+        return count
+
+    def merge_file(self, filename, progress=None, workers=1, rejects=None):
+        fmt = self._format(filename)
+        self.cache.clear()
+        counts = xmlio.merge_xml(self.db, filename, self.planos, progress=progress, fmt=fmt, workers=workers,
+                                 rejects=rejects, archived=archive.attach(self.db, self.archive_file))
+        if archive.attach(self.db, self.archive_file):
+            schema.retry_busy(archive.after_import, self.db, False)
+        if self.nomes is not None:
+            self.load_indexes()
+        return counts
+
+    def export_file(self, filename, progress=None, file_rows=None):
+        # Os arquivados também vão, para que a exportação seja o cadastro inteiro
+        return xmlio.export_xml(self.db, filename, progress=progress, fmt=formats.for_filename(filename),
+                                file_rows=file_rows, archived=archive.attach(self.db, self.archive_file))
+
+    def export_changes(self, filename, since=0, progress=None):
+        # Só o que mudou depois de since: a seq devolvida pela exportação
+        # anterior (ate) ou uma data e hora ISO em UTC; ver xmlio.export_changes
+        if formats.for_filename(filename) is not xmlio.XmlFormat:
+            raise ValueError('A exportação das alterações é feita só em XML')
+        if isinstance(since, str):
+            since = xmlio.change_seq(self.db, since)
+        return xmlio.export_changes(self.db, filename, since, progress=progress,
+                                    archived=archive.attach(self.db, self.archive_file))
+
+    # Manutenção
+
+    def table_sizes(self):
+        return maintenance.table_sizes(self.db)
+
+    def maintain(self, full=False):
+        # Ver maintenance.maintain
+        return maintenance.maintain(self.db, full)
+
+    def _format(self, filenames):
+        if isinstance(filenames, str):
+            return formats.for_filename(filenames)
+        fmt = None
+        for filename in filenames:
+            if fmt not in (None, formats.for_filename(filename)):
+                raise ValueError('Arquivos em formatos diferentes')
+            fmt = formats.for_filename(filename)
+        if fmt is None:
+            raise ValueError('Nenhum arquivo para importar')
+        return fmt
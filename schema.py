@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import sqlite3
+
+import compact
+from search import normalize_name, MAX_CHAR
+from xmlio import content_hash, FIELDS, NOW, RESET_CHANGES
+from birthdates import iso_date
+
+
+def create_tables(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS planos ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL, "
+        "nome TEXT UNIQUE NOT NULL)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS pacientes ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL, "
+        "nome TEXT NOT NULL, "
+        "sexo TEXT, "
+        "cartao TEXT, "
+        "dia_nasc TEXT, "
+        "mes_nasc TEXT, "
+        "ano_nasc TEXT, "
+        "endereco TEXT, "
+        "cidade TEXT, "
+        "estado TEXT, "
+        "cep TEXT, "
+        "telefone TEXT NOT NULL, "
+        "celular TEXT, "
+        "plano_id INTEGER NOT NULL, "
+        "FOREIGN KEY (plano_id) REFERENCES planos)")
+
+
+def add_lookup_indexes(cursor):
+    # NOCASE para que o LIKE (que não diferencia maiúsculas) possa usar o índice
+    cursor.execute("CREATE INDEX IF NOT EXISTS pacientes_nome ON pacientes (nome COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS pacientes_nome_telefone ON pacientes (nome, telefone)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS pacientes_plano ON pacientes (plano_id)")
+
+
+def add_search_key(cursor):
+    cursor.execute("ALTER TABLE pacientes ADD COLUMN nome_busca TEXT")
+    cursor.execute("SELECT id, nome FROM pacientes")
+    cursor.executemany("UPDATE pacientes SET nome_busca=? WHERE id=?",
+                       [(normalize_name(nome), identity) for identity, nome in cursor.fetchall()])
+    cursor.execute("CREATE INDEX pacientes_nome_busca ON pacientes (nome_busca, id)")
+
+
+def add_browse_indexes(cursor):
+    # Ordenação por cidade na janela de navegação; o rowid no fim do índice
+    # permite continuar a página a partir de (cidade, id)
+    cursor.execute("CREATE INDEX IF NOT EXISTS pacientes_cidade ON pacientes (ifnull(cidade, ''))")
+
+
+def add_content_hash(cursor):
+    # Resumo do conteúdo de cada linha, usado pela importação incremental
+    cursor.execute("ALTER TABLE pacientes ADD COLUMN conteudo_hash TEXT")
+    cursor.execute("SELECT pacientes.id, pacientes.nome, pacientes.sexo, pacientes.cartao, pacientes.dia_nasc, "
+                   "pacientes.mes_nasc, pacientes.ano_nasc, pacientes.endereco, pacientes.cidade, pacientes.estado, "
+                   "pacientes.cep, pacientes.telefone, pacientes.celular, planos.nome "
+                   "FROM pacientes, planos WHERE pacientes.plano_id = planos.id")
+    cursor.executemany("UPDATE pacientes SET conteudo_hash=? WHERE id=?",
+                       [(content_hash(row[1:13], row[13]), row[0]) for row in cursor.fetchall()])
+
+
+def add_row_version(cursor):
+    # Incrementada a cada gravação; um UPDATE que espera a versão lida antes
+    # detecta que outra estação alterou o paciente nesse meio tempo
+    cursor.execute("ALTER TABLE pacientes ADD COLUMN versao INTEGER NOT NULL DEFAULT 1")
+
+
+def add_birth_date(cursor):
+    # Data de nascimento 'AAAA-MM-DD' (NULL se os campos não formam uma data)
+    # para consultas por idade, e o 'MM-DD' indexado para aniversários
+    cursor.execute("ALTER TABLE pacientes ADD COLUMN nascimento TEXT")
+    cursor.execute("SELECT id, dia_nasc, mes_nasc, ano_nasc FROM pacientes")
+    cursor.executemany("UPDATE pacientes SET nascimento=? WHERE id=?",
+                       [(iso_date(dia, mes, ano), identity) for identity, dia, mes, ano in cursor.fetchall()])
+    cursor.execute("CREATE INDEX pacientes_nascimento ON pacientes (nascimento)")
+    cursor.execute("CREATE INDEX pacientes_aniversario ON pacientes (substr(nascimento, 6))")
+
+
+def add_distinct_pairs(cursor):
+    # Pares que a busca de duplicados apontou e alguém marcou como pessoas
+    # diferentes, com o menor id primeiro, para não aparecerem de novo
+    cursor.execute("CREATE TABLE distintos (paciente_a INTEGER NOT NULL, paciente_b INTEGER NOT NULL, "
+                   "PRIMARY KEY (paciente_a, paciente_b)) WITHOUT ROWID")
+
+
+def add_change_log(cursor):
+    # Última alteração de cada paciente, numerada em ordem (seq), para a
+    # exportação só do que mudou (xmlio.export_changes). Uma linha por
+    # paciente: uma nova alteração substitui a anterior, e a remoção fica
+    # como removido=1. alteracoes_inicio guarda a última seq anterior à
+    # importação completa mais recente, que troca todos os registros.
+    cursor.execute("CREATE TABLE alteracoes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "paciente_id INTEGER NOT NULL UNIQUE, removido INTEGER NOT NULL DEFAULT 0, momento TEXT NOT NULL)")
+    cursor.execute("CREATE INDEX alteracoes_momento ON alteracoes (momento)")
+    cursor.execute("CREATE TABLE alteracoes_inicio (seq INTEGER NOT NULL)")
+    cursor.execute("INSERT INTO alteracoes_inicio (seq) VALUES (0)")
+    # Gatilhos, para que toda gravação (formulário, importação incremental,
+    # outros programas) entre no registro
+    for name, event, row, removido in (("pacientes_inserido", "INSERT", "NEW", 0),
+                                       ("pacientes_alterado", "UPDATE", "NEW", 0),
+                                       ("pacientes_removido", "DELETE", "OLD", 1)):
+        cursor.execute("CREATE TRIGGER {0} AFTER {1} ON pacientes BEGIN "
+                       "DELETE FROM alteracoes WHERE paciente_id = {2}.id; "
+                       "INSERT INTO alteracoes (paciente_id, removido, momento) VALUES ({2}.id, {3}, {4}); "
+                       "END".format(name, event, row, removido, NOW))
+    for sql in RESET_CHANGES:
+        cursor.execute(sql)
+
+
+def compact_fields(cursor):
+    # Grava sexo, mês, CEP e telefones na forma compacta (ver compact.py) e
+    # refaz o resumo, que é do que está gravado. Não é uma alteração dos
+    # pacientes, então o gatilho do registro de alterações sai durante a
+    # migração. O espaço liberado volta ao sistema com cadastro.py maintenance.
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='pacientes_alterado'")
+    trigger = cursor.fetchone()
+    if trigger is not None:
+        cursor.execute("DROP TRIGGER pacientes_alterado")
+    cursor.execute("SELECT pacientes.id, " + ", ".join("pacientes." + field for field in FIELDS) + ", planos.nome "
+                   "FROM pacientes, planos WHERE pacientes.plano_id = planos.id")
+    updates = []
+    for row in cursor.fetchall():
+        record = compact.encode(row[1:13])
+        if record != row[1:13]:
+            updates.append((record[compact.SEXO], record[compact.MES_NASC], record[compact.CEP],
+                            record[compact.TELEFONE], record[compact.CELULAR], content_hash(record, row[13]), row[0]))
+    cursor.executemany("UPDATE pacientes SET sexo=?, mes_nasc=?, cep=?, telefone=?, celular=?, conteudo_hash=? "
+                       "WHERE id=?", updates)
+    if trigger is not None:
+        cursor.execute(trigger[0])
+
+
+def add_import_checkpoint(cursor):
+    # A importação completa lê os pacientes para importacao_pacientes (já na
+    # forma gravada, com o nome do plano) e os recusados para
+    # importacao_rejeitados, e grava em importacao quantos já leu de quais
+    # arquivos; ver xmlio.import_xml
+    cursor.execute("CREATE TABLE importacao (arquivos TEXT NOT NULL, lidos INTEGER NOT NULL, "
+                   "gravados INTEGER NOT NULL, momento TEXT NOT NULL)")
+    cursor.execute("CREATE TABLE importacao_pacientes (id INTEGER PRIMARY KEY, "
+                   "nome TEXT, sexo TEXT, cartao TEXT, dia_nasc TEXT, mes_nasc TEXT, ano_nasc TEXT, endereco TEXT, "
+                   "cidade TEXT, estado TEXT, cep TEXT, telefone TEXT, celular TEXT, plano TEXT, "
+                   "nome_busca TEXT, conteudo_hash TEXT, nascimento TEXT)")
+    cursor.execute("CREATE TABLE importacao_rejeitados (posicao INTEGER PRIMARY KEY, motivo TEXT NOT NULL, "
+                   "campos TEXT NOT NULL)")
+
+
+# A posição na tupla é a versão gravada em PRAGMA user_version depois de aplicada
+MIGRATIONS = (create_tables, add_lookup_indexes, add_search_key, add_browse_indexes, add_content_hash,
+              add_row_version, add_birth_date, add_distinct_pairs, add_change_log, compact_fields,
+              add_import_checkpoint)
+
+# Consultas frequentes e o índice que cada uma deve usar
+HOT_QUERIES = (
+    ("find_pac_id", "SELECT nome, telefone, id FROM pacientes WHERE nome=? AND telefone=?",
+     ("", ""), "pacientes_nome_telefone"),
+    ("abrir_nome", "SELECT nome, id FROM pacientes WHERE nome=? ORDER BY nome",
+     ("",), "pacientes_nome_telefone"),
+    ("abrir", "SELECT nome, id FROM pacientes WHERE nome LIKE ? ORDER BY nome COLLATE NOCASE",
+     ("a%",), "pacientes_nome"),
+    ("plano", "SELECT id FROM pacientes WHERE plano_id=?",
+     (1,), "pacientes_plano"),
+    ("busca", "SELECT nome, id FROM pacientes WHERE nome_busca >= ? AND nome_busca < ? "
+     "ORDER BY nome_busca, id LIMIT 50", ("jo", "jo" + MAX_CHAR), "pacientes_nome_busca"),
+    ("navegar", "SELECT id FROM pacientes WHERE ifnull(cidade, '') = ? AND id > ? ORDER BY id LIMIT 100",
+     ("", 0), "pacientes_cidade"),
+    ("idade", "SELECT id FROM pacientes WHERE nascimento > ? AND nascimento <= ? ORDER BY nascimento DESC LIMIT 100",
+     ("1990-01-01", "2000-01-01"), "pacientes_nascimento"),
+    ("aniversario", "SELECT id FROM pacientes WHERE substr(nascimento, 6) BETWEEN ? AND ? "
+     "ORDER BY substr(nascimento, 6)", ("10-01", "10-07"), "pacientes_aniversario"),
+    ("alteracoes", "SELECT min(seq) FROM alteracoes INDEXED BY alteracoes_momento WHERE momento > ?",
+     ("2024-01-01",), "alteracoes_momento"),
+)
+
+
+# Segundos que uma conexão espera por outra que está gravando antes de
+# desistir com "database is locked"
+BUSY_TIMEOUT = 5.0
+
+# Novas tentativas de uma gravação que ainda assim encontrou o banco ocupado
+BUSY_RETRIES = 3
+
+
+def schema_version(db):
+    cursor = db.cursor()
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def migrate(db):
+    version = schema_version(db)
+    if version > len(MIGRATIONS):
+        raise ValueError('Banco de dados criado por uma versão mais nova do programa')
+    cursor = db.cursor()
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        # IMMEDIATE reserva a escrita antes de reler a versão, para que duas
+        # estações abrindo um banco antigo não apliquem a mesma migração
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(db) >= number:
+                db.rollback()
+                continue
+            migration(cursor)
+            cursor.execute("PRAGMA user_version = {0}".format(number))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    return len(MIGRATIONS)
+
+
+def connect(filename, timeout=BUSY_TIMEOUT, factory=sqlite3.Connection):
+    # WAL permite que várias estações leiam enquanto uma grava, sem que a
+    # leitura bloqueie a gravação; synchronous=NORMAL basta nesse modo
+    db = sqlite3.connect(filename, timeout=timeout, factory=factory)
+    # Só vale para um banco novo (antes do WAL, que já grava o arquivo):
+    # as páginas livres podem então voltar ao sistema sem o VACUUM completo
+    db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    migrate(db)
+    return db
+
+
+def is_busy(err):
+    return isinstance(err, sqlite3.OperationalError) and \
+        ("locked" in str(err) or "busy" in str(err))
+
+
+def retry_busy(function, *args, retries=BUSY_RETRIES):
+    # Repete function quando o SQLite devolve SQLITE_BUSY mesmo depois do
+    # timeout, o que acontece quando uma transação de leitura precisa virar
+    # de escrita e outra conexão gravou antes; a transação já foi desfeita
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except sqlite3.OperationalError as err:
+            if attempt == retries or not is_busy(err):
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+
+def check_query_plans(db):
+    # Devolve (nome, plano, ok) para cada consulta frequente, onde ok indica
+    # que o EXPLAIN QUERY PLAN usa o índice esperado
+    results = []
+    cursor = db.cursor()
+    for name, query, params, index in HOT_QUERIES:
+        cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+        plan = " / ".join(row[-1] for row in cursor.fetchall())
+        results.append((name, plan, index in plan))
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("uso: schema.py arquivo.sdb")
+        sys.exit(2)
+    db = connect(sys.argv[1])
+    print("versão do esquema: {0}".format(schema_version(db)))
+    failed = False
+    for name, plan, ok in check_query_plans(db):
+        print("{0:12} {1:4} {2}".format(name, "ok" if ok else "FALHA", plan))
+        failed = failed or not ok
+    db.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import re
+import unicodedata
+
+# Resultados mostrados na lista da combobox enquanto o usuário digita
+TYPEAHEAD_LIMIT = 50
+
+# Maior caractere Unicode, usado como limite superior da faixa de prefixo
+MAX_CHAR = "\U0010ffff"
+
+# Blocos de marcas combinantes (acentos) que sobram depois da decomposição NFKD
+COMBINING = re.compile("[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]")
+
+
+def normalize_name(nome):
+    # "José  da Silva" -> "jose da silva": sem acentos, sem diferença entre
+    # maiúsculas e minúsculas e com espaços simples
+    if nome is None:
+        return None
+    if not nome.isascii():
+        nome = COMBINING.sub("", unicodedata.normalize("NFKD", nome))
+    return " ".join(nome.casefold().split())
+
+
+def search_names(db, text, limit=TYPEAHEAD_LIMIT, offset=0):
+    # Busca por prefixo do nome normalizado, percorrendo só a faixa do índice
+    # pacientes_nome_busca. A correspondência exata vem primeiro, pois é a
+    # menor chave da faixa; depois os demais em ordem alfabética.
+    # Devolve uma lista de (nome, id).
+    key = normalize_name(text)
+    if not key:
+        return []
+    cursor = db.cursor()
+    cursor.execute("SELECT nome, id FROM pacientes "
+                   "WHERE nome_busca >= ? AND nome_busca < ? "
+                   "ORDER BY nome_busca, id LIMIT ? OFFSET ?",
+                   (key, key + MAX_CHAR, limit, offset))
+    return cursor.fetchall()
+
+
+def exact_match(records, text):
+    # Entre os resultados de search_names, devolve o único cujo nome
+    # corresponde exatamente ao texto digitado, ou None
+    key = normalize_name(text)
+    matches = [record for record in records if normalize_name(record[0]) == key]
+    return matches[0] if len(matches) == 1 else None
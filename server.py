@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import shutil
+import asyncio
+import sqlite3
+import tempfile
+import threading
+import traceback
+import urllib.parse
+import concurrent.futures
+
+import schema
+import instrument
+import formats
+import xmlio
+from repository import ConflictError, Patient, PatientRepository
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Conexões de leitura; as gravações passam todas por uma única conexão
+READERS = 4
+
+# Maior corpo JSON aceito; arquivos importados vão direto para o disco
+MAX_BODY = 1 << 20
+COPY_CHUNK = 1 << 16
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+PATIENT_KEYS = xmlio.FIELDS + ("plano", "id", "versao")
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def patient_to_json(patient):
+    return {key: getattr(patient, key) for key in PATIENT_KEYS}
+
+
+def patient_from_json(data):
+    if not isinstance(data, dict) or not isinstance(data.get("nome"), str):
+        raise ValueError('Paciente sem nome')
+    return Patient(**{key: data.get(key) for key in PATIENT_KEYS})
+
+
+class RejectList(xmlio.Rejects):
+    # Recusados da importação guardados para a resposta, em vez de num arquivo
+
+    def __init__(self):
+        super().__init__(None)
+        self.rows = []
+
+    def write(self, rows):
+        self.rows = [list(row) for row in rows]
+        self.count = len(self.rows)
+
+
+class Request:
+
+    def __init__(self, method, target, headers):
+        self.method = method
+        parts = urllib.parse.urlsplit(target)
+        self.path = urllib.parse.unquote(parts.path)
+        self.query = {name: values[0]
+                      for name, values in urllib.parse.parse_qs(parts.query, keep_blank_values=True).items()}
+        self.headers = headers
+        self.body = b""
+        self.upload = None
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise ValueError('Corpo da requisição não é JSON')
+
+    def json_object(self):
+        # Corpo que precisa ser um objeto JSON (null, lista ou número é 400)
+        data = self.json()
+        if not isinstance(data, dict):
+            raise ValueError('Corpo da requisição não é um objeto JSON')
+        return data
+
+    def integer(self, name, default=None):
+        value = self.query.get(name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('Parâmetro {0} inválido: {1}'.format(name, value))
+
+
+class Service:
+    # Serviço HTTP/JSON para as estações: uma conexão grava (uma thread só,
+    # então as gravações nunca disputam o banco entre si) e um grupo de
+    # conexões somente leitura atende as consultas. O SQLite bloqueia, por
+    # isso cada acesso roda numa thread do grupo e o laço asyncio só cuida
+    # das conexões de rede.
+
+    def __init__(self, filename, readers=READERS, timeout=None):
+        self.filename = filename
+        self.timeout = schema.BUSY_TIMEOUT if timeout is None else timeout
+        self.stats = instrument.Stats(slow_log=os.path.splitext(filename)[0] + '-servidor-lento.log')
+        self.local = threading.local()
+        self.writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="gravador")
+        self.readers = concurrent.futures.ThreadPoolExecutor(readers, thread_name_prefix="leitor")
+        # Identifica esta execução nas versões dos índices enviadas aos clientes
+        self.started = int(time.time() * 1000)
+        self.data_version = None
+        self.routes = [(method, re.compile(pattern + "$"), name, handler, upload)
+                       for method, pattern, name, handler, upload in (
+            ("GET", r"/pacientes", "GET /pacientes", self.find, False),
+            ("POST", r"/pacientes", "POST /pacientes", self.save, False),
+            ("GET", r"/pacientes/(\d+)", "GET /pacientes/{id}", self.get, False),
+            ("PUT", r"/pacientes/(\d+)", "PUT /pacientes/{id}", self.save, False),
+            ("DELETE", r"/pacientes/(\d+)", "DELETE /pacientes/{id}", self.delete, False),
+            ("GET", r"/arquivo", "GET /arquivo", self.find_archived, False),
+            ("POST", r"/arquivo", "POST /arquivo", self.archive, False),
+            ("GET", r"/navegar", "GET /navegar", self.browse, False),
+            ("GET", r"/indices", "GET /indices", self.indexes, False),
+            ("GET", r"/planos", "GET /planos", self.planos, False),
+            ("GET", r"/duplicados", "GET /duplicados", self.duplicates, False),
+            ("POST", r"/duplicados/mesclar", "POST /duplicados/mesclar", self.merge_patients, False),
+            ("POST", r"/duplicados/distintos", "POST /duplicados/distintos", self.mark_distinct, False),
+            ("POST", r"/importar", "POST /importar", self.import_file, True),
+            ("GET", r"/exportar", "GET /exportar", self.export_file, False),
+            ("GET", r"/estatisticas", "GET /estatisticas", self.statistics, False),
+        )]
+
+    # Conexões
+
+    def _repo(self, read_only):
+        repo = getattr(self.local, "repo", None)
+        if repo is None:
+            repo = self.local.repo = PatientRepository(self.filename, self.timeout, self.stats)
+            if read_only:
+                repo.db.execute("PRAGMA query_only=ON")
+        return repo
+
+    def _run(self, read_only, function, args):
+        return function(self._repo(read_only), *args)
+
+    async def read(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._run, True, function, args)
+
+    async def write(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._run, False, function, args)
+
+    def close(self):
+        # A conexão de gravação é fechada na própria thread; as de leitura
+        # não têm nada pendente e fecham com o processo
+        def close_writer():
+            repo = getattr(self.local, "repo", None)
+            if repo is not None:
+                repo.close()
+        self.writer.submit(close_writer).result()
+        self.writer.shutdown()
+        self.readers.shutdown()
+
+    # Pacientes
+
+    async def find(self, request):
+        query = request.query
+        if "busca" in query:
+            return await self.read(lambda repo: repo.search(query["busca"], request.integer("limite", 50),
+                                                            request.integer("deslocamento", 0)))
+        if "nome" in query and "telefone" in query:
+            identity = await self.read(lambda repo: repo.find_id(query["nome"], query["telefone"]))
+            return {"id": identity}
+        if "nome" in query:
+            return await self.read(lambda repo: repo.find_by_name(query["nome"]))
+        raise ValueError('Informe busca, nome ou nome e telefone')
+
+    async def get(self, request, identity):
+        identity = int(identity)
+        patient = await self.read(lambda repo: repo.get(identity))
+        if patient is None and request.query.get("restaurar"):
+            patient = await self.write(lambda repo: repo.restore(identity))
+        if patient is None:
+            raise HttpError(404, 'Registro {0} não encontrado'.format(identity))
+        return patient_to_json(patient)
+
+    async def save(self, request, identity=None):
+        patient = patient_from_json(request.json())
+        if identity is not None:
+            patient.id = int(identity)
+        await self.write(lambda repo: repo.save(patient))
+        return {"id": patient.id, "versao": patient.versao}
+
+    async def delete(self, request, identity):
+        removed = await self.write(lambda repo: repo.delete(int(identity)))
+        return {"removido": removed}
+
+    async def browse(self, request):
+        after = request.query.get("depois")
+        after = json.loads(after) if after else None
+        return await self.read(lambda repo: repo.browse(request.query.get("ordem", "nome"), after,
+                                                        request.integer("limite", 100),
+                                                        bool(request.integer("desc", 0))))
+
+    def _indexes(self, repo, version):
+        # Na conexão de gravação, que mantém os índices em dia com o que ela
+        # mesma grava; gravações de fora (outra estação usando o arquivo
+        # direto) mudam PRAGMA data_version e os índices são relidos
+        data_version = repo.db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.data_version:
+            if self.data_version is not None:
+                repo.reload()
+            self.data_version = data_version
+        names = repo.names_index()
+        current = "{0}-{1}".format(self.started, names.version)
+        if version == current:
+            return {"versao": current}
+        return {"versao": current, "nomes": list(names), "registros": list(repo.ids_index())}
+
+    async def indexes(self, request):
+        return await self.write(self._indexes, request.query.get("versao"))
+
+    async def planos(self, request):
+        return await self.write(lambda repo: list(repo.list_planos()))
+
+    # Arquivo de inativos e duplicados
+
+    async def find_archived(self, request):
+        if "nome" in request.query:
+            return await self.read(lambda repo: repo.find_archived_by_name(request.query["nome"]))
+        return await self.read(lambda repo: repo.search_archive(request.query.get("busca", ""),
+                                                                request.integer("limite", 50)))
+
+    async def archive(self, request):
+        days = request.json_object().get("dias")
+        return {"arquivados": await self.write(lambda repo: repo.archive_inactive(int(days)))}
+
+    async def duplicates(self, request):
+        threshold = float(request.query.get("nota", 0.7))
+        return await self.read(lambda repo: repo.duplicate_pairs(threshold))
+
+    async def merge_patients(self, request):
+        data = request.json_object()
+        def merge(repo):
+            identities = int(data["manter"]), int(data["remover"])
+            keep, drop = repo.get(identities[0]), repo.get(identities[1])
+            if keep is None or drop is None:
+                raise ConflictError('O paciente {0} foi alterado ou removido em outra estação'.format(
+                    identities[0] if keep is None else identities[1]))
+            # A verificação de versão vale para o que o cliente viu
+            keep.versao, drop.versao = data.get("versao_manter", keep.versao), data.get("versao_remover", drop.versao)
+            return repo.merge_patients(keep, drop)
+        return patient_to_json(await self.write(merge))
+
+    async def mark_distinct(self, request):
+        data = request.json_object()
+        await self.write(lambda repo: repo.mark_distinct(int(data["a"]), int(data["b"])))
+        return {}
+
+    # Importação e exportação
+
+    async def import_file(self, request):
+        # Os recusados voltam na resposta (recusados), para o cliente gravar
+        # o arquivo dele; o arquivo enviado é apagado no final, e por isso a
+        # importação não pode ser retomada: se falhar, não deixa nada lido
+        workers = request.integer("processos", 1)
+        rejects = RejectList()
+        if request.integer("mesclar", 0):
+            result = await self.write(lambda repo: repo.merge_file(request.upload, workers=workers, rejects=rejects))
+        else:
+            result = {"pacientes": await self.write(lambda repo: repo.import_file(request.upload, workers=workers,
+                                                                                  rejects=rejects, resumable=False))}
+        result["recusados"] = rejects.rows
+        return result
+
+    async def export_file(self, request):
+        # Exporta num diretório temporário e devolve o caminho; handle envia
+        # o arquivo e apaga o diretório
+        name = os.path.basename(request.query.get("nome", "patients.xml"))
+        formats.for_filename(name)
+        directory = tempfile.mkdtemp(prefix="exportar-")
+        filename = os.path.join(directory, name)
+        try:
+            await self.read(lambda repo: repo.export_file(filename))
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return filename
+
+    async def statistics(self, request):
+        return {category: self.stats.rows(category) for category in ("servidor", "sql")}
+
+    # HTTP
+
+    def route(self, method, path):
+        allowed = False
+        for route_method, pattern, name, handler, upload in self.routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            if route_method == method:
+                return name, handler, upload, match.groups()
+            allowed = True
+        if allowed:
+            raise HttpError(405, 'Método {0} não aceito em {1}'.format(method, path))
+        raise HttpError(404, 'Caminho desconhecido: {0}'.format(path))
+
+    async def handle(self, reader, writer):
+        # Uma conexão pode levar várias requisições (keep-alive do HTTP/1.1)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                keep_alive = await self.handle_request(line, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, line, reader, writer):
+        start = time.perf_counter()
+        name = None
+        upload = None
+        # Um erro antes de ler o corpo deixa o corpo na conexão, onde seria
+        # lido como a próxima requisição: a conexão é fechada
+        keep_alive = False
+        consumed = False
+        try:
+            parts = line.decode("latin-1").split()
+            if len(parts) != 3:
+                raise HttpError(400, 'Requisição inválida')
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                key, separator, value = header.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            request = Request(parts[0], parts[1], headers)
+            keep_alive = parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+            length = int(headers.get("content-length", 0) or 0)
+            name, handler, is_upload, groups = self.route(request.method, request.path)
+            if is_upload:
+                upload = request.upload = await self.receive_file(reader, length, request.query.get("nome", ""))
+            elif length > MAX_BODY:
+                raise HttpError(413, 'Corpo da requisição muito grande')
+            else:
+                request.body = await reader.readexactly(length)
+            consumed = True
+            status, payload = 200, await handler(request, *groups)
+        except HttpError as err:
+            status, payload, keep_alive = err.status, {"erro": str(err)}, False
+        except ConflictError as err:
+            status, payload = 409, {"erro": str(err)}
+        except (ValueError, KeyError, TypeError) as err:
+            status, payload = 400, {"erro": str(err)}
+        except sqlite3.OperationalError as err:
+            status, payload = (503 if schema.is_busy(err) else 500), {"erro": str(err)}
+        except Exception as err:
+            self.stats.log("erro em {0}: {1}".format(name or line.decode("latin-1").strip(),
+                                                     traceback.format_exc().replace("\n", " | ")))
+            status, payload = 500, {"erro": str(err)}
+        finally:
+            if upload is not None:
+                shutil.rmtree(os.path.dirname(upload), ignore_errors=True)
+        keep_alive = keep_alive and consumed
+        try:
+            await self.respond(writer, status, payload, keep_alive)
+        finally:
+            seconds = time.perf_counter() - start
+            self.stats.record("servidor", name or "(inválida)", seconds)
+            if seconds >= self.stats.slow_handler:
+                self.stats.log("servidor {0:.1f} ms: {1}".format(seconds * 1000, name))
+        return keep_alive
+
+    async def receive_file(self, reader, length, name):
+        # O corpo vai em partes para um arquivo temporário com a extensão do
+        # original, de onde o formato é deduzido
+        name = os.path.basename(name)
+        formats.for_filename(name)
+        directory = tempfile.mkdtemp(prefix="importar-")
+        filename = os.path.join(directory, name)
+        try:
+            with open(filename, "wb") as fh:
+                while length > 0:
+                    data = await reader.read(min(length, COPY_CHUNK))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b"", length)
+                    fh.write(data)
+                    length -= len(data)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return filename
+
+    async def respond(self, writer, status, payload, keep_alive):
+        head = "HTTP/1.1 {0} {1}\r\nConnection: {2}\r\n".format(status, REASONS.get(status, ""),
+                                                                "keep-alive" if keep_alive else "close")
+        if isinstance(payload, str):
+            # Arquivo exportado
+            try:
+                size = os.path.getsize(payload)
+                writer.write((head + "Content-Type: application/octet-stream\r\nContent-Length: {0}\r\n\r\n".format(
+                    size)).encode("latin-1"))
+                with open(payload, "rb") as fh:
+                    while True:
+                        data = fh.read(COPY_CHUNK)
+                        if not data:
+                            break
+                        writer.write(data)
+                        await writer.drain()
+            finally:
+                shutil.rmtree(os.path.dirname(payload), ignore_errors=True)
+            return
+        body = json.dumps(payload, ensure_ascii=False).encode("UTF-8")
+        writer.write((head + "Content-Type: application/json; charset=utf-8\r\nContent-Length: {0}\r\n\r\n".format(
+            len(body))).encode("latin-1") + body)
+        await writer.drain()
+
+
+async def run(service, host, port, ready=None):
+    server = await asyncio.start_server(service.handle, host, port)
+    address = server.sockets[0].getsockname()
+    if ready is not None:
+        ready("http://{0}:{1}".format(address[0], address[1]))
+    async with server:
+        await server.serve_forever()
+
+
+def serve(filename, host=DEFAULT_HOST, port=DEFAULT_PORT, readers=READERS, ready=None, timeout=None):
+    # Roda até Ctrl+C; ready(url) é chamado quando já aceita conexões (com
+    # port=0 a porta é escolhida pelo sistema). timeout: segundos de espera
+    # das conexões quando outro programa está gravando no banco
+    service = Service(filename, readers, timeout)
+    try:
+        asyncio.run(run(service, host, port, ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+from repository import Patient, PatientRepository
+
+
+class ArchiveTest(unittest.TestCase):
+    # Arquivo de inativos (archive) usado pelo PatientRepository
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        self.ana = self.repo.save(Patient("Ana", telefone="1111-1111", plano="UNIMED"))
+        self.bia = self.repo.save(Patient("Bia", telefone="2222-2222", plano="UNIMED"))
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def age(self, *identities):
+        # Faz as últimas alterações destes pacientes parecerem antigas
+        self.repo.db.executemany("UPDATE alteracoes SET momento = '2000-01-01T00:00:00.000Z' WHERE paciente_id = ?",
+                                 [(identity,) for identity in identities])
+        self.repo.db.commit()
+
+    def exported_names(self):
+        filename = os.path.join(self.directory.name, "exportado.xml")
+        self.repo.export_file(filename)
+        return sorted(pac.text for pac in xml.etree.ElementTree.parse(filename).getroot())
+
+    def write(self, name, content):
+        filename = os.path.join(self.directory.name, name)
+        with open(filename, "w", encoding="UTF-8") as fh:
+            fh.write(content)
+        return filename
+
+    def test_archive_export_restore_round_trip(self):
+        patient = self.repo.get(self.ana)
+        patient.cidade = "Recife"
+        self.repo.save(patient)
+        before = self.repo.get(self.ana)
+        self.age(self.ana)
+        self.assertEqual(self.repo.archive_inactive(30), 1)
+        self.assertIsNone(self.repo.get(self.ana))
+        self.assertEqual(self.repo.count(), 1)
+        self.assertEqual(self.repo.count_archived(), 1)
+        self.assertEqual(self.repo.search_archive("an"), [("Ana", self.ana)])
+        self.assertEqual(self.exported_names(), ["Ana", "Bia"])
+
+        restored = self.repo.restore(self.ana)
+        self.assertEqual(restored, before)
+        self.assertEqual(self.repo.count_archived(), 0)
+        self.assertIsNone(self.repo.restore(self.ana))
+        self.assertEqual(self.exported_names(), ["Ana", "Bia"])
+
+    def test_full_import_keeps_archive(self):
+        self.age(self.ana)
+        self.repo.archive_inactive(30)
+        filename = os.path.join(self.directory.name, "completo.xml")
+        self.repo.export_file(filename)
+        self.repo.import_file(self.write("so_bia.xml", '<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n'
+                                         '<pac plano="UNIMED" telefone="2222-2222">Bia</pac>\n</pacientes>\n'))
+        self.assertEqual(self.repo.count_archived(), 1)
+        self.assertEqual(self.exported_names(), ["Ana", "Bia"])
+        # O arquivo completo traz Ana de volta, e ela sai do arquivo
+        self.repo.import_file(filename)
+        self.assertEqual(self.repo.count_archived(), 0)
+        self.assertEqual(self.repo.count(), 2)
+
+    def test_merge_with_archived_registro_releases_archive_copy(self):
+        self.age(self.ana)
+        self.assertEqual(self.repo.archive_inactive(30), 1)
+        filename = self.write("volta.xml", '<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n'
+                              '<pac plano="UNIMED" telefone="3333-3333" registro="{0}">Ana Maria</pac>\n'
+                              '<pac plano="UNIMED" telefone="2222-2222">Bia</pac>\n</pacientes>\n'.format(self.ana))
+        counts = self.repo.merge_file(filename)
+        self.assertEqual(counts["inseridos"], 1)
+        self.assertEqual(self.repo.count_archived(), 0)
+        self.assertEqual(self.repo.get(self.ana).nome, "Ana Maria")
+        self.assertEqual(self.exported_names(), ["Ana Maria", "Bia"])
+
+    def test_patient_edited_while_archiving_is_not_exported_twice(self):
+        # A primeira transação de archive_patients já copiou Ana quando
+        # outra estação a altera
+        self.age(self.ana)
+        archive.attach(self.repo.db, self.repo.archive_file, create=True)
+        self.repo.db.execute(archive.ARCHIVE_PATIENTS, (archive.cutoff(30),))
+        self.repo.db.commit()
+        patient = self.repo.get(self.ana)
+        patient.cidade = "Recife"
+        self.repo.save(patient)
+        self.assertEqual(self.repo.archive_inactive(30), 0)
+        self.assertEqual(self.repo.count_archived(), 0)
+        self.assertEqual(self.exported_names(), ["Ana", "Bia"])
+
+    def test_restore_conflict_is_reported(self):
+        self.age(self.ana)
+        self.repo.archive_inactive(30)
+        # Arquivado pela metade: o paciente voltou ao banco principal, mas a
+        # cópia continua no arquivo
+        self.repo.db.execute("INSERT INTO main.pacientes (id, nome, telefone, plano_id) "
+                             "SELECT id, nome, telefone, (SELECT min(id) FROM planos) FROM arquivo.pacientes")
+        self.repo.db.commit()
+        with self.assertRaises(ValueError):
+            self.repo.restore(self.ana)
+        self.assertEqual(self.repo.count_archived(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import datetime
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import birthdates
+from repository import Patient, PatientRepository
+
+
+def date(text):
+    return datetime.date.fromisoformat(text)
+
+
+class IsoDateTest(unittest.TestCase):
+
+    def test_month_names_and_numbers(self):
+        self.assertEqual(birthdates.iso_date("5", "Março", "1980"), "1980-03-05")
+        self.assertEqual(birthdates.iso_date(" 05 ", "marco", "1980 "), "1980-03-05")
+        self.assertEqual(birthdates.iso_date("5", "03", "1980"), "1980-03-05")
+
+    def test_invalid_dates(self):
+        self.assertEqual(birthdates.iso_date("29", "Fevereiro", "2000"), "2000-02-29")
+        self.assertIsNone(birthdates.iso_date("29", "Fevereiro", "1900"))
+        self.assertIsNone(birthdates.iso_date("31", "Abril", "1980"))
+        self.assertIsNone(birthdates.iso_date("5", "Março", "80"))
+        self.assertIsNone(birthdates.iso_date("5", "Marcha", "1980"))
+        self.assertIsNone(birthdates.iso_date(None, "Março", "1980"))
+
+
+class AgeTest(unittest.TestCase):
+
+    def test_age_on_birthday(self):
+        self.assertEqual(birthdates.age("1980-03-05", date("2020-03-04")), 39)
+        self.assertEqual(birthdates.age("1980-03-05", date("2020-03-05")), 40)
+
+    def test_leap_day_birth(self):
+        # Em ano comum, quem nasceu em 29 de fevereiro faz anos em 1º de março
+        self.assertEqual(birthdates.age("2000-02-29", date("2021-02-28")), 20)
+        self.assertEqual(birthdates.age("2000-02-29", date("2021-03-01")), 21)
+        self.assertEqual(birthdates.age("2000-02-29", date("2024-02-29")), 24)
+
+    def test_bounds_agree_with_age(self):
+        born = [date("1999-12-31") + datetime.timedelta(days=days) for days in range(0, 3 * 366 + 5, 7)]
+        born += [date("2000-02-29"), date("2000-02-28"), date("2000-03-01"), date("2001-02-28")]
+        for today in (date("2021-02-28"), date("2021-03-01"), date("2024-02-29"), date("2022-12-31")):
+            for min_age, max_age in ((20, 20), (0, 21), (21, 22)):
+                after, until = birthdates.age_bounds(min_age, max_age, today)
+                for day in born:
+                    nascimento = day.isoformat()
+                    self.assertEqual(after < nascimento <= until,
+                                     min_age <= birthdates.age(nascimento, today) <= max_age,
+                                     (today, min_age, max_age, nascimento))
+
+
+class BirthdayRangesTest(unittest.TestCase):
+
+    def test_within_the_year(self):
+        self.assertEqual(birthdates.birthday_ranges(7, date("2021-06-10")), [("06-10", "06-16")])
+        self.assertEqual(birthdates.birthday_ranges(1, date("2021-06-10")), [("06-10", "06-10")])
+        self.assertEqual(birthdates.birthday_ranges(0, date("2021-06-10")), [])
+
+    def test_new_year_wrap(self):
+        self.assertEqual(birthdates.birthday_ranges(7, date("2021-12-28")), [("12-28", "12-31"), ("01-01", "01-03")])
+        self.assertEqual(birthdates.birthday_ranges(365, date("2021-01-01")), [("01-01", "12-31")])
+        self.assertEqual(birthdates.birthday_ranges(400, date("2021-07-01")), [("07-01", "12-31"), ("01-01", "06-30")])
+
+    def test_leap_day_in_common_year(self):
+        self.assertEqual(birthdates.birthday_ranges(2, date("2021-02-27")), [("02-27", "02-29")])
+        self.assertEqual(birthdates.birthday_ranges(1, date("2021-02-28")), [("02-28", "02-29")])
+        self.assertEqual(birthdates.birthday_ranges(1, date("2024-02-28")), [("02-28", "02-28")])
+        self.assertEqual(birthdates.birthday_ranges(365, date("2021-03-01")), [("03-01", "12-31"), ("01-01", "02-29")])
+
+
+class QueryTest(unittest.TestCase):
+    # by_age e birthdays no banco, com o índice de nascimento
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        for nome, dia, mes, ano in (("Ana", "29", "Fevereiro", "2000"), ("Bia", "1", "Janeiro", "2001"),
+                                    ("Caio", "31", "Dezembro", "1990"), ("Davi", None, None, None)):
+            self.repo.save(Patient(nome, dia_nasc=dia, mes_nasc=mes, ano_nasc=ano, telefone="1111-1111",
+                                   plano="UNIMED"))
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def test_by_age(self):
+        rows = self.repo.by_age(20, 21, today=date("2021-02-28"))
+        self.assertEqual([row[1] for row in rows], ["Bia", "Ana"])
+        self.assertEqual([row[1] for row in self.repo.by_age(30, 40, today=date("2021-02-28"))], ["Caio"])
+
+    def test_birthdays(self):
+        rows = self.repo.birthdays(3, today=date("2020-12-30"))
+        self.assertEqual([(row[1], row[2]) for row in rows], [("Caio", "1990-12-31"), ("Bia", "2001-01-01")])
+        self.assertEqual([row[1] for row in self.repo.birthdays(1, today=date("2021-02-28"))], ["Ana"])
+        self.assertEqual(self.repo.birthdays(1, today=date("2021-03-01")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import Patient, PatientRepository
+
+
+class ExportChangesTest(unittest.TestCase):
+    # Exportação das alterações (xmlio.export_changes)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        self.ana = self.repo.save(Patient("Ana", telefone="1111-1111", plano="UNIMED"))
+        self.bia = self.repo.save(Patient("Bia", telefone="2222-2222", plano="UNIMED"))
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def changes(self, since):
+        # (desde, ate, completo, [(tag, registro, nome)]) do arquivo exportado
+        filename = os.path.join(self.directory.name, "alteracoes.xml")
+        count, last = self.repo.export_changes(filename, since)
+        root = xml.etree.ElementTree.parse(filename).getroot()
+        self.assertEqual(int(root.get("ate")), last)
+        self.assertEqual(len(root), count)
+        return (int(root.get("desde")), last, root.get("completo"),
+                [(element.tag, int(element.get("registro")), element.text) for element in root])
+
+    def test_first_export_is_complete(self):
+        since, last, complete, elements = self.changes(0)
+        self.assertEqual(complete, "1")
+        self.assertEqual(elements, [("pac", self.ana, "Ana"), ("pac", self.bia, "Bia")])
+
+    def test_changes_and_tombstones(self):
+        last = self.changes(0)[1]
+        patient = self.repo.get(self.bia)
+        patient.cidade = "Recife"
+        self.repo.save(patient)
+        self.repo.delete(self.ana)
+        carlos = self.repo.save(Patient("Carlos", telefone="3333-3333", plano="SUS"))
+        since, until, complete, elements = self.changes(last)
+        self.assertEqual((since, complete), (last, "0"))
+        self.assertEqual(elements, [("pac", self.bia, "Bia"), ("removido", self.ana, None),
+                                    ("pac", carlos, "Carlos")])
+        # Nada mudou desde a última exportação
+        self.assertEqual(self.changes(until)[2:], ("0", []))
+
+    def test_full_import_makes_older_cursors_complete(self):
+        last = self.changes(0)[1]
+        filename = os.path.join(self.directory.name, "pacientes.xml")
+        self.repo.export_file(filename)
+        self.repo.import_file(filename)
+        since, until, complete, elements = self.changes(last)
+        self.assertEqual(complete, "1")
+        self.assertEqual([element[2] for element in elements], ["Ana", "Bia"])
+        self.assertEqual(self.changes(until)[2:], ("0", []))
+
+    def test_date_cursor_with_clocks_out_of_step(self):
+        # Ana foi gravada por uma estação adiantada, Bia depois por uma atrasada
+        self.repo.db.execute("UPDATE alteracoes SET momento = '2030-01-01T10:00:00.000Z' WHERE paciente_id = ?",
+                             (self.ana,))
+        self.repo.db.execute("UPDATE alteracoes SET momento = '2030-01-01T09:00:00.000Z' WHERE paciente_id = ?",
+                             (self.bia,))
+        self.repo.db.commit()
+        elements = self.changes("2030-01-01T08:00:00")[3]
+        self.assertEqual([element[2] for element in elements], ["Ana", "Bia"])
+        self.assertEqual(self.changes("2030-01-01T09:30:00")[3][0][2], "Ana")
+        since, last = self.changes("2031-01-01")[:2]
+        self.assertEqual(since, last)
+
+
+if __name__ == "__main__":
+    unittest.main()
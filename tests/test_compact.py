@@ -0,0 +1,71 @@
+import os
+import sys
+import sqlite3
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compact
+import xmlio
+
+
+class CompactTest(unittest.TestCase):
+    # compact.encode na gravação e compact.decoded na leitura
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE pacientes ({0})".format(", ".join(xmlio.FIELDS)))
+
+    def tearDown(self):
+        self.db.close()
+
+    def round_trip(self, record):
+        encoded = compact.encode(record)
+        self.db.execute("DELETE FROM pacientes")
+        self.db.execute("INSERT INTO pacientes VALUES ({0})".format(", ".join("?" * len(encoded))), encoded)
+        columns = ", ".join(compact.decoded(field) for field in xmlio.FIELDS)
+        return encoded, self.db.execute("SELECT " + columns + " FROM pacientes").fetchone()
+
+    def record(self, **fields):
+        return tuple(fields.get(field) for field in xmlio.FIELDS)
+
+    def test_usual_values_are_compacted(self):
+        record = self.record(nome="Ana", sexo="Feminino", dia_nasc="5", mes_nasc="Março", ano_nasc="1980",
+                             cep="50000-000", telefone="(81) 3333-4444", celular="99999-8888")
+        encoded, decoded = self.round_trip(record)
+        self.assertEqual([encoded[i] for i in (compact.SEXO, compact.MES_NASC, compact.CEP, compact.TELEFONE,
+                                               compact.CELULAR)], ["2", "3", "50000000", "8133334444", "999998888"])
+        self.assertEqual(decoded, record)
+
+    def test_every_phone_size_and_month(self):
+        for typed, shown in (("3333 4444", "3333-4444"), ("9.9999.8888", "99999-8888"),
+                             ("81 3333-4444", "(81) 3333-4444"), ("(81)99999 8888", "(81) 99999-8888")):
+            self.assertEqual(self.round_trip(self.record(telefone=typed))[1][compact.TELEFONE], shown)
+        for month in compact.MONTHS:
+            self.assertEqual(self.round_trip(self.record(mes_nasc=month))[1][compact.MES_NASC], month)
+
+    def test_values_outside_the_patterns_are_kept(self):
+        record = self.record(nome="Bia", sexo="Outro", mes_nasc="Marco", cep="50.000-00",
+                             telefone="ramal 12", celular="+55 81 99999-8888")
+        encoded, decoded = self.round_trip(record)
+        self.assertEqual(encoded, record)
+        self.assertEqual(decoded, record)
+        for value in ("", "123-4567", "-", "0800 123 4567 9"):
+            record = self.record(telefone=value, cep=value)
+            self.assertEqual(self.round_trip(record), (record, record))
+
+    def test_phones_starting_with_zero(self):
+        for value in ("0800 123 4567", "011 3333-4444", "(011) 99999-8888"):
+            record = self.record(telefone=value, celular=value)
+            self.assertEqual(self.round_trip(record), (record, record))
+        # Gravado só com os dígitos antes desta regra
+        self.db.execute("UPDATE pacientes SET telefone = '08001234567'")
+        self.assertEqual(self.db.execute("SELECT " + compact.decoded("telefone") + " FROM pacientes").fetchone(),
+                         ("08001234567",))
+        # O CEP pode começar com 0
+        record = self.record(cep="01000-000")
+        self.assertEqual(self.round_trip(record), (self.record(cep="01000000"), record))
+
+
+if __name__ == "__main__":
+    unittest.main()
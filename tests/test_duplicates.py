@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import duplicates
+from duplicates import Features
+from repository import Patient, PatientRepository
+
+
+def features(identity, nome_busca, telefone=None, celular=None, cep=None, nascimento=None, cartao=None):
+    return Features(identity, nome_busca, telefone, celular, cep, nascimento, cartao)
+
+
+class KeysTest(unittest.TestCase):
+
+    def test_phonetic_spellings(self):
+        for first, second in (("luiz", "luis"), ("souza", "sousa"), ("felipe", "phelipe"), ("thiago", "tiago"),
+                              ("cecilia", "sesilia"), ("helena", "elena"), ("william", "wiliam")):
+            self.assertEqual(duplicates.phonetic(first), duplicates.phonetic(second), (first, second))
+        self.assertNotEqual(duplicates.phonetic("maria"), duplicates.phonetic("marta"))
+
+    def test_tokens_and_digits(self):
+        self.assertEqual(duplicates.name_tokens("maria da conceicao d'avila"), ["maria", "conceicao", "davila"])
+        self.assertEqual(duplicates.digits("(81) 9 9999-8888"), "99998888")
+        self.assertIsNone(duplicates.digits("1234"))
+        self.assertIsNone(duplicates.digits(None))
+
+
+class ScoreTest(unittest.TestCase):
+
+    def test_name_alone_is_not_enough(self):
+        a = features(1, "jose da silva")
+        b = features(2, "jose silva")
+        self.assertAlmostEqual(duplicates.score(a, b), duplicates.NAME_WEIGHT)
+        self.assertLess(duplicates.score(a, b), duplicates.THRESHOLD)
+
+    def test_same_name_and_phone(self):
+        a = features(1, "luiz souza", telefone="3333-4444")
+        b = features(2, "luis sousa", celular="(81) 3333-4444")
+        self.assertGreaterEqual(duplicates.score(a, b), duplicates.THRESHOLD)
+        self.assertEqual(duplicates.reasons(a, b), "nome 100%, telefone")
+
+    def test_different_birth_dates_count_against(self):
+        a = features(1, "luiz souza", telefone="3333-4444", nascimento="1980-01-01")
+        b = features(2, "luis sousa", telefone="3333-4444", nascimento="1990-01-01")
+        self.assertLess(duplicates.score(a, b), duplicates.THRESHOLD)
+        self.assertEqual(duplicates.reasons(a, b), "nome 100%, telefone, nascimento diferente")
+
+
+class CandidatePairsTest(unittest.TestCase):
+
+    def test_blocks(self):
+        patients = [features(1, "ana lima", telefone="1111-2222"), features(2, "anna lima"),
+                    features(3, "bia costa", telefone="1111-2222"), features(4, "caio rocha")]
+        self.assertEqual(duplicates.candidate_pairs(patients), {(0, 1), (0, 2)})
+
+    def test_window(self):
+        patients = [features(identity, "maria silva") for identity in range(10)]
+        pairs = duplicates.candidate_pairs(patients, window=2)
+        self.assertEqual(len(pairs), 9 + 8)
+        self.assertTrue(all(second - first <= 2 for first, second in pairs))
+
+
+class RepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        self.luiz = self.repo.save(Patient("Luiz Souza", telefone="3333-4444", cidade="Recife", plano="UNIMED"))
+        self.luis = self.repo.save(Patient("Luís Sousa", telefone="3333-4444", cep="50000-000", plano="SUS"))
+        self.repo.save(Patient("Maria Lima", telefone="5555-6666", plano="SUS"))
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def test_find_mark_and_merge(self):
+        rows = self.repo.duplicate_pairs()
+        self.assertEqual([row[1:5] for row in rows], [(self.luiz, "Luiz Souza", self.luis, "Luís Sousa")])
+        self.repo.mark_distinct(self.luis, self.luiz)
+        self.assertEqual(self.repo.find_duplicates(), [])
+
+    def test_merge_fills_empty_fields(self):
+        self.repo.merge_patients(self.repo.get(self.luiz), self.repo.get(self.luis))
+        merged = self.repo.get(self.luiz)
+        self.assertEqual((merged.cidade, merged.cep, merged.plano), ("Recife", "50000-000", "UNIMED"))
+        self.assertIsNone(self.repo.get(self.luis))
+        self.assertEqual(self.repo.count(), 2)
+        with self.assertRaises(ValueError):
+            self.repo.merge_patients(merged, merged)
+
+
+if __name__ == "__main__":
+    unittest.main()
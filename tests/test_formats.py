@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import io
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import formats
+import xmlio
+from repository import Patient, PatientRepository
+
+CONTENT = "SELECT pacientes.nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, " \
+          "celular, planos.nome FROM pacientes, planos WHERE planos.id = plano_id ORDER BY pacientes.nome"
+
+
+class RoundTripTest(unittest.TestCase):
+    # Exportar e importar de volta, em cada formato, não muda o cadastro
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        self.repo.save(Patient("Ana Souza", sexo="Feminino", dia_nasc="29", mes_nasc="Fevereiro", ano_nasc="1980",
+                               endereco='Rua "A", 10', cidade="Recife", estado="PE", cep="50000-000",
+                               telefone="(81) 3333-4444", celular="(81) 99999-8888", plano="UNIMED"))
+        self.repo.save(Patient("Bia", telefone="", plano="PARTICULAR"))
+        self.repo.save(Patient("Caio, o Moço", telefone="ramal 12", plano=""))
+        self.content = self.repo.db.execute(CONTENT).fetchall()
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def round_trip(self, name):
+        filename = os.path.join(self.directory.name, name)
+        self.repo.export_file(filename)
+        self.assertEqual(self.repo.import_file(filename), len(self.content))
+        self.assertEqual(self.repo.db.execute(CONTENT).fetchall(), self.content)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "pacientes-rejeitados.txt")))
+
+    def test_xml(self):
+        self.round_trip("pacientes.xml")
+
+    def test_csv(self):
+        self.round_trip("pacientes.csv")
+
+    def test_jsonl(self):
+        self.round_trip("pacientes.jsonl.gz")
+
+    def test_chunked_export(self):
+        filename = os.path.join(self.directory.name, "pacientes.csv.gz")
+        self.assertEqual(self.repo.export_file(filename, file_rows=2), 3)
+        parts = [xmlio.part_name(filename, number) for number in (1, 2)]
+        self.assertEqual([os.path.basename(part) for part in parts],
+                         ["pacientes-0001.csv.gz", "pacientes-0002.csv.gz"])
+        self.assertFalse(os.path.exists(xmlio.part_name(filename, 3)))
+        self.assertEqual(self.repo.import_file(parts), 3)
+        self.assertEqual(self.repo.db.execute(CONTENT).fetchall(), self.content)
+
+
+class CsvReadTest(unittest.TestCase):
+
+    def read(self, text):
+        return list(formats.CsvFormat.read(io.BytesIO(text.encode("utf-8-sig"))))
+
+    def test_header_order_and_missing_columns(self):
+        rows = self.read("telefone, plano ,nome,registro\n1111-1111,UNIMED, Ana ,7\n\n")
+        self.assertEqual(rows, [(("Ana",) + (None,) * 9 + ("1111-1111", None), "UNIMED", "7")])
+
+    def test_wrong_width_is_rejected(self):
+        rows = self.read("nome,plano,telefone\nAna,UNIMED\nBia,UNIMED,\n")
+        self.assertIsInstance(rows[0], xmlio.Reject)
+        self.assertEqual(rows[0].reason, "linha 2 com 2 colunas em vez de 3")
+        self.assertEqual(rows[1], (("Bia",) + (None,) * 9 + ("", None), "UNIMED", None))
+
+    def test_required_columns(self):
+        with self.assertRaises(ValueError):
+            self.read("nome,telefone\nAna,1111-1111\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
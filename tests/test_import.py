@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schema
+import xmlio
+
+
+class Cancelled(Exception):
+    pass
+
+
+def cancel(count, fraction):
+    raise Cancelled()
+
+
+class ImportTest(unittest.TestCase):
+    # Importação completa (xmlio.import_xml) interrompida depois do primeiro
+    # ponto gravado
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = schema.connect(os.path.join(self.directory.name, "pacientes.sdb"))
+        self.filename = os.path.join(self.directory.name, "pacientes.xml")
+        with open(self.filename, "w", encoding="UTF-8") as fh:
+            fh.write('<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n')
+            for number in range(10):
+                fh.write('<pac plano="UNIMED" telefone="1111-1111">Paciente {0}</pac>\n'.format(number))
+            fh.write("</pacientes>\n")
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def staged(self):
+        return self.db.execute("SELECT (SELECT COUNT(*) FROM importacao), "
+                               "(SELECT COUNT(*) FROM importacao_pacientes)").fetchone()
+
+    def interrupted(self, resumable):
+        with self.assertRaises(Cancelled):
+            xmlio.import_xml(self.db, self.filename, batch_size=2, checkpoint_rows=2, progress=cancel,
+                             resumable=resumable)
+
+    def test_resumable_import_keeps_checkpoint(self):
+        self.interrupted(True)
+        self.assertEqual(self.staged(), (1, 2))
+        self.assertEqual(xmlio.import_xml(self.db, self.filename), 10)
+        self.assertEqual(self.staged(), (0, 0))
+
+    def test_other_import_discards_staged_rows(self):
+        self.interrupted(False)
+        self.assertEqual(self.staged(), (0, 0))
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM pacientes").fetchone()[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
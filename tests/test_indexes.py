@@ -0,0 +1,40 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indexes import SortedIndex
+
+
+class SortedIndexTest(unittest.TestCase):
+
+    def test_values_follow_changes(self):
+        rnd = random.Random(1)
+        keys = [(rnd.choice("ABCDE"), number) for number in range(50)]
+        index = SortedIndex(keys[:25], value=lambda key: key[0])
+        self.assertEqual(index.values(), [key[0] for key in sorted(keys[:25])])
+        for key in keys[25:]:
+            index.add(key)
+        for key in keys[:10]:
+            self.assertTrue(index.remove(key))
+        self.assertFalse(index.remove(keys[0]))
+        index.replace(keys[30], ("F", 30))
+        expected = sorted(keys[10:30] + keys[31:] + [("F", 30)])
+        self.assertEqual(index.keys, expected)
+        self.assertEqual(index.values(), [key[0] for key in expected])
+
+    def test_version_changes_only_with_content(self):
+        index = SortedIndex(["b"])
+        version = index.version
+        index.remove("a")
+        index.replace("b", "b")
+        self.assertEqual(index.version, version)
+        index.add("a")
+        self.assertEqual(index.values(), ["a", "b"])
+        self.assertNotEqual(index.version, version)
+
+
+if __name__ == "__main__":
+    unittest.main()
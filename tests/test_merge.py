@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import formats
+import schema
+import xmlio
+
+
+def pac(nome, telefone="1111-1111", registro=None, cidade=None):
+    attributes = ' plano="UNIMED" telefone="{0}"'.format(telefone)
+    if registro is not None:
+        attributes += ' registro="{0}"'.format(registro)
+    if cidade is not None:
+        attributes += ' cidade="{0}"'.format(cidade)
+    return "<pac{0}>{1}</pac>".format(attributes, nome)
+
+
+class MergeTest(unittest.TestCase):
+    # Importação incremental (xmlio.merge_xml) num banco novo
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = schema.connect(os.path.join(self.directory.name, "pacientes.sdb"))
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def merge(self, *pacs):
+        filename = os.path.join(self.directory.name, "pacientes.xml")
+        with open(filename, "w", encoding="UTF-8") as fh:
+            fh.write('<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n')
+            fh.write("\n".join(pacs))
+            fh.write("\n</pacientes>\n")
+        return xmlio.merge_xml(self.db, filename)
+
+    def merge_empty(self, name, content):
+        filename = os.path.join(self.directory.name, name)
+        with open(filename, "w", encoding="UTF-8") as fh:
+            fh.write(content)
+        with self.assertRaises(ValueError):
+            xmlio.merge_xml(self.db, filename, fmt=formats.for_filename(filename))
+
+    def rejected(self):
+        filename = os.path.join(self.directory.name, "pacientes-rejeitados.txt")
+        if not os.path.exists(filename):
+            return []
+        with open(filename, encoding="UTF-8") as fh:
+            return [line.split("\t")[:3] for line in fh.read().splitlines()[1:]]
+
+    def patients(self):
+        return self.db.execute("SELECT id, nome, cidade FROM pacientes ORDER BY id").fetchall()
+
+    def test_counts_and_changes(self):
+        self.merge(pac("Ana"), pac("Bia"), pac("Caio"))
+        caio = self.patients()[2][0]
+        counts = self.merge(pac("Ana", cidade="Recife"), pac("Caio Lima", registro=caio), pac("Bia"), pac("Davi"))
+        self.assertEqual(counts, {"inseridos": 1, "atualizados": 2, "removidos": 0, "inalterados": 1,
+                                  "rejeitados": 0})
+        counts = self.merge(pac("Ana", cidade="Recife"), pac("Davi"))
+        self.assertEqual(counts, {"inseridos": 0, "atualizados": 0, "removidos": 2, "inalterados": 2,
+                                  "rejeitados": 0})
+        self.assertEqual([row[1:] for row in self.patients()], [("Ana", "Recife"), ("Davi", None)])
+
+    def test_repeated_registro_is_rejected(self):
+        counts = self.merge(pac("Ana", registro=7), pac("Bia", registro=7))
+        self.assertEqual(counts["inseridos"], 1)
+        self.assertEqual(counts["rejeitados"], 1)
+        self.assertEqual(self.patients(), [(7, "Ana", None)])
+        self.assertEqual(self.rejected(), [["2", "registro repetido: 7", "Bia"]])
+
+    def test_ambiguous_name_and_phone_is_rejected(self):
+        self.merge(pac("Ana"), pac("Ana"))
+        self.assertEqual(len(self.patients()), 2)
+        counts = self.merge(pac("Ana", cidade="Recife"))
+        self.assertEqual(counts["rejeitados"], 1)
+        self.assertEqual(counts["removidos"], 0)
+        self.assertEqual([row[2] for row in self.patients()], [None, None])
+        self.assertEqual(self.rejected(), [["1", "nome e telefone de mais de um paciente", "Ana"]])
+
+    def test_same_patient_twice_keeps_the_first(self):
+        self.merge(pac("Ana"))
+        identity = self.patients()[0][0]
+        counts = self.merge(pac("Ana", cidade="Recife"), pac("Ana", registro=identity, cidade="Olinda"))
+        self.assertEqual(counts["atualizados"], 1)
+        self.assertEqual(counts["rejeitados"], 1)
+        self.assertEqual(self.patients(), [(identity, "Ana", "Recife")])
+        self.assertEqual(self.rejected(), [["2", "mesmo paciente de uma linha anterior", "Ana"]])
+
+    def test_registro_zero_is_kept(self):
+        counts = self.merge(pac("Ana", registro=0), pac("Bia"))
+        self.assertEqual(counts["inseridos"], 2)
+        self.assertEqual([row[:2] for row in self.patients()], [(0, "Ana"), (1, "Bia")])
+
+    def test_new_registro_after_generated_id(self):
+        self.merge(pac("Ana", registro=1))
+        counts = self.merge(pac("Ana", registro=1), pac("Bia"), pac("Caio", registro=2))
+        self.assertEqual(counts["inseridos"], 2)
+        self.assertEqual([row[:2] for row in self.patients()], [(1, "Ana"), (2, "Caio"), (3, "Bia")])
+
+    def test_empty_file_is_refused(self):
+        self.merge(pac("Ana"), pac("Bia"))
+        for name, content in (("vazio.xml", '<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n</pacientes>\n'),
+                              ("vazio.csv", ",".join(formats.COLUMNS) + "\n"),
+                              ("nada.csv", ""),
+                              ("vazio.jsonl", "")):
+            self.merge_empty(name, content)
+            self.assertEqual([row[1] for row in self.patients()], ["Ana", "Bia"])
+
+    def test_file_without_valid_patients_is_refused(self):
+        self.merge(pac("Ana"))
+        self.merge_empty("pacientes.xml", '<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n'
+                                           '<pac telefone="1111-1111">Sem Plano</pac>\n</pacientes>\n')
+        self.assertEqual([row[1] for row in self.patients()], ["Ana"])
+        self.assertEqual(self.rejected(), [["1", "sem plano", "Sem Plano"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import search
+from repository import Patient, PatientRepository
+
+
+class NormalizeNameTest(unittest.TestCase):
+
+    def test_accents_case_and_spaces(self):
+        self.assertEqual(search.normalize_name("  José  da SILVA "), "jose da silva")
+        self.assertEqual(search.normalize_name("CONCEIÇÃO Brandão"), "conceicao brandao")
+        self.assertEqual(search.normalize_name("Müller\tStraße"), "muller strasse")
+
+    def test_empty_values(self):
+        self.assertIsNone(search.normalize_name(None))
+        self.assertEqual(search.normalize_name("   "), "")
+
+    def test_decomposed_accents(self):
+        # "é" gravado como "e" seguido do acento combinante
+        self.assertEqual(search.normalize_name("Jose\u0301"), search.normalize_name("Jos\u00e9"))
+
+
+class SearchNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo = PatientRepository(os.path.join(self.directory.name, "pacientes.sdb"))
+        for nome in ("José Silva", "JOSÉ", "Josefa Lima", "Joana", "João Souza", "Ângela"):
+            self.repo.save(Patient(nome, telefone="1111-1111", plano="UNIMED"))
+
+    def tearDown(self):
+        self.repo.close()
+        self.directory.cleanup()
+
+    def names(self, text, **options):
+        return [nome for nome, identity in search.search_names(self.repo.db, text, **options)]
+
+    def test_prefix_ignores_accents_and_case(self):
+        self.assertEqual(self.names("jose"), ["JOSÉ", "José Silva", "Josefa Lima"])
+        self.assertEqual(self.names("JOÃO"), ["João Souza"])
+        self.assertEqual(self.names("angela"), ["Ângela"])
+
+    def test_exact_match_first(self):
+        self.assertEqual(self.names("josé")[0], "JOSÉ")
+        records = search.search_names(self.repo.db, "jose silva")
+        self.assertEqual(search.exact_match(records, "JOSE  SILVA")[0], "José Silva")
+        self.assertIsNone(search.exact_match(search.search_names(self.repo.db, "jo"), "jo"))
+
+    def test_limit_offset_and_blank_text(self):
+        self.assertEqual(self.names("jo", limit=2), ["Joana", "João Souza"])
+        self.assertEqual(self.names("jo", limit=2, offset=2), ["JOSÉ", "José Silva"])
+        self.assertEqual(self.names("  "), [])
+        self.assertEqual(self.names("xyz"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import http.client
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+class ServerTest(unittest.TestCase):
+    # Respostas do servidor (cadastro.py serve) a corpos inválidos
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.process, url = benchmark.start_server(os.path.join(cls.directory.name, "pacientes.sdb"), 1)
+        cls.address = urllib.parse.urlsplit(url).netloc
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.wait()
+        cls.process.stdout.close()
+        cls.directory.cleanup()
+
+    def post(self, path, body):
+        connection = http.client.HTTPConnection(self.address, timeout=10)
+        try:
+            connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read() or b"null")
+        finally:
+            connection.close()
+
+    def test_body_must_be_an_object(self):
+        for path in ("/arquivo", "/duplicados/mesclar", "/duplicados/distintos"):
+            for body in (b"null", b"[]", b"7", b'"dias"'):
+                status, payload = self.post(path, body)
+                self.assertEqual(status, 400, (path, body))
+                self.assertEqual(payload["erro"], "Corpo da requisição não é um objeto JSON")
+
+    def test_bad_values(self):
+        self.assertEqual(self.post("/arquivo", b"{not json")[0], 400)
+        self.assertEqual(self.post("/arquivo", b"{}")[0], 400)
+        self.assertEqual(self.post("/arquivo", b'{"dias": "x"}')[0], 400)
+        status, payload = self.post("/arquivo", b'{"dias": 30}')
+        self.assertEqual((status, payload), (200, {"arquivados": 0}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+import client
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job(threading.Thread):
+    # Executa task(repo, progress) numa thread separada, com sua própria
+    # conexão ao banco (ou ao servidor, se filename é uma URL), aberta com o
+    # mesmo timeout da interface. A interface só lê rows, fraction, result e
+    # error.
+
+    def __init__(self, filename, task, stats=None, timeout=None):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.task = task
+        self.stats = stats
+        self.timeout = timeout
+        self.cancel_event = threading.Event()
+        self.rows = 0
+        self.fraction = None
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def run(self):
+        self.started = time.monotonic()
+        repo = None
+        try:
+            repo = client.open_repository(self.filename, self.timeout, self.stats)
+            self.result = self.task(repo, self.progress)
+        except BaseException as err:
+            self.error = err
+        finally:
+            if repo is not None:
+                repo.close()
+            self.finished = time.monotonic()
+
+    def progress(self, rows, fraction=None):
+        self.rows = rows
+        self.fraction = fraction
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return isinstance(self.error, Cancelled)
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        # Segundos restantes estimados, ou None sem fração conhecida
+        if not self.fraction:
+            return None
+        return self.elapsed() * (1 - self.fraction) / self.fraction
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}:{1:02}:{2:02}'.format(hours, minutes, seconds)
+    return '{0}:{1:02}'.format(minutes, seconds)
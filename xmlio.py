@@ -0,0 +1,880 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import collections
+import multiprocessing
+import concurrent.futures
+import xml.etree.ElementTree
+import xml.sax.saxutils
+
+import compact
+from planos import PlanoCache
+from search import normalize_name
+from birthdates import iso_date
+
+# Quantidade de pacientes enviados por vez ao executemany
+BATCH_SIZE = 1000
+
+# A importação completa grava o andamento (importacao) a cada CHECKPOINT_ROWS
+# pacientes lidos; interrompida, continua do último ponto gravado
+CHECKPOINT_ROWS = 20000
+
+# Linhas lidas por fetchmany e gravadas de uma vez na exportação
+EXPORT_CHUNK = 5000
+
+# Importação paralela: arquivos menores que PARALLEL_MIN_SIZE são lidos
+# direto; os maiores são divididos em trechos de RANGE_SIZE bytes, e cada
+# processo pode ter até PARALLEL_PENDING trechos na fila à frente do gravador
+PARALLEL_MIN_SIZE = 16 << 20
+RANGE_SIZE = 4 << 20
+PARALLEL_PENDING = 2
+
+# Início de um elemento <pac> (e não de <pacientes>)
+PAC_START = re.compile(rb"<pac[\s>]")
+
+# Tamanho do buffer do arquivo exportado e nível de compressão do .gz
+WRITE_BUFFER = 1 << 20
+GZIP_LEVEL = 6
+
+FIELDS = ("nome", "sexo", "cartao", "dia_nasc", "mes_nasc", "ano_nasc", "endereco",
+          "cidade", "estado", "cep", "telefone", "celular")
+
+ATTRIBUTES = ("sexo", "cartao", "dia_nasc", "mes_nasc", "ano_nasc", "endereco", "cidade", "plano",
+              "estado", "cep", "telefone", "celular")
+
+# Posição de cada atributo (menos o plano) em FIELDS
+ATTRIBUTE_FIELDS = tuple(FIELDS.index(name) if name != "plano" else None for name in ATTRIBUTES)
+
+# Campos na ordem de exportação (nome e ATTRIBUTES), já sem a codificação compacta
+EXPORT_FIELDS = tuple(["pacientes.nome"] + ["planos.nome" if name == "plano" else compact.decoded(name)
+                                             for name in ATTRIBUTES])
+EXPORT_COLUMNS = ", ".join(EXPORT_FIELDS)
+
+SELECT_EXPORT = ("SELECT " + EXPORT_COLUMNS + " "
+                 "FROM pacientes, planos "
+                 "WHERE pacientes.plano_id = planos.id "
+                 "ORDER BY pacientes.nome ")
+
+# Os mesmos campos no arquivo de inativos (ver archive.py, anexado como
+# arquivo e lido como a), que guarda o nome do plano em vez do id
+ARCHIVE_FIELDS = tuple(["a.nome"] + ["a.plano" if name == "plano" else compact.decoded(name, "a")
+                                     for name in ATTRIBUTES])
+
+# Com o arquivo anexado, a exportação completa leva também os arquivados
+SELECT_EXPORT_ARCHIVED = ("SELECT " + EXPORT_COLUMNS + " "
+                          "FROM pacientes, planos "
+                          "WHERE pacientes.plano_id = planos.id "
+                          "UNION ALL "
+                          "SELECT " + ", ".join(ARCHIVE_FIELDS) + " FROM arquivo.pacientes AS a "
+                          "ORDER BY 1")
+
+PAC_TEMPLATE = "<pac " + " ".join("{0}={{{1}}}".format(name, i) for i, name in enumerate(ATTRIBUTES)) + \
+               ">{12}</pac>\n"
+
+# Versão do modelo para linhas sem nenhum caractere a escapar
+PAC_PLAIN = "<pac " + " ".join('{0}="{{{1}}}"'.format(name, i) for i, name in enumerate(ATTRIBUTES)) + \
+            ">{12}</pac>\n"
+
+# Caracteres que obrigam quoteattr a escapar ou trocar as aspas
+SPECIAL = re.compile("[&<>\"'\n\r\t]")
+
+INSERT_PAC = ("INSERT INTO pacientes "
+              "(nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, celular, plano_id, "
+              "nome_busca, conteudo_hash, nascimento) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+# Data e hora (UTC) gravada no registro de alterações
+NOW = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+# Depois de uma importação completa todos os registros mudaram: o registro
+# de alterações passa a ter todos os pacientes, e quem pedir alterações
+# desde antes dela recebe tudo (completo="1")
+RESET_CHANGES = (
+    "UPDATE alteracoes_inicio SET seq = "
+    "ifnull((SELECT seq FROM sqlite_sequence WHERE name = 'alteracoes'), 0)",
+    "DELETE FROM alteracoes",
+    "INSERT INTO alteracoes (paciente_id, removido, momento) "
+    "SELECT id, 0, {0} FROM pacientes ORDER BY id".format(NOW),
+)
+
+# Alterações depois de uma seq até outra, com os campos na ordem de
+# SELECT_EXPORT (vazios para os removidos)
+SELECT_CHANGES = ("SELECT alteracoes.paciente_id, alteracoes.removido, " + EXPORT_COLUMNS + " "
+                  "FROM alteracoes "
+                  "LEFT JOIN pacientes ON pacientes.id = alteracoes.paciente_id AND NOT alteracoes.removido "
+                  "LEFT JOIN planos ON planos.id = pacientes.plano_id "
+                  "WHERE alteracoes.seq > ? AND alteracoes.seq <= ? "
+                  "ORDER BY alteracoes.seq")
+
+# O mesmo com o arquivo anexado: um paciente arquivado continua com a sua
+# última alteração no registro (archive.archive_patients não registra a
+# saída do banco principal), com os campos lidos do arquivo
+SELECT_CHANGES_ARCHIVED = (
+    "SELECT alteracoes.paciente_id, alteracoes.removido, " +
+    ", ".join("CASE WHEN pacientes.id IS NULL THEN {0} ELSE {1} END".format(archived, current) for archived, current in
+              zip(ARCHIVE_FIELDS, EXPORT_FIELDS)) + " "
+    "FROM alteracoes "
+    "LEFT JOIN pacientes ON pacientes.id = alteracoes.paciente_id AND NOT alteracoes.removido "
+    "LEFT JOIN planos ON planos.id = pacientes.plano_id "
+    "LEFT JOIN arquivo.pacientes AS a ON a.id = alteracoes.paciente_id AND NOT alteracoes.removido "
+    "WHERE alteracoes.seq > ? AND alteracoes.seq <= ? "
+    "ORDER BY alteracoes.seq")
+
+CHANGES_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<pacientes desde="{0}" ate="{1}" completo="{2}">\n'
+
+# Tabela temporária da importação incremental: posição no arquivo, registro,
+# campos, plano_id, nome_busca, conteudo_hash, nascimento e o id do paciente
+# correspondente no banco
+CREATE_ENTRADA = ("CREATE TEMP TABLE entrada (posicao INTEGER, registro INTEGER, "
+                  "nome TEXT, sexo TEXT, cartao TEXT, dia_nasc TEXT, mes_nasc TEXT, ano_nasc TEXT, endereco TEXT, "
+                  "cidade TEXT, estado TEXT, cep TEXT, telefone TEXT, celular TEXT, plano_id INTEGER, "
+                  "nome_busca TEXT, conteudo_hash TEXT, nascimento TEXT, paciente_id INTEGER)")
+
+# Andamento da importação completa (uma linha, ver schema.add_import_checkpoint):
+# os arquivos, identificados por caminho, tamanho e data, e quantos
+# pacientes já foram lidos deles
+SELECT_CHECKPOINT = "SELECT arquivos, lidos, gravados FROM importacao"
+INSERT_STAGED = ("INSERT INTO importacao_pacientes "
+                 "(nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, "
+                 "celular, plano, nome_busca, conteudo_hash, nascimento) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+INSERT_REJECTED = "INSERT INTO importacao_rejeitados (posicao, motivo, campos) VALUES (?, ?, ?)"
+CLEAR_STAGING = ("DELETE FROM importacao", "DELETE FROM importacao_pacientes", "DELETE FROM importacao_rejeitados")
+
+# Troca do conteúdo do banco pelo que foi lido, com os planos na ordem em
+# que aparecem no arquivo
+INSERT_STAGED_PLANOS = ("INSERT INTO planos (nome) "
+                        "SELECT plano FROM importacao_pacientes GROUP BY plano ORDER BY min(id)")
+INSERT_STAGED_PACIENTES = (
+    "INSERT INTO pacientes "
+    "(nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, celular, plano_id, "
+    "nome_busca, conteudo_hash, nascimento) "
+    "SELECT e.nome, e.sexo, e.cartao, e.dia_nasc, e.mes_nasc, e.ano_nasc, e.endereco, e.cidade, e.estado, e.cep, "
+    "e.telefone, e.celular, planos.id, e.nome_busca, e.conteudo_hash, e.nascimento "
+    "FROM importacao_pacientes AS e, planos WHERE planos.nome = e.plano ORDER BY e.id")
+
+REJECTS_HEADER = "posição\tmotivo\t" + "\t".join(("nome",) + ATTRIBUTES) + "\n"
+
+# Tabulações e quebras de linha dentro de um campo do arquivo de recusados
+SEPARATORS = re.compile("[\t\r\n]")
+
+INSERT_ENTRADA = ("INSERT INTO entrada "
+                  "(posicao, registro, nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, telefone, "
+                  "celular, plano_id, nome_busca, conteudo_hash, nascimento) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+# Casamento de cada linha da entrada com um paciente do banco: pelo registro,
+# se houver, ou pelo nome e telefone
+MATCH_ENTRADA = ("UPDATE entrada SET paciente_id = CASE WHEN registro IS NOT NULL "
+                 "THEN (SELECT id FROM pacientes WHERE id = entrada.registro) "
+                 "ELSE (SELECT id FROM pacientes WHERE nome = entrada.nome AND telefone = entrada.telefone "
+                 "ORDER BY id LIMIT 1) END")
+
+# Linhas da entrada que não podem ser casadas com segurança, com os campos na
+# ordem do arquivo de recusados: sem registro e com nome e telefone de mais
+# de um paciente do banco, ou casadas com o mesmo paciente que uma linha
+# anterior do arquivo (a primeira é a que vale)
+REJECT_COLUMNS = ", ".join("planos.nome" if name == "plano" else "e." + name for name in ("nome",) + ATTRIBUTES)
+SELECT_AMBIGUOUS = ("SELECT e.rowid, e.posicao, " + REJECT_COLUMNS + " FROM entrada AS e "
+                    "JOIN planos ON planos.id = e.plano_id "
+                    "WHERE e.registro IS NULL AND e.paciente_id IS NOT NULL AND EXISTS "
+                    "(SELECT 1 FROM pacientes WHERE nome = e.nome AND telefone = e.telefone AND id <> e.paciente_id)")
+SELECT_REPEATED = ("SELECT e.rowid, e.posicao, " + REJECT_COLUMNS + " FROM entrada AS e "
+                   "JOIN planos ON planos.id = e.plano_id "
+                   "WHERE e.paciente_id IS NOT NULL AND EXISTS "
+                   "(SELECT 1 FROM entrada AS f WHERE f.paciente_id = e.paciente_id AND f.rowid < e.rowid)")
+DELETE_ENTRADA = "DELETE FROM entrada WHERE rowid = ?"
+
+# Com o arquivo de inativos anexado: um paciente inserido com o registro de
+# um arquivado voltou a ser ativo, e a cópia arquivada sai na mesma transação
+RELEASE_ARCHIVED = ("DELETE FROM arquivo.pacientes WHERE id IN "
+                    "(SELECT registro FROM entrada WHERE paciente_id IS NULL AND registro IS NOT NULL)")
+
+
+def content_hash(record, plano):
+    # Resumo dos campos de um paciente (na ordem de FIELDS, como gravados,
+    # ver compact.encode) e do nome do plano, usado para saber se uma linha
+    # mudou sem comparar campo a campo
+    data = "\x1f".join("\x00" if value is None else value for value in record + (plano.upper(),))
+    return hashlib.blake2b(data.encode("UTF-8"), digest_size=8).hexdigest()
+
+
+def iter_pacs(source):
+    # Lê os elementos <pac> um a um, descartando cada um depois de lido,
+    # para que a memória não cresça com o tamanho do arquivo. Nome e plano
+    # ausentes são recusados depois, por validate.
+    context = xml.etree.ElementTree.iterparse(source, events=("start", "end"))
+    event, root = next(context)
+    for event, element in context:
+        if event != "end" or element.tag != "pac":
+            continue
+        nome = element.text.strip() if element.text is not None else None
+        record = (nome, element.get("sexo"), element.get("cartao"),
+                  element.get("dia_nasc"), element.get("mes_nasc"), element.get("ano_nasc"),
+                  element.get("endereco"), element.get("cidade"), element.get("estado"),
+                  element.get("cep"), element.get("telefone"), element.get("celular"))
+        plano = element.get("plano")
+        registro = element.get("registro")
+        root.clear()
+        yield record, plano, registro
+
+
+def open_input(filename):
+    # Devolve o arquivo bruto (para medir o progresso), o arquivo a ser lido
+    # pelo parser (descompactado se for .gz) e o tamanho em bytes
+    raw = open(filename, "rb")
+    size = os.fstat(raw.fileno()).st_size
+    fh = gzip.GzipFile(fileobj=raw, mode="rb") if filename.endswith(".gz") else raw
+    return raw, fh, size
+
+
+class Reject:
+    # Paciente que não pode ser gravado, no lugar de (record, plano, registro):
+    # o motivo e os campos como foram lidos
+
+    __slots__ = ("reason", "values")
+
+    def __init__(self, reason, values):
+        self.reason = reason
+        self.values = values
+
+
+def invalid(record, plano, registro):
+    # Motivo para recusar um paciente, ou None; nome, telefone e plano são
+    # obrigatórios no banco
+    if not record[0]:
+        return "sem nome"
+    if plano is None:
+        return "sem plano"
+    if record[10] is None:
+        return "sem telefone"
+    if registro is not None and registro != "":
+        try:
+            int(registro)
+        except (TypeError, ValueError):
+            return "registro inválido: {0}".format(registro)
+    return None
+
+
+def validate(pacs):
+    # Primeira etapa da importação: (record, plano, registro) dos pacientes
+    # que podem ser gravados, e um Reject no lugar dos outros (os leitores já
+    # trocam por Reject as linhas que nem formam um paciente)
+    for pac in pacs:
+        if pac.__class__ is not Reject:
+            reason = invalid(*pac)
+            if reason is not None:
+                record, plano, registro = pac
+                pac = Reject(reason, reject_values(record, plano))
+        yield pac
+
+
+def reject_values(record, plano):
+    # Campos de um paciente na ordem do arquivo de recusados: nome e atributos
+    return (record[0],) + tuple(plano if i is None else record[i] for i in ATTRIBUTE_FIELDS)
+
+
+def prepare(record, plano, registro):
+    # Linha pronta para gravar, menos o id do plano, que só o gravador conhece
+    record = compact.encode(record)
+    return (record, plano, registro, normalize_name(record[0]), content_hash(record, plano),
+            iso_date(record[3], record[4], record[5]))
+
+
+def prepared(pacs):
+    # Segunda etapa: normaliza os pacientes válidos (prepare); os Reject passam
+    for pac in pacs:
+        yield pac if pac.__class__ is Reject else prepare(*pac)
+
+
+def reject_fields(values):
+    # Campos de um Reject numa linha do arquivo de recusados
+    return "\t".join("" if value is None else SEPARATORS.sub(" ", str(value)) for value in values)
+
+
+def rejects_name(filenames):
+    # pacientes.xml.gz -> pacientes-rejeitados.txt, ao lado do (primeiro) arquivo importado
+    filename = filenames if isinstance(filenames, str) else filenames[0]
+    base = os.path.splitext(filename[:-3] if filename.endswith(".gz") else filename)[0]
+    return base + "-rejeitados.txt"
+
+
+class Rejects:
+    # Arquivo de texto, separado por tabulações, com os pacientes recusados:
+    # a posição no arquivo importado (contando os pacientes, a partir de 1),
+    # o motivo e os campos lidos. Só é criado se algum paciente for recusado.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+
+    def write(self, rows):
+        # rows: (posição, motivo, campos já passados por reject_fields)
+        self.count = 0
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        fh = None
+        try:
+            for position, reason, fields in rows:
+                if fh is None:
+                    fh = open(self.filename, "w", encoding="UTF-8")
+                    fh.write(REJECTS_HEADER)
+                fh.write("{0}\t{1}\t{2}\n".format(position, reason, fields))
+                self.count += 1
+        finally:
+            if fh is not None:
+                fh.close()
+
+
+def split_ranges(filename, size, range_size=RANGE_SIZE):
+    # Divide o XML em trechos (início, fim) que começam sempre num <pac>, ou
+    # devolve None se o arquivo não puder ser dividido com segurança (outra
+    # codificação, DOCTYPE, comentários ou sem a tag de fechamento)
+    with open(filename, "rb") as fh:
+        head = fh.read(min(size, 1 << 16))
+        prolog = head.split(b"?>", 1)[0] if head.startswith(b"<?xml") else b""
+        if b"encoding" in prolog and not re.search(rb"""encoding=["']utf-?8["']""", prolog, re.IGNORECASE):
+            return None
+        if b"<!DOCTYPE" in head or b"<!--" in head:
+            return None
+        match = PAC_START.search(head)
+        fh.seek(max(0, size - 4096))
+        end = fh.read().rfind(b"</pacientes>")
+        if match is None or end < 0:
+            return None
+        end += max(0, size - 4096)
+        ranges = []
+        start = match.start()
+        while start < end:
+            target = start + range_size
+            found = None
+            while target < end:
+                fh.seek(target)
+                window = fh.read(1 << 16)
+                match = PAC_START.search(window)
+                if match is not None:
+                    found = target + match.start()
+                    break
+                target += max(1, len(window) - 8)
+            if found is None or found >= end:
+                ranges.append((start, end))
+                break
+            ranges.append((start, found))
+            start = found
+    return ranges
+
+
+def parse_range(filename, start, end):
+    # Roda em outro processo: lê e prepara os <pac> de um trecho do arquivo
+    with open(filename, "rb") as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    source = io.BytesIO(b"<pacientes>" + data + b"</pacientes>")
+    return list(prepared(validate(iter_pacs(source))))
+
+
+class Inputs:
+    # Um ou mais arquivos lidos em sequência como se fossem um só (por
+    # exemplo as partes de uma exportação dividida), com a fração já lida
+    # somando os tamanhos de todos
+
+    def __init__(self, filenames):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        self.sizes = [os.path.getsize(filename) for filename in self.filenames]
+        self.total = sum(self.sizes)
+        self.done = 0
+        self.raw = None
+        self.skip = 0
+
+    def signature(self):
+        # Identifica os arquivos no andamento gravado da importação: a mesma
+        # lista, com os mesmos tamanhos e datas, continua de onde parou
+        return json.dumps([[os.path.abspath(filename), size, os.stat(filename).st_mtime_ns]
+                           for filename, size in zip(self.filenames, self.sizes)])
+
+    def rows(self, fmt, workers=1, skip=0):
+        # Devolve prepare(record, plano, registro) de cada paciente, ou um
+        # Reject, depois de pular os skip primeiros (já gravados por uma
+        # importação interrompida; são lidos de novo, mas não normalizados).
+        # Com mais de um worker, os XML grandes são lidos em paralelo (ver
+        # parallel_rows), na mesma ordem do arquivo. Mais workers que
+        # processadores só atrapalha.
+        self.skip = skip
+        workers = min(workers, os.cpu_count() or 1)
+        for filename, size in zip(self.filenames, self.sizes):
+            ranges = None
+            if workers > 1 and fmt is XmlFormat and size >= PARALLEL_MIN_SIZE and not filename.endswith(".gz"):
+                ranges = split_ranges(filename, size)
+            if ranges is not None:
+                yield from self.parallel_rows(filename, ranges, workers)
+            else:
+                yield from self.serial_rows(filename, fmt)
+            self.done += size
+
+    def serial_rows(self, filename, fmt):
+        self.raw, fh, ignore = open_input(filename)
+        try:
+            yield from prepared(self.skipped(validate(fmt.read(fh))))
+        finally:
+            fh.close()
+            self.raw.close()
+            self.raw = None
+
+    def parallel_rows(self, filename, ranges, workers):
+        # Os trechos são lidos por um ProcessPoolExecutor; no máximo
+        # workers * PARALLEL_PENDING ficam em andamento, para que a memória
+        # não cresça se o gravador (esta thread) for mais lento que a leitura
+        start = self.done
+        pending = collections.deque()
+        ranges = iter(ranges)
+        # spawn não copia o processo (que pode ter Tk e outras threads abertas)
+        context = multiprocessing.get_context("spawn")
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+        try:
+            while True:
+                for first, last in ranges:
+                    pending.append((executor.submit(parse_range, filename, first, last), last))
+                    if len(pending) >= workers * PARALLEL_PENDING:
+                        break
+                if not pending:
+                    break
+                future, last = pending.popleft()
+                yield from self.skipped(future.result())
+                self.done = start + last
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.done = start
+
+    def skipped(self, pacs):
+        for pac in pacs:
+            if self.skip:
+                self.skip -= 1
+            else:
+                yield pac
+
+    def fraction(self):
+        if not self.total:
+            return None
+        return (self.done + (self.raw.tell() if self.raw is not None else 0)) / self.total
+
+
+class XmlFormat:
+    # Formato padrão. Os outros formatos (módulo formats) têm os mesmos
+    # atributos e podem ser passados a import_xml, merge_xml e export_xml.
+    name = "xml"
+    extension = ".xml"
+    header = b'<?xml version="1.0" encoding="UTF-8"?>\n<pacientes>\n'
+    footer = b"</pacientes>\n"
+    read = staticmethod(iter_pacs)
+
+    @staticmethod
+    def lines(records):
+        return "".join(map(pac_line, records))
+
+
+def pending_import(db, inputs):
+    # Pacientes já lidos (e gravados em importacao_pacientes) por uma
+    # importação destes arquivos que foi interrompida, ou None
+    row = db.execute(SELECT_CHECKPOINT).fetchone()
+    if row is None or row[0] != inputs.signature():
+        return None
+    return row[1]
+
+
+def no_patients(rejects):
+    # Erro de uma importação sem nenhum paciente a gravar
+    if not rejects.count:
+        return ValueError('Nenhum paciente no arquivo; o banco de dados não foi alterado')
+    return ValueError('Nenhum paciente válido no arquivo ({0} recusados{1})'.format(
+        rejects.count, "; veja os motivos em " + rejects.filename if rejects.filename else ""))
+
+
+def clear_staging(db):
+    # Descarta o andamento gravado e os pacientes já lidos
+    for sql in CLEAR_STAGING:
+        db.execute(sql)
+    db.commit()
+
+
+def import_xml(db, filename, planos=None, batch_size=BATCH_SIZE, progress=None, fmt=XmlFormat, workers=1,
+               rejects=None, checkpoint_rows=CHECKPOINT_ROWS, resumable=True):
+    # Substitui todo o conteúdo do banco pelo XML. Os pacientes são lidos
+    # para importacao_pacientes, com o andamento gravado (commit) a cada
+    # checkpoint_rows, e só no final trocam o conteúdo do banco, numa única
+    # transação: até lá as outras estações veem o banco anterior, e uma
+    # importação interrompida (erro, cancelamento, queda) dos mesmos arquivos
+    # continua do último ponto gravado. Os pacientes recusados por validate
+    # não entram e vão para rejects (Rejects, por padrão ao lado do arquivo).
+    # progress(linhas, fração do arquivo lida) é chamado a cada lote e pode
+    # levantar uma exceção para cancelar.
+    # filename pode ser uma lista de arquivos, importados juntos. Com
+    # workers > 1 a leitura dos XML grandes é feita em paralelo, mas só esta
+    # conexão grava. resumable=False é para arquivos que não serão importados
+    # de novo do mesmo caminho (o temporário de um envio ao servidor, por
+    # exemplo): uma importação que falha descarta o que já tinha lido.
+    if planos is None:
+        planos = PlanoCache(db)
+    if rejects is None:
+        rejects = Rejects(rejects_name(filename))
+    cursor = db.cursor()
+    inputs = Inputs(filename)
+    read = pending_import(db, inputs)
+    if read is None:
+        for sql in CLEAR_STAGING:
+            cursor.execute(sql)
+        cursor.execute("INSERT INTO importacao (arquivos, lidos, gravados, momento) VALUES (?, 0, 0, {0})".format(NOW),
+                       (inputs.signature(),))
+        db.commit()
+        read = count = 0
+    else:
+        count = cursor.execute(SELECT_CHECKPOINT).fetchone()[2]
+    batch = []
+    rejected = []
+    checkpoint = read
+    records = inputs.rows(fmt, workers, skip=read)
+    try:
+        for row in records:
+            read += 1
+            if row.__class__ is Reject:
+                rejected.append((read, row.reason, reject_fields(row.values)))
+                continue
+            record, plano, registro, nome_busca, conteudo_hash, nascimento = row
+            batch.append(record + (plano.upper(), nome_busca, conteudo_hash, nascimento))
+            if len(batch) >= batch_size:
+                cursor.executemany(INSERT_STAGED, batch)
+                count += len(batch)
+                batch.clear()
+                if read - checkpoint >= checkpoint_rows:
+                    cursor.executemany(INSERT_REJECTED, rejected)
+                    rejected.clear()
+                    cursor.execute("UPDATE importacao SET lidos=?, gravados=?, momento={0}".format(NOW),
+                                   (read, count))
+                    db.commit()
+                    checkpoint = read
+                if progress is not None:
+                    progress(count, inputs.fraction())
+        cursor.executemany(INSERT_STAGED, batch)
+        count += len(batch)
+        cursor.executemany(INSERT_REJECTED, rejected)
+        cursor.execute("UPDATE importacao SET lidos=?, gravados=?, momento={0}".format(NOW), (read, count))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        if not resumable:
+            clear_staging(db)
+        raise
+    finally:
+        records.close()
+
+    rejects.write(cursor.execute("SELECT posicao, motivo, campos FROM importacao_rejeitados ORDER BY posicao"))
+    if not count:
+        # Um arquivo vazio ou sem nenhum paciente válido (de outro programa,
+        # por exemplo) não apaga o banco
+        clear_staging(db)
+        raise no_patients(rejects)
+    try:
+        # Recriar os índices no final é bem mais rápido do que mantê-los linha
+        # a linha; os gatilhos do registro de alterações também saem, e o
+        # registro é refeito de uma vez no final (RESET_CHANGES)
+        cursor.execute("SELECT type, name, sql FROM sqlite_master "
+                       "WHERE type IN ('index', 'trigger') AND tbl_name='pacientes' AND sql IS NOT NULL")
+        indexes = cursor.fetchall()
+        for kind, name, sql in indexes:
+            cursor.execute("DROP {0} {1}".format(kind.upper(), name))
+        cursor.execute("DELETE FROM planos")
+        cursor.execute("DELETE FROM pacientes")
+        cursor.execute(INSERT_STAGED_PLANOS)
+        cursor.execute(INSERT_STAGED_PACIENTES)
+        for kind, name, sql in indexes:
+            cursor.execute(sql)
+        if any(kind == "trigger" for kind, name, sql in indexes):
+            for sql in RESET_CHANGES:
+                cursor.execute(sql)
+        for sql in CLEAR_STAGING:
+            cursor.execute(sql)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        if not resumable:
+            clear_staging(db)
+        raise
+    finally:
+        planos.reload()
+    return count
+
+
+def merge_xml(db, filename, planos=None, batch_size=BATCH_SIZE, progress=None, fmt=XmlFormat, workers=1,
+              rejects=None, archived=False):
+    # Importação incremental: em vez de apagar tudo, casa cada <pac> com o
+    # paciente de mesmo registro (atributo opcional) ou, na falta dele, de
+    # mesmo nome e telefone, e só grava o que mudou. Pacientes que não estão
+    # no arquivo são removidos, a não ser que algum tenha sido recusado por
+    # validate: o arquivo está incompleto, e os recusados (gravados em
+    # rejects) não podem ser casados. Também são recusados os pacientes com o
+    # registro de um anterior, os sem registro cujo nome e telefone são de
+    # mais de um paciente do banco e os casados com o mesmo paciente que um
+    # anterior: gravar qualquer um deles seria escolher ao acaso entre duas
+    # versões. archived indica que o arquivo de inativos está anexado (ver
+    # RELEASE_ARCHIVED). Devolve as contagens de cada caso.
+    if planos is None:
+        planos = PlanoCache(db)
+    if rejects is None:
+        rejects = Rejects(rejects_name(filename))
+    cursor = db.cursor()
+    batch = []
+    rejected = []
+    registros = set()
+    count = 0
+    inputs = Inputs(filename)
+    records = inputs.rows(fmt, workers)
+    try:
+        cursor.execute("DROP TABLE IF EXISTS temp.entrada")
+        cursor.execute(CREATE_ENTRADA)
+        for position, row in enumerate(records, 1):
+            if row.__class__ is Reject:
+                rejected.append((position, row.reason, reject_fields(row.values)))
+                continue
+            record, plano, registro, nome_busca, conteudo_hash, nascimento = row
+            if registro is None or registro == "":
+                registro = None
+            else:
+                registro = int(registro)
+                if registro in registros:
+                    rejected.append((position, "registro repetido: {0}".format(registro),
+                                     reject_fields(reject_values(record, plano))))
+                    continue
+                registros.add(registro)
+            batch.append((position, registro) + record +
+                         (planos.get_and_set(plano, commit=False), nome_busca, conteudo_hash, nascimento))
+            if len(batch) >= batch_size:
+                cursor.executemany(INSERT_ENTRADA, batch)
+                count += len(batch)
+                batch.clear()
+                if progress is not None:
+                    progress(count, inputs.fraction())
+        if batch:
+            cursor.executemany(INSERT_ENTRADA, batch)
+            count += len(batch)
+        if not count:
+            # Como em import_xml: um arquivo sem nenhum paciente válido
+            # removeria todos os do banco
+            rejects.write(rejected)
+            raise no_patients(rejects)
+
+        cursor.execute(MATCH_ENTRADA)
+        cursor.execute("CREATE INDEX temp.entrada_paciente ON entrada (paciente_id)")
+        for query, reason in ((SELECT_AMBIGUOUS, "nome e telefone de mais de um paciente"),
+                              (SELECT_REPEATED, "mesmo paciente de uma linha anterior")):
+            found = cursor.execute(query).fetchall()
+            cursor.executemany(DELETE_ENTRADA, [(row[0],) for row in found])
+            rejected.extend((row[1], reason, reject_fields(row[2:])) for row in found)
+        rejected.sort(key=lambda reject: reject[0])
+        rejects.write(rejected)
+
+        removed = 0
+        if not rejected:
+            cursor.execute("DELETE FROM pacientes WHERE id NOT IN "
+                           "(SELECT paciente_id FROM entrada WHERE paciente_id IS NOT NULL)")
+            removed = cursor.rowcount
+        cursor.execute("UPDATE pacientes SET nome=e.nome, sexo=e.sexo, cartao=e.cartao, dia_nasc=e.dia_nasc, "
+                       "mes_nasc=e.mes_nasc, ano_nasc=e.ano_nasc, endereco=e.endereco, cidade=e.cidade, "
+                       "estado=e.estado, cep=e.cep, telefone=e.telefone, celular=e.celular, plano_id=e.plano_id, "
+                       "nome_busca=e.nome_busca, conteudo_hash=e.conteudo_hash, nascimento=e.nascimento, "
+                       "versao=pacientes.versao + 1 "
+                       "FROM entrada AS e "
+                       "WHERE e.paciente_id = pacientes.id AND pacientes.conteudo_hash IS NOT e.conteudo_hash")
+        updated = cursor.rowcount
+        cursor.execute("INSERT INTO pacientes "
+                       "(id, nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, cep, "
+                       "telefone, celular, plano_id, nome_busca, conteudo_hash, nascimento) "
+                       "SELECT registro, nome, sexo, cartao, dia_nasc, mes_nasc, ano_nasc, endereco, cidade, estado, "
+                       "cep, telefone, celular, plano_id, nome_busca, conteudo_hash, nascimento "
+                       "FROM entrada WHERE paciente_id IS NULL ORDER BY registro IS NULL, rowid")
+        inserted = cursor.rowcount
+        if archived:
+            cursor.execute(RELEASE_ARCHIVED)
+        cursor.execute("SELECT COUNT(DISTINCT paciente_id) FROM entrada WHERE paciente_id IS NOT NULL")
+        unchanged = cursor.fetchone()[0] - updated
+        cursor.execute("DELETE FROM planos WHERE id NOT IN (SELECT plano_id FROM pacientes)")
+        cursor.execute("DROP TABLE temp.entrada")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        cursor.execute("DROP TABLE IF EXISTS temp.entrada")
+        planos.reload()
+        raise
+    finally:
+        records.close()
+    planos.reload()
+    return {"inseridos": inserted, "atualizados": updated, "removidos": removed, "inalterados": unchanged,
+            "rejeitados": rejects.count}
+
+
+def quote(value):
+    # Mesmo resultado de quoteattr, sem o custo das substituições quando o
+    # valor não tem nada a escapar (o caso comum)
+    if SPECIAL.search(value) is None:
+        return '"' + value + '"'
+    return xml.sax.saxutils.quoteattr(value)
+
+
+def pac_line(record):
+    # record vem na ordem de SELECT_EXPORT: nome, atributos de ATTRIBUTES
+    if None in record:
+        attributes = "".join(" {0}={1}".format(name, quote(value))
+                             for name, value in zip(ATTRIBUTES, record[1:]) if value is not None)
+        return "<pac{0}>{1}</pac>\n".format(attributes, xml.sax.saxutils.escape(record[0] or ""))
+    if SPECIAL.search("".join(record)) is None:
+        return PAC_PLAIN.format(*record[1:], record[0])
+    return PAC_TEMPLATE.format(*map(quote, record[1:]), xml.sax.saxutils.escape(record[0]))
+
+
+def open_output(filename, temp):
+    # Arquivos terminados em .gz são gravados já compactados
+    raw = open(temp, "wb", buffering=WRITE_BUFFER)
+    if filename.endswith(".gz"):
+        return raw, gzip.GzipFile(filename=os.path.basename(filename[:-3]), fileobj=raw, mode="wb",
+                                  compresslevel=GZIP_LEVEL)
+    return raw, raw
+
+
+def part_name(filename, number):
+    # pacientes.csv.gz, 3 -> pacientes-0003.csv.gz
+    base, ext = os.path.splitext(filename[:-3] if filename.endswith(".gz") else filename)
+    return "{0}-{1:04d}{2}{3}".format(base, number, ext, ".gz" if filename.endswith(".gz") else "")
+
+
+def fraction(count, total):
+    # total vem de uma contagem anterior à consulta: outra estação pode ter
+    # gravado entre as duas, e count passar de total (que pode até ser 0)
+    return min(1.0, count / total) if total else 1.0
+
+
+def export_xml(db, filename, progress=None, chunk_size=EXPORT_CHUNK, fmt=XmlFormat, file_rows=None, archived=False):
+    # Lê o banco em blocos de chunk_size linhas e grava cada bloco de uma vez.
+    # Grava num arquivo temporário e só substitui o destino no final, para
+    # que um erro ou cancelamento não deixe um XML pela metade.
+    # Com file_rows, divide a saída em partes de até file_rows pacientes
+    # (ver part_name), cada uma um arquivo completo que pode ser importado
+    # sozinho; sem pacientes, grava uma única parte vazia. archived indica
+    # que o arquivo de inativos está anexado: os arquivados também vão.
+    cursor = db.cursor()
+    if archived:
+        cursor.execute("SELECT (SELECT COUNT(*) FROM pacientes) + (SELECT COUNT(*) FROM arquivo.pacientes)")
+    else:
+        cursor.execute("SELECT COUNT(*) FROM pacientes")
+    total = cursor.fetchone()[0]
+    cursor.execute(SELECT_EXPORT_ARCHIVED if archived else SELECT_EXPORT)
+
+    if file_rows:
+        chunk_size = min(chunk_size, file_rows)
+        names = [part_name(filename, number + 1) for number in range(max(1, -(-total // file_rows)))]
+    else:
+        file_rows = total
+        names = [filename]
+    temps = []
+    count = 0
+    try:
+        for number, name in enumerate(names, 1):
+            # A última parte leva o que sobrar, caso o banco tenha mudado
+            # entre a contagem e a consulta
+            last = number == len(names)
+            temps.append(name + ".tmp")
+            raw, fh = open_output(name, temps[-1])
+            with raw:
+                fh.write(fmt.header)
+                written = 0
+                while last or written < file_rows:
+                    records = cursor.fetchmany(chunk_size if last else min(chunk_size, file_rows - written))
+                    if not records:
+                        break
+                    fh.write(fmt.lines(records).encode("UTF-8"))
+                    written += len(records)
+                    count += len(records)
+                    if progress is not None:
+                        progress(count, fraction(count, total))
+                fh.write(fmt.footer)
+                if fh is not raw:
+                    fh.close()
+        for name, temp in zip(names, temps):
+            os.replace(temp, name)
+    except BaseException:
+        for temp in temps:
+            if os.path.exists(temp):
+                os.remove(temp)
+        raise
+    return count
+
+
+def change_seq(db, timestamp):
+    # seq a partir da qual estão as alterações feitas depois de timestamp
+    # ('AAAA-MM-DD' ou 'AAAA-MM-DDTHH:MM:SS', UTC). O momento vem do relógio
+    # de cada estação, e com relógios fora de acerto não cresce junto com a
+    # seq: vale a menor seq entre as alterações com momento depois de
+    # timestamp, para não pular nenhuma delas (as que vieram depois, na
+    # ordem das seq, também vão). Mesmo assim uma alteração gravada por um
+    # relógio atrasado pode ficar antes de timestamp; só a seq devolvida
+    # pela exportação anterior não perde nada. O índice de momento limita a
+    # leitura às alterações depois de timestamp.
+    cursor = db.cursor()
+    cursor.execute("SELECT min(seq) - 1 FROM alteracoes INDEXED BY alteracoes_momento WHERE momento > ?",
+                   (timestamp,))
+    row = cursor.fetchone()
+    if row[0] is None:
+        cursor.execute("SELECT ifnull(max(seq), 0) FROM alteracoes")
+        row = cursor.fetchone()
+    return row[0]
+
+
+def export_changes(db, filename, since=0, progress=None, chunk_size=EXPORT_CHUNK, archived=False):
+    # Grava em XML só os pacientes alterados depois da alteração since, com
+    # o atributo registro, e um <removido registro="..."/> para cada paciente
+    # removido. O elemento raiz traz desde e ate (a seq a passar como since
+    # na próxima vez) e completo="1" quando since é anterior à última
+    # importação completa: aí o arquivo tem todos os pacientes e substitui
+    # tudo o que já foi recebido. O custo depende só do número de alterações.
+    # Com archived (arquivo de inativos anexado), os arquivados saem com os
+    # campos do arquivo. Devolve (pacientes gravados ou removidos, ate).
+    cursor = db.cursor()
+    cursor.execute("SELECT ifnull(max(seq), 0) FROM alteracoes")
+    last = cursor.fetchone()[0]
+    cursor.execute("SELECT seq FROM alteracoes_inicio")
+    complete = since <= cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM alteracoes WHERE seq > ? AND seq <= ?", (since, last))
+    total = cursor.fetchone()[0]
+    cursor.execute(SELECT_CHANGES_ARCHIVED if archived else SELECT_CHANGES, (since, last))
+
+    temp = filename + ".tmp"
+    count = 0
+    try:
+        raw, fh = open_output(filename, temp)
+        with raw:
+            fh.write(CHANGES_HEADER.format(since, last, int(complete)).encode("UTF-8"))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                lines = []
+                for row in rows:
+                    if row[1] or row[2] is None:
+                        lines.append('<removido registro="{0}"/>\n'.format(row[0]))
+                    else:
+                        lines.append('<pac registro="{0}"'.format(row[0]) + pac_line(row[2:])[4:])
+                fh.write("".join(lines).encode("UTF-8"))
+                count += len(rows)
+                if progress is not None:
+                    progress(count, fraction(count, total))
+            fh.write(XmlFormat.footer)
+            if fh is not raw:
+                fh.close()
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return count, last